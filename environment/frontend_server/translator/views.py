@@ -6,6 +6,7 @@ import os
 import string
 import random
 import json
+import socket
 from os import listdir
 import os
 
@@ -238,12 +239,50 @@ def path_tester(request):
   return render(request, template, context)
 
 
+def send_to_backend(message, timeout=10): 
+  """
+  Sends <message> to the frontend channel of the backend server (see 
+  reverie/backend_server/frontend_channel.py), whose port the backend 
+  leaves in "temp_storage/curr_sim_code.json". 
+
+  ARGS:
+    message: the json message
+    timeout: the seconds we wait for the answer
+  RETURNS: 
+    the json answer, or None if there is no channel to send it to (in which
+    case we fall back to the files). 
+  """
+  f_curr_sim_code = "temp_storage/curr_sim_code.json"
+  try: 
+    with open(f_curr_sim_code) as json_file:  
+      port = json.load(json_file).get("channel_port")
+  except (OSError, ValueError): 
+    return None
+  if not port: 
+    return None
+
+  try: 
+    with socket.create_connection(("127.0.0.1", port), 
+                                  timeout=timeout + 5) as conn: 
+      conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+      answer = conn.makefile("rb").readline()
+  except OSError: 
+    return None
+  if not answer: 
+    return None
+  answer = json.loads(answer)
+  if "error" in answer: 
+    return None
+  return answer
+
+
 def process_environment(request): 
   """
   <FRONTEND to BACKEND> 
   This sends the frontend visual world information to the backend server. 
-  It does this by writing the current environment representation to 
-  "storage/environment.json" file. 
+  It does this by pushing the current environment representation to the 
+  backend's frontend channel, or if there is none, by writing it to the 
+  "storage/<sim_code>/environment/<step>.json" file. 
 
   ARGS:
     request: Django request
@@ -259,8 +298,13 @@ def process_environment(request):
   sim_code = data["sim_code"]
   environment = data["environment"]
 
-  with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
-    outfile.write(json.dumps(environment, indent=2))
+  answer = send_to_backend({"type": "environment", 
+                            "sim_code": sim_code, 
+                            "step": step, 
+                            "environment": environment})
+  if not answer: 
+    with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
+      outfile.write(json.dumps(environment, indent=2))
 
   return HttpResponse("received")
 
@@ -270,8 +314,10 @@ def update_environment(request):
   <BACKEND to FRONTEND> 
   This sends the backend computation of the persona behavior to the frontend
   visual server. 
-  It does this by reading the new movement information from 
-  "storage/movement.json" file.
+  It does this by asking the backend's frontend channel for the new movement
+  information, which answers as soon as the backend has it, or if there is
+  no channel, by reading it from the "storage/<sim_code>/movement/<step>.json"
+  file.
 
   ARGS:
     request: Django request
@@ -287,7 +333,13 @@ def update_environment(request):
   sim_code = data["sim_code"]
 
   response_data = {"<step>": -1}
-  if (check_if_file_exists(f"storage/{sim_code}/movement/{step}.json")):
+  answer = send_to_backend({"type": "movement", 
+                            "sim_code": sim_code, 
+                            "step": step, 
+                            "timeout": 10}, 10)
+  if answer and answer["<step>"] == step: 
+    response_data = answer
+  elif (check_if_file_exists(f"storage/{sim_code}/movement/{step}.json")):
     with open(f"storage/{sim_code}/movement/{step}.json") as json_file: 
       response_data = json.load(json_file)
       response_data["<step>"] = step
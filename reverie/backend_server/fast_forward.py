@@ -0,0 +1,171 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: fast_forward.py
+Description: Skips the cognition of the personas in the steps where it would
+not change what they do. Most persona-steps are spent walking a path that is
+already planned, or sleeping for hours, and yet every one of them runs the
+whole perceive/retrieve/plan/reflect sequence. A persona only needs to think
+in a step when
+  - a new day starts,
+  - its current action ends (see Scratch.act_check_finished),
+  - it is in a conversation,
+  - it has just arrived at the end of its path, or
+  - it sees a new event: a persona that comes into its vision, or a persona
+    in its vision that does something new (or an object, if it is not
+    walking).
+In every other step, the persona coasts: it keeps to its current action, and
+takes the next tile of its path (see FastForward.coast).
+
+When no persona thinks in a step and none of them is walking, the world does
+not change until the first of them wakes up, so the clock jumps right to
+that point (on the grid of <sec_per_step>, so that the action ends are still
+met; see FastForward.get_next_time), e.g., from when the last persona falls
+asleep until the first one wakes up or the day ends. Such a step still counts
+as one step, with one movement file.
+
+What the personas miss this way: a walking persona does not perceive the
+objects it walks past (it still remembers the spaces it sees), and so they do
+not go into its associative memory either.
+"""
+import datetime
+
+from persona.persona import *
+
+
+class FastForward:
+  def __init__(self, sec_per_step):
+    self.sec_per_step = sec_per_step
+    # <seen> maps a persona name to the events it saw in its last step.
+    self.seen = dict()
+    # <walking> is the set of names of the personas that were on their way
+    # somewhere at the start of the last step.
+    self.walking = set()
+    # Counters: the persona-steps that thought and that coasted, and the
+    # steps that jumped the clock and the seconds of game time they skipped.
+    self.thinking_steps = 0
+    self.coasting_steps = 0
+    self.jumps = 0
+    self.skipped_seconds = 0
+
+
+  def _get_seen_events(self, persona, maze):
+    """
+    Returns the set of events that the persona sees that would wake it up if
+    they were new.
+    """
+    walking = bool(persona.scratch.planned_path)
+    seen = set()
+    for event in get_perceived_events(persona, maze):
+      if event[0] == persona.name:
+        continue
+      # The objects go by as the persona walks.
+      if walking and ":" in event[0]:
+        continue
+      seen.add(event)
+    return seen
+
+
+  def get_thinkers(self, maze, personas, personas_tile, curr_time):
+    """
+    Returns the names of the personas that think in the step at <curr_time>
+    (in the order of the personas). The others coast.
+    """
+    thinkers = []
+    walking = set()
+    for persona_name, persona in personas.items():
+      scratch = persona.scratch
+      # The persona is placed on this tile at the start of its move anyway.
+      scratch.curr_tile = personas_tile[persona_name]
+      seen = self._get_seen_events(persona, maze)
+
+      if (not scratch.curr_time
+          or (scratch.curr_time.strftime('%A %B %d')
+              != curr_time.strftime('%A %B %d'))):
+        think = True
+      elif scratch.chatting_with or not scratch.act_address:
+        think = True
+      elif (scratch.get_act_end_time().strftime("%H:%M:%S")
+            == curr_time.strftime("%H:%M:%S")):
+        think = True
+      elif persona_name in self.walking and not scratch.planned_path:
+        think = True
+      elif (persona_name not in self.seen
+            or seen - self.seen[persona_name]):
+        think = True
+      else:
+        think = False
+
+      if think:
+        thinkers += [persona_name]
+      if scratch.planned_path:
+        walking.add(persona_name)
+      self.seen[persona_name] = seen
+
+    self.walking = walking
+    self.thinking_steps += len(thinkers)
+    self.coasting_steps += len(personas) - len(thinkers)
+    return thinkers
+
+
+  def coast(self, maze, personas, persona_name, curr_tile, curr_time):
+    """
+    Moves the persona <persona_name> for the step at <curr_time> without
+    thinking: it perceives the spaces around it, and goes on with its
+    current action.
+    OUTPUT:
+      the (next_tile, pronunciatio, description) of Persona.move.
+    """
+    persona = personas[persona_name]
+    persona.scratch.curr_tile = curr_tile
+    persona.scratch.curr_time = curr_time
+    perceive_space(persona, maze,
+                   maze.get_nearby_tiles(curr_tile, persona.scratch.vision_r))
+    update_chat_state(persona)
+    return persona.execute(maze, personas, persona.scratch.act_address)
+
+
+  def get_next_time(self, personas, curr_time, thinkers):
+    """
+    Returns the time of the step after the step at <curr_time>, in which
+    <thinkers> thought. That is the next step on the clock, unless nobody
+    thought or is on their way somewhere: then nothing changes until the
+    first action ends or the day does, and we jump to the last step at or
+    before that.
+    """
+    sec_per_step = datetime.timedelta(seconds=self.sec_per_step)
+    if (thinkers or self.walking
+        or any([i.scratch.planned_path for i in personas.values()])):
+      return curr_time + sec_per_step
+
+    wake_time = datetime.datetime.combine(curr_time.date()
+                                          + datetime.timedelta(days=1),
+                                          datetime.time())
+    for persona in personas.values():
+      # An action ends when the clock shows its end time (see
+      # Scratch.act_check_finished).
+      end_time = datetime.datetime.combine(curr_time.date(),
+                                           persona.scratch.get_act_end_time()
+                                           .time())
+      if end_time <= curr_time:
+        end_time += datetime.timedelta(days=1)
+      wake_time = min(wake_time, end_time)
+
+    n_steps = max(1, (wake_time - curr_time) // sec_per_step)
+    if n_steps > 1:
+      # The personas account for the steps that we skip.
+      for persona in personas.values():
+        update_chat_state(persona, n_steps - 1)
+      self.jumps += 1
+      self.skipped_seconds += (n_steps - 1) * self.sec_per_step
+    return curr_time + n_steps * sec_per_step
+
+
+  def get_str_stats(self):
+    persona_steps = self.thinking_steps + self.coasting_steps
+    coasted = self.coasting_steps / persona_steps if persona_steps else 0
+    return (f"Fast forward: {self.thinking_steps} persona-steps thought, "
+            f"{self.coasting_steps} coasted ({coasted:.0%}), "
+            f"{self.jumps} jumps of the clock skipped "
+            f"{datetime.timedelta(seconds=self.skipped_seconds)} of game "
+            f"time")
@@ -0,0 +1,112 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: frontend_channel.py
+Description: A local socket between the frontend server (the Django views in
+environment/frontend_server/translator/views.py) and the simulation server,
+which replaces the environment and movement files of the live loop. Instead
+of the frontend writing environment/<step>.json and the simulation server
+polling for it (and the other way around for movement/<step>.json), both
+sides push to each other:
+  - the frontend sends the environment of a step, and the simulation server,
+    which waits on it, starts the step right away, and
+  - the frontend asks for the movements of a step, and gets them as soon as
+    the simulation server has them (a long poll).
+
+Every message is a line of json, and so is every answer:
+  {"type": "environment", "sim_code": ..., "step": ..., "environment": ...}
+    -> {"ok": true}
+  {"type": "movement", "sim_code": ..., "step": ..., "timeout": <seconds>}
+    -> the movements of the step with their "<step>", or {"<step>": -1} if
+       they are not ready within <timeout>.
+The port of the channel is in temp_storage/curr_sim_code.json, so the
+frontend finds it, and falls back to the files if there is none (or the
+simulation server is gone).
+"""
+import json
+import socketserver
+import threading
+
+
+class ChannelServer(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+class ChannelHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    # A connection can send any number of messages.
+    for line in self.rfile:
+      try:
+        answer = self.server.channel.answer(json.loads(line))
+      except (ValueError, KeyError) as e:
+        answer = {"error": f"Bad message: {e}"}
+      self.wfile.write((json.dumps(answer) + "\n").encode("utf-8"))
+
+
+class FrontendChannel:
+  def __init__(self, sim_code, port=0):
+    """
+    Opens the channel of the simulation <sim_code> on <port> (0 for any free
+    port) of localhost.
+    """
+    self.sim_code = sim_code
+    # <environments> maps a step to the environment the frontend sent for
+    # it, and <movements> maps a step to the movements of the step.
+    self.environments = dict()
+    self.movements = dict()
+    self.condition = threading.Condition()
+
+    self.server = ChannelServer(("127.0.0.1", port), ChannelHandler)
+    self.server.channel = self
+    self.port = self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+  def answer(self, message):
+    if message["sim_code"] != self.sim_code:
+      return {"error": f"This channel is for {self.sim_code}"}
+
+    step = int(message["step"])
+    if message["type"] == "environment":
+      with self.condition:
+        self.environments[step] = message["environment"]
+        self.condition.notify_all()
+      return {"ok": True}
+
+    elif message["type"] == "movement":
+      with self.condition:
+        self.condition.wait_for(lambda: step in self.movements,
+                                float(message.get("timeout", 10)))
+        if step not in self.movements:
+          return {"<step>": -1}
+        return dict(self.movements[step], **{"<step>": step})
+
+    return {"error": f"Unknown message type: {message['type']}"}
+
+
+  def wait_for_environment(self, step, timeout):
+    """
+    Returns the environment that the frontend sent for <step>, waiting up
+    to <timeout> seconds for it, or None if it has not arrived.
+    """
+    with self.condition:
+      self.condition.wait_for(lambda: step in self.environments, timeout)
+      return self.environments.pop(step, None)
+
+
+  def publish_movement(self, step, movements):
+    """
+    Hands the <movements> of <step> to the frontend.
+    """
+    with self.condition:
+      self.movements[step] = movements
+      # The frontend only ever asks for the latest steps.
+      for i in [i for i in self.movements if i < step - 1]:
+        del self.movements[i]
+      self.condition.notify_all()
+
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
@@ -204,6 +204,60 @@ class Maze:
           else: 
             self.address_tiles[add] = set([(j, i)])
 
+    # <journal> is the list of [method name, args] of the tile event writes
+    # applied since start_journal(), or None if we do not keep one. 
+    self.journal = None
+
+
+  def _journal_write(self, method_name, *args): 
+    # The tile event writes go to the journal, if we keep one. 
+    if self.journal is not None: 
+      self.journal += [[method_name, args]]
+
+
+  def start_journal(self): 
+    """
+    Starts keeping a journal of the tile event writes, so that other copies
+    of the maze (e.g., in the persona workers) can follow along by replaying
+    it (see take_journal). 
+    """
+    self.journal = []
+
+
+  def take_journal(self): 
+    """
+    Returns the journal of the tile event writes since the last call, as a 
+    list of [method name, args]. 
+    """
+    journal = self.journal
+    self.journal = []
+    return journal
+
+
+  def get_tile_events(self): 
+    """
+    Returns the events of all tiles that have any, as a list of [(x, y), 
+    <set of event triples>]. 
+    """
+    ret = []
+    for y, row in enumerate(self.tiles): 
+      for x, tile in enumerate(row): 
+        if tile["events"]: 
+          ret += [[(x, y), set(tile["events"])]]
+    return ret
+
+
+  def set_tile_events(self, tile_events): 
+    """
+    Replaces the events of all tiles with <tile_events> (as returned by
+    get_tile_events). 
+    """
+    for row in self.tiles: 
+      for tile in row: 
+        tile["events"] = set()
+    for (x, y), events in tile_events: 
+      self.tiles[y][x]["events"] = set(events)
+
 
   def turn_coordinate_to_tile(self, px_coordinate): 
     """
@@ -336,6 +390,7 @@ class Maze:
     OUPUT: 
       None
     """
+    self._journal_write("add_event_from_tile", curr_event, tile)
     self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
 
 
@@ -351,6 +406,7 @@ class Maze:
     OUPUT: 
       None
     """
+    self._journal_write("remove_event_from_tile", curr_event, tile)
     curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
     for event in curr_tile_ev_cp: 
       if event == curr_event:  
@@ -358,6 +414,7 @@ class Maze:
 
 
   def turn_event_from_tile_idle(self, curr_event, tile):
+    self._journal_write("turn_event_from_tile_idle", curr_event, tile)
     curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
     for event in curr_tile_ev_cp: 
       if event == curr_event:  
@@ -376,6 +433,7 @@ class Maze:
     OUPUT: 
       None
     """
+    self._journal_write("remove_subject_events_from_tile", subject, tile)
     curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
     for event in curr_tile_ev_cp: 
       if event[0] == subject:  
@@ -0,0 +1,160 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: parallel_step.py
+Description: Runs the moves of all personas of a step in parallel. A move is
+dominated by its LLM round trips, which do not depend on the other personas,
+so a step of N personas takes about as long as its slowest persona instead of
+the sum of all of them.
+
+So that the personas do not see each other half way through their moves,
+every persona sees the others as they were at the start of the step
+(PersonaSnapshot), with everyone at their tile in <personas_tile>. The tile
+events of the maze stay put during the step by themselves: a move only
+reads them (the server writes them before the personas move; see
+ReverieServer.start_server). What a persona does to another persona (e.g.,
+a conversation, which also changes the schedule of the persona it is with;
+see plan.py) is deferred, and applied at the barrier after all moves are
+done, in the order of the personas.
+"""
+import contextvars
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# <current_step_barrier> is the StepBarrier of the parallel step that the
+# current context runs in, or None outside of a parallel step.
+current_step_barrier = contextvars.ContextVar("current_step_barrier",
+                                              default=None)
+
+
+# <BARRIER_ACTIONS> maps the kind of a deferred action to the function that
+# applies it at the barrier, which is called with (maze, personas, <the name
+# of the persona that deferred it>, *<the args of the action>). Deferred
+# actions are plain data rather than closures, so that they can also be sent
+# between processes (see persona_workers.py).
+BARRIER_ACTIONS = dict()
+
+
+def register_barrier_action(kind, func):
+  BARRIER_ACTIONS[kind] = func
+
+
+def get_step_barrier():
+  return current_step_barrier.get()
+
+
+class PersonaSnapshot:
+  """
+  A read-only view of a persona as it was at the start of a parallel step,
+  which is what the other personas see of it during the step.
+  """
+  def __init__(self, persona):
+    self.persona = persona
+    self.name = persona.name
+    # The persona changes its scratch (and the lists and dicts in it) in 
+    # place during its move. A scratch only holds plain data, so a deep copy
+    # is cheap. 
+    self.scratch = copy.deepcopy(persona.scratch)
+
+
+  def __getattr__(self, name):
+    # Everything but the scratch (e.g., the memories) is the persona's own.
+    return getattr(self.persona, name)
+
+
+class StepBarrier:
+  def __init__(self, persona_names):
+    # <order> maps a persona name to its position in the order of the
+    # personas, which is the order we apply the deferred actions in.
+    self.order = {name: i for i, name in enumerate(persona_names)}
+    # <deferred> is the list of [order, sequence number, persona name, kind,
+    # args] of the deferred actions.
+    self.deferred = []
+    self.lock = threading.Lock()
+
+
+  def defer(self, persona_name, kind, *args):
+    """
+    Defers the action of <kind> (see BARRIER_ACTIONS) with <args> that the
+    persona <persona_name> takes to the barrier.
+    """
+    with self.lock:
+      self.deferred += [[self.order[persona_name], len(self.deferred),
+                         persona_name, kind, args]]
+
+
+  def take_deferred(self):
+    """
+    Returns the deferred actions in the order we apply them in.
+    """
+    ret = sorted(self.deferred, key=lambda x: x[:2])
+    self.deferred = []
+    return ret
+
+
+  def apply(self, maze, personas):
+    for order, sequence, persona_name, kind, args in self.take_deferred():
+      BARRIER_ACTIONS[kind](maze, personas, persona_name, *args)
+
+
+def move_personas_behind_barrier(maze, personas, personas_tile, curr_time,
+                                 barrier, movers=None, max_workers=None):
+  """
+  Moves the personas <movers> (all <personas> by default) for the step at
+  <curr_time> in parallel, and leaves the actions they deferred on 
+  <barrier>.
+  INPUT:
+    maze: the Maze of the world
+    personas: a dictionary of persona name -> Persona (or any stand-in with
+              a name and a scratch, for the personas that do not move here)
+    personas_tile: a dictionary of persona name -> the persona's (x, y) tile
+    curr_time: the datetime of the step
+    barrier: the StepBarrier of the step
+    movers: the names of the personas to move
+    max_workers: the max number of personas that move at once (None for all
+                 of them)
+  OUTPUT:
+    a dictionary of persona name -> the (next_tile, pronunciatio,
+    description) returned by its move.
+  """
+  movers = movers if movers is not None else list(personas.keys())
+  # Every persona sees everyone at their tile of this step.
+  for persona_name, persona in personas.items():
+    persona.scratch.curr_tile = personas_tile[persona_name]
+  snapshots = {name: PersonaSnapshot(persona)
+               for name, persona in personas.items()}
+
+  def move(persona_name):
+    curr_personas = dict(snapshots)
+    curr_personas[persona_name] = personas[persona_name]
+    current_step_barrier.set(barrier)
+    return personas[persona_name].move(maze, curr_personas,
+                                       personas_tile[persona_name],
+                                       curr_time)
+
+  if not movers:
+    return dict()
+  with ThreadPoolExecutor(max_workers or len(movers)) as executor:
+    # Every move runs in its own copy of the context, so that the context
+    # variables it sets (e.g., the barrier) stay with it.
+    futures = {name: executor.submit(contextvars.copy_context().run,
+                                     move, name)
+               for name in movers}
+    return {name: futures[name].result() for name in movers}
+
+
+def move_personas_in_parallel(maze, personas, personas_tile, curr_time,
+                              max_workers=None, movers=None):
+  """
+  Moves the personas <movers> (all <personas> by default) for the step at
+  <curr_time> in parallel (see move_personas_behind_barrier), and applies
+  the actions they deferred at the barrier once all of them are done.
+  Returns a dictionary of persona name -> the (next_tile, pronunciatio,
+  description) returned by its move.
+  """
+  barrier = StepBarrier(list(personas.keys()))
+  ret = move_personas_behind_barrier(maze, personas, personas_tile,
+                                     curr_time, barrier, movers, max_workers)
+  barrier.apply(maze, personas)
+  return ret
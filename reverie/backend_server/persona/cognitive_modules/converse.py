@@ -123,49 +123,45 @@ def generate_one_utterance(maze, init_persona, target_persona, retrieved, curr_c
 
   return x["utterance"], x["end"]
 
+def agent_chat_turn(maze, init_persona, target_persona, curr_chat): 
+  """
+  Generates the next utterance of <init_persona> to <target_persona> in the
+  conversation <curr_chat>. Only <init_persona>'s memory is used, so the 
+  turns of a conversation can be generated wherever the speaker's memory 
+  lives (see persona_workers.py). 
+  OUTPUT: 
+    the str utterance, and whether it ends the conversation
+  """
+  focal_points = [f"{target_persona.scratch.name}"]
+  retrieved = new_retrieve(init_persona, focal_points, 50)
+  relationship = generate_summarize_agent_relationship(init_persona, target_persona, retrieved)
+  print ("-------- relationshopadsjfhkalsdjf", relationship)
+  last_chat = ""
+  for i in curr_chat[-4:]:
+    last_chat += ": ".join(i) + "\n"
+  if last_chat: 
+    focal_points = [f"{relationship}", 
+                    f"{target_persona.scratch.name} is {target_persona.scratch.act_description}", 
+                    last_chat]
+  else: 
+    focal_points = [f"{relationship}", 
+                    f"{target_persona.scratch.name} is {target_persona.scratch.act_description}"]
+  retrieved = new_retrieve(init_persona, focal_points, 15)
+  return generate_one_utterance(maze, init_persona, target_persona, retrieved, curr_chat)
+
+
 def agent_chat_v2(maze, init_persona, target_persona): 
   curr_chat = []
   print ("July 23")
 
   for i in range(8): 
-    focal_points = [f"{target_persona.scratch.name}"]
-    retrieved = new_retrieve(init_persona, focal_points, 50)
-    relationship = generate_summarize_agent_relationship(init_persona, target_persona, retrieved)
-    print ("-------- relationshopadsjfhkalsdjf", relationship)
-    last_chat = ""
-    for i in curr_chat[-4:]:
-      last_chat += ": ".join(i) + "\n"
-    if last_chat: 
-      focal_points = [f"{relationship}", 
-                      f"{target_persona.scratch.name} is {target_persona.scratch.act_description}", 
-                      last_chat]
-    else: 
-      focal_points = [f"{relationship}", 
-                      f"{target_persona.scratch.name} is {target_persona.scratch.act_description}"]
-    retrieved = new_retrieve(init_persona, focal_points, 15)
-    utt, end = generate_one_utterance(maze, init_persona, target_persona, retrieved, curr_chat)
+    utt, end = agent_chat_turn(maze, init_persona, target_persona, curr_chat)
 
     curr_chat += [[init_persona.scratch.name, utt]]
     if end:
       break
 
-
-    focal_points = [f"{init_persona.scratch.name}"]
-    retrieved = new_retrieve(target_persona, focal_points, 50)
-    relationship = generate_summarize_agent_relationship(target_persona, init_persona, retrieved)
-    print ("-------- relationshopadsjfhkalsdjf", relationship)
-    last_chat = ""
-    for i in curr_chat[-4:]:
-      last_chat += ": ".join(i) + "\n"
-    if last_chat: 
-      focal_points = [f"{relationship}", 
-                      f"{init_persona.scratch.name} is {init_persona.scratch.act_description}", 
-                      last_chat]
-    else: 
-      focal_points = [f"{relationship}", 
-                      f"{init_persona.scratch.name} is {init_persona.scratch.act_description}"]
-    retrieved = new_retrieve(target_persona, focal_points, 15)
-    utt, end = generate_one_utterance(maze, target_persona, init_persona, retrieved, curr_chat)
+    utt, end = agent_chat_turn(maze, target_persona, init_persona, curr_chat)
 
     curr_chat += [[target_persona.scratch.name, utt]]
     if end:
@@ -7,67 +7,113 @@ Description: This defines the "Perceive" module for generative agents.
 import sys
 sys.path.append('../../')
 
+import utils
 from operator import itemgetter
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
 from persona.prompt_template.run_gpt_prompt import *
 
+# <poignancy_batch> in utils.py scores the poignancy of newly perceived events
+# in one batched prompt instead of one prompt per event: 
+#   None: one prompt per event (the default)
+#   "persona": one prompt for all new events of a persona, in perceive
+#   "step": one prompt for the new events of all personas in a step (see 
+#           prefetch_step_poig_scores)
+poignancy_batch = getattr(utils, "poignancy_batch", None)
+
+# <poig_score_memo> maps a persona name to {(event_type, description): score}
+# for the scores that were prefetched in a batched prompt. Scores are used
+# once; anything not in here is scored on its own in generate_poig_score. 
+poig_score_memo = dict()
+
+
 def generate_poig_score(persona, event_type, description): 
   if "is idle" in description: 
     return 1
 
+  memo = poig_score_memo.get(persona.name, dict())
+  if (event_type, description) in memo: 
+    return memo.pop((event_type, description))
+
   if event_type == "event": 
     return run_gpt_prompt_event_poignancy(persona, description)[0]
   elif event_type == "chat": 
     return run_gpt_prompt_chat_poignancy(persona, 
                            persona.scratch.act_description)[0]
 
-def perceive(persona, maze): 
+def prefetch_poig_scores(persona_events): 
   """
-  Perceives events around the persona and saves it to the memory, both events 
-  and spaces. 
+  Scores the poignancy of all <persona_events> in one batched prompt, and 
+  keeps the scores for generate_poig_score. If the batched response cannot
+  be parsed, we keep nothing and every event gets scored on its own. 
 
-  We first perceive the events nearby the persona, as determined by its 
-  <vision_r>. If there are a lot of events happening within that radius, we 
-  take the <att_bandwidth> of the closest events. Finally, we check whether
-  any of them are new, as determined by <retention>. If they are new, then we
-  save those and return the <ConceptNode> instances for those events. 
+  INPUT: 
+    persona_events: a list of [persona, [[event_type, description], ...]]
+  OUTPUT: 
+    None
+  """
+  to_score = []
+  for persona, events in persona_events: 
+    poig_score_memo[persona.name] = dict()
+    events = [list(i) for i in dict.fromkeys([tuple(i) for i in events]) 
+              if "is idle" not in i[1]]
+    if events: 
+      to_score += [[persona, events]]
+
+  # A single event gains nothing from a batched prompt. 
+  if sum([len(events) for persona, events in to_score]) < 2: 
+    return
+
+  scores = run_gpt_prompt_poignancy_batch(to_score)[0]
+  if not scores: 
+    return
+  for persona, events in to_score: 
+    for event_type, description in events: 
+      poig_score_memo[persona.name][(event_type, description)] = scores.pop(0)
+
+
+def prefetch_step_poig_scores(personas, maze, personas_tile): 
+  """
+  Scores the poignancy of the events that all personas are about to perceive
+  in this step, in one batched prompt. This is called at the start of a step,
+  before the personas move (see ReverieServer.start_server). 
 
   INPUT: 
-    persona: An instance of <Persona> that represents the current persona. 
-    maze: An instance of <Maze> that represents the current maze in which the 
-          persona is acting in. 
+    personas: A dictionary that contains all persona names as keys, and the 
+              Persona instance as values. 
+    maze: An instance of <Maze> that represents the current maze. 
+    personas_tile: A dictionary that contains all persona names as keys, and
+                   the tile of the persona in this step as values. 
   OUTPUT: 
-    ret_events: a list of <ConceptNode> that are perceived and new. 
+    None
   """
-  # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius. 
-  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
-                                       persona.scratch.vision_r)
+  persona_events = []
+  for persona_name, persona in personas.items(): 
+    # The persona is placed on this tile at the start of its move anyway.
+    persona.scratch.curr_tile = personas_tile[persona_name]
+    perceived_events = get_perceived_events(persona, maze)
+    persona_events += [[persona, 
+                        get_new_event_descriptions(persona, perceived_events)]]
+  prefetch_poig_scores(persona_events)
 
-  # We then store the perceived space. Note that the s_mem of the persona is
-  # in the form of a tree constructed using dictionaries. 
-  for i in nearby_tiles: 
-    i = maze.access_tile(i)
-    if i["world"]: 
-      if (i["world"] not in persona.s_mem.tree): 
-        persona.s_mem.tree[i["world"]] = {}
-    if i["sector"]: 
-      if (i["sector"] not in persona.s_mem.tree[i["world"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]] = {}
-    if i["arena"]: 
-      if (i["arena"] not in persona.s_mem.tree[i["world"]]
-                                              [i["sector"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
-    if i["game_object"]: 
-      if (i["game_object"] not in persona.s_mem.tree[i["world"]]
-                                                    [i["sector"]]
-                                                    [i["arena"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
-                                                             i["game_object"]]
 
-  # PERCEIVE EVENTS. 
+def get_perceived_events(persona, maze, nearby_tiles=None): 
+  """
+  Returns the <att_bandwidth> closest events in the persona's vision radius
+  that take place in the persona's current arena. 
+
+  INPUT: 
+    persona: An instance of <Persona> that represents the current persona. 
+    maze: An instance of <Maze> that represents the current maze. 
+    nearby_tiles: the tiles within the persona's vision radius (if we 
+                  already have them). 
+  OUTPUT: 
+    a list of (s, p, o, desc) events. 
+  """
+  if nearby_tiles is None: 
+    nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
+                                         persona.scratch.vision_r)
+
   # We will perceive events that take place in the same arena as the
   # persona's current arena. 
   curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
@@ -101,6 +147,108 @@ def perceive(persona, maze):
   perceived_events = []
   for dist, event in percept_events_list[:persona.scratch.att_bandwidth]: 
     perceived_events += [event]
+  return perceived_events
+
+
+def get_new_event_descriptions(persona, perceived_events): 
+  """
+  Returns the descriptions of the perceived events that are new to the 
+  persona (as determined by <retention>), in the form they are embedded and
+  scored in perceive. This includes the persona's own chat, if there is one.
+
+  INPUT: 
+    persona: An instance of <Persona> that represents the current persona. 
+    perceived_events: a list of (s, p, o, desc) events. 
+  OUTPUT: 
+    a list of [event_type, description] where event_type is "event" or 
+    "chat". 
+  """
+  latest_events = persona.a_mem.get_summarized_latest_events(
+                                  persona.scratch.retention)
+  new_events = []
+  for s, p, o, desc in perceived_events: 
+    if p and (s, p, o) not in latest_events: 
+      desc = f"{s.split(':')[-1]} is {desc}"
+      if "(" in desc: 
+        desc = desc.split("(")[1].split(")")[0].strip()
+      new_events += [["event", desc]]
+      if s == f"{persona.name}" and p == "chat with": 
+        new_events += [["chat", persona.scratch.act_description]]
+  return new_events
+
+
+def perceive_space(persona, maze, nearby_tiles): 
+  """
+  Stores the <nearby_tiles> that the persona sees in its spatial memory.
+
+  INPUT: 
+    persona: An instance of <Persona> that represents the current persona. 
+    maze: An instance of <Maze> that represents the current maze. 
+    nearby_tiles: the tiles within the persona's vision radius. 
+  OUTPUT: 
+    None
+  """
+  # Note that the s_mem of the persona is in the form of a tree constructed 
+  # using dictionaries. 
+  for i in nearby_tiles: 
+    i = maze.access_tile(i)
+    if i["world"]: 
+      if (i["world"] not in persona.s_mem.tree): 
+        persona.s_mem.tree[i["world"]] = {}
+    if i["sector"]: 
+      if (i["sector"] not in persona.s_mem.tree[i["world"]]): 
+        persona.s_mem.tree[i["world"]][i["sector"]] = {}
+    if i["arena"]: 
+      if (i["arena"] not in persona.s_mem.tree[i["world"]]
+                                              [i["sector"]]): 
+        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
+    if i["game_object"]: 
+      if (i["game_object"] not in persona.s_mem.tree[i["world"]]
+                                                    [i["sector"]]
+                                                    [i["arena"]]): 
+        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
+                                                             i["game_object"]]
+
+
+def perceive(persona, maze): 
+  """
+  Perceives events around the persona and saves it to the memory, both events 
+  and spaces. 
+
+  We first perceive the events nearby the persona, as determined by its 
+  <vision_r>. If there are a lot of events happening within that radius, we 
+  take the <att_bandwidth> of the closest events. Finally, we check whether
+  any of them are new, as determined by <retention>. If they are new, then we
+  save those and return the <ConceptNode> instances for those events. 
+
+  INPUT: 
+    persona: An instance of <Persona> that represents the current persona. 
+    maze: An instance of <Maze> that represents the current maze in which the 
+          persona is acting in. 
+  OUTPUT: 
+    ret_events: a list of <ConceptNode> that are perceived and new. 
+  """
+  # PERCEIVE SPACE
+  # We get the nearby tiles given our current tile and the persona's vision
+  # radius. 
+  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
+                                       persona.scratch.vision_r)
+  perceive_space(persona, maze, nearby_tiles)
+
+  # PERCEIVE EVENTS. 
+  perceived_events = get_perceived_events(persona, maze, nearby_tiles)
+
+  # We embed the descriptions of all the events that might be new in one 
+  # batched request up front, so that the get_embedding calls below are 
+  # served from the embedding store. 
+  new_events = get_new_event_descriptions(persona, perceived_events)
+  to_embed = [description for event_type, description in new_events 
+              if description not in persona.a_mem.embeddings]
+  if to_embed: 
+    get_embeddings(to_embed)
+  # Likewise, we score the poignancy of all of them in one prompt. 
+  if poignancy_batch == "persona": 
+    prefetch_poig_scores([[persona, new_events]])
 
   # Storing events. 
   # <ret_events> is a list of <ConceptNode> instances from the persona's 
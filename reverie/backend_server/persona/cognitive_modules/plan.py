@@ -11,11 +11,24 @@ import sys
 import time
 sys.path.append('../../')
 
+import utils
 from global_methods import *
+from parallel_step import *
 from persona.prompt_template.run_gpt_prompt import *
 from persona.cognitive_modules.retrieve import *
 from persona.cognitive_modules.converse import *
 
+# If <fused_action_resolution> is set in utils.py, _determine_action resolves
+# the address, emoji, event triple and object state of a new action in one
+# LLM call instead of eight (see generate_action_resolution).
+fused_action_resolution = getattr(utils, "fused_action_resolution", False)
+
+# If <whole_day_hourly_schedule> is set in utils.py, generate_hourly_schedule
+# asks for the schedule of the whole day in one LLM call instead of one call
+# per waking hour, and only falls back to the hourly calls if that schedule
+# does not cover every hour or is not diverse enough.
+whole_day_hourly_schedule = getattr(utils, "whole_day_hourly_schedule", False)
+
 ##############################################################################
 # CHAPTER 2: Generate
 ##############################################################################
@@ -95,6 +108,13 @@ def generate_hourly_schedule(persona, wake_up_hour):
               "03:00 PM", "04:00 PM", "05:00 PM", "06:00 PM", "07:00 PM",
               "08:00 PM", "09:00 PM", "10:00 PM", "11:00 PM"]
   n_m1_activity = []
+  if whole_day_hourly_schedule: 
+    # The day schedule has already passed the same coverage and diversity 
+    # checks as below, so the hourly loop only runs if it failed. 
+    n_m1_activity = run_gpt_prompt_generate_hourly_schedule_day(
+                      persona, wake_up_hour, hour_str)[0]
+    if not n_m1_activity: 
+      n_m1_activity = []
   diversity_repeat_count = 3
   for i in range(diversity_repeat_count): 
     n_m1_activity_set = set(n_m1_activity)
@@ -274,12 +294,83 @@ def generate_act_obj_event_triple(act_game_object, act_obj_desc, persona):
   return run_gpt_prompt_act_obj_event_triple(act_game_object, act_obj_desc, persona)[0]
 
 
+def generate_action_resolution(act_desp, persona, maze): 
+  """
+  Resolves everything that _determine_action needs for a new action -- its 
+  sector, arena and game object, its emoji and event triple, and the 
+  description, emoji and event triple of the game object -- in one LLM call.
+  Fields that the fused prompt could not resolve (e.g., an arena that is not
+  in the persona's spatial memory) fall back to their own generate function.
+
+  INPUT: 
+    act_desp: the description of the action (e.g., "sleeping")
+    persona: The Persona class instance 
+    maze: Current <Maze> instance. 
+  OUTPUT: 
+    act_sector, act_arena, act_game_object, act_pron, act_event, 
+    act_obj_desp, act_obj_pron, act_obj_event
+  """
+  if debug: print ("GNS FUNCTION: <generate_action_resolution>")
+  resolved = run_gpt_prompt_action_resolution(act_desp, persona, maze)[0]
+
+  act_world = maze.access_tile(persona.scratch.curr_tile)["world"]
+  act_sector = resolved["act_sector"]
+  act_arena = resolved["act_arena"]
+  act_game_object = resolved["act_game_object"]
+  if not act_sector: 
+    act_sector = generate_action_sector(act_desp, persona, maze)
+  if not act_arena: 
+    act_arena = generate_action_arena(act_desp, persona, maze, act_world, 
+                                      act_sector)
+  act_address = f"{act_world}:{act_sector}:{act_arena}"
+  if not act_game_object: 
+    act_game_object = generate_action_game_object(act_desp, act_address,
+                                                  persona, maze)
+
+  act_pron = resolved["act_pron"]
+  if not act_pron: 
+    act_pron = generate_action_pronunciatio(act_desp, persona)
+  act_event = resolved["act_event"]
+  if not act_event: 
+    act_event = generate_action_event_triple(act_desp, persona)
+
+  # The object fields only come from the fused prompt if its game object was
+  # used; otherwise they describe the wrong object. 
+  act_obj_desp = resolved["act_obj_desp"]
+  act_obj_pron = resolved["act_obj_pron"]
+  act_obj_event = resolved["act_obj_event"]
+  if act_game_object != resolved["act_game_object"]: 
+    act_obj_desp, act_obj_pron, act_obj_event = None, None, None
+  if not act_obj_desp: 
+    act_obj_desp = generate_act_obj_desc(act_game_object, act_desp, persona)
+    act_obj_pron, act_obj_event = None, None
+  if not act_obj_pron: 
+    act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
+  if not act_obj_event: 
+    act_obj_event = generate_act_obj_event_triple(act_game_object, 
+                                                  act_obj_desp, persona)
+
+  return (act_sector, act_arena, act_game_object, act_pron, act_event, 
+          act_obj_desp, act_obj_pron, act_obj_event)
+
+
 def generate_convo(maze, init_persona, target_persona): 
   curr_loc = maze.access_tile(init_persona.scratch.curr_tile)
 
   # convo = run_gpt_prompt_create_conversation(init_persona, target_persona, curr_loc)[0]
   # convo = agent_chat_v1(maze, init_persona, target_persona)
   convo = agent_chat_v2(maze, init_persona, target_persona)
+  convo_length = get_convo_length(convo)
+
+  if debug: print ("GNS FUNCTION: <generate_convo>")
+  return convo, convo_length
+
+
+def get_convo_length(convo): 
+  """
+  Returns the number of minutes that the conversation <convo> (a list of 
+  [speaker, utterance]) takes. 
+  """
   all_utt = ""
 
   for row in convo: 
@@ -287,10 +378,7 @@ def generate_convo(maze, init_persona, target_persona):
     utt = row[1]
     all_utt += f"{speaker}: {utt}\n"
 
-  convo_length = math.ceil(int(len(all_utt)/8) / 30)
-
-  if debug: print ("GNS FUNCTION: <generate_convo>")
-  return convo, convo_length
+  return math.ceil(int(len(all_utt)/8) / 30)
 
 
 def generate_convo_summary(persona, convo): 
@@ -482,7 +570,8 @@ def _long_term_planning(persona, new_day):
     persona.scratch.daily_req = generate_first_daily_plan(persona, 
                                                           wake_up_hour)
   elif new_day == "New day":
-    revise_identity(persona)
+    with llm_priority("reflection"): 
+      revise_identity(persona)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - TODO
     # We need to create a new daily_req here...
@@ -622,20 +711,26 @@ def _determine_action(persona, maze):
   # Finding the target location of the action and creating action-related
   # variables.
   act_world = maze.access_tile(persona.scratch.curr_tile)["world"]
-  # act_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
-  act_sector = generate_action_sector(act_desp, persona, maze)
-  act_arena = generate_action_arena(act_desp, persona, maze, act_world, act_sector)
-  act_address = f"{act_world}:{act_sector}:{act_arena}"
-  act_game_object = generate_action_game_object(act_desp, act_address,
-                                                persona, maze)
-  new_address = f"{act_world}:{act_sector}:{act_arena}:{act_game_object}"
-  act_pron = generate_action_pronunciatio(act_desp, persona)
-  act_event = generate_action_event_triple(act_desp, persona)
-  # Persona's actions also influence the object states. We set those up here. 
-  act_obj_desp = generate_act_obj_desc(act_game_object, act_desp, persona)
-  act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
-  act_obj_event = generate_act_obj_event_triple(act_game_object, 
-                                                act_obj_desp, persona)
+  if fused_action_resolution: 
+    (act_sector, act_arena, act_game_object, act_pron, act_event, 
+     act_obj_desp, act_obj_pron, act_obj_event) = (
+                      generate_action_resolution(act_desp, persona, maze))
+    new_address = f"{act_world}:{act_sector}:{act_arena}:{act_game_object}"
+  else: 
+    # act_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
+    act_sector = generate_action_sector(act_desp, persona, maze)
+    act_arena = generate_action_arena(act_desp, persona, maze, act_world, act_sector)
+    act_address = f"{act_world}:{act_sector}:{act_arena}"
+    act_game_object = generate_action_game_object(act_desp, act_address,
+                                                  persona, maze)
+    new_address = f"{act_world}:{act_sector}:{act_arena}:{act_game_object}"
+    act_pron = generate_action_pronunciatio(act_desp, persona)
+    act_event = generate_action_event_triple(act_desp, persona)
+    # Persona's actions also influence the object states. We set those up here. 
+    act_obj_desp = generate_act_obj_desc(act_game_object, act_desp, persona)
+    act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
+    act_obj_event = generate_act_obj_event_triple(act_game_object, 
+                                                  act_obj_desp, persona)
 
   # Adding the action to persona's queue. 
   persona.scratch.add_new_action(new_address, 
@@ -871,37 +966,66 @@ def _chat_react(maze, persona, focused_event, reaction_mode, personas):
   inserted_act_dur = duration_min
 
   act_start_time = target_persona.scratch.act_start_time
+  chatting_end_time = get_chatting_end_time(target_persona.scratch.curr_time, 
+                                            inserted_act_dur)
 
-  curr_time = target_persona.scratch.curr_time
+  create_chat_react(init_persona, target_persona.name, convo, inserted_act, 
+                    inserted_act_dur, act_start_time, chatting_end_time)
+  create_chat_react(target_persona, init_persona.name, convo, inserted_act, 
+                    inserted_act_dur, act_start_time, chatting_end_time)
+
+
+def get_chatting_end_time(curr_time, inserted_act_dur): 
+  """
+  Returns the datetime at which a conversation of <inserted_act_dur> 
+  minutes that starts at <curr_time> ends (counting from the next full 
+  minute). 
+  """
   if curr_time.second != 0: 
     temp_curr_time = curr_time + datetime.timedelta(seconds=60 - curr_time.second)
-    chatting_end_time = temp_curr_time + datetime.timedelta(minutes=inserted_act_dur)
-  else: 
-    chatting_end_time = curr_time + datetime.timedelta(minutes=inserted_act_dur)
-
-  for role, p in [("init", init_persona), ("target", target_persona)]: 
-    if role == "init": 
-      act_address = f"<persona> {target_persona.name}"
-      act_event = (p.name, "chat with", target_persona.name)
-      chatting_with = target_persona.name
-      chatting_with_buffer = {}
-      chatting_with_buffer[target_persona.name] = 800
-    elif role == "target": 
-      act_address = f"<persona> {init_persona.name}"
-      act_event = (p.name, "chat with", init_persona.name)
-      chatting_with = init_persona.name
-      chatting_with_buffer = {}
-      chatting_with_buffer[init_persona.name] = 800
-
-    act_pronunciatio = "💬" 
-    act_obj_description = None
-    act_obj_pronunciatio = None
-    act_obj_event = (None, None, None)
-
-    _create_react(p, inserted_act, inserted_act_dur,
-      act_address, act_event, chatting_with, convo, chatting_with_buffer, chatting_end_time,
-      act_pronunciatio, act_obj_description, act_obj_pronunciatio, 
-      act_obj_event, act_start_time)
+    return temp_curr_time + datetime.timedelta(minutes=inserted_act_dur)
+  return curr_time + datetime.timedelta(minutes=inserted_act_dur)
+
+
+def create_chat_react(p, other_name, convo, inserted_act, inserted_act_dur,
+                      act_start_time, chatting_end_time): 
+  """
+  Inserts the conversation <convo> with the persona <other_name> into the 
+  schedule of the persona <p>. This is the same for both sides of the 
+  conversation. 
+  """
+  act_address = f"<persona> {other_name}"
+  act_event = (p.name, "chat with", other_name)
+  chatting_with = other_name
+  chatting_with_buffer = {}
+  chatting_with_buffer[other_name] = 800
+
+  act_pronunciatio = "💬" 
+  act_obj_description = None
+  act_obj_pronunciatio = None
+  act_obj_event = (None, None, None)
+
+  _create_react(p, inserted_act, inserted_act_dur,
+    act_address, act_event, chatting_with, convo, chatting_with_buffer, chatting_end_time,
+    act_pronunciatio, act_obj_description, act_obj_pronunciatio, 
+    act_obj_event, act_start_time)
+
+
+def _deferred_chat_react(maze, personas, persona_name, reaction_mode): 
+  """
+  Starts the conversation that the persona <persona_name> decided on during
+  a parallel step, at the barrier after the step (see parallel_step.py). If
+  either persona has started another conversation at the barrier in the 
+  meantime, we drop this one. 
+  """
+  persona = personas[persona_name]
+  target_persona = personas[reaction_mode[9:].strip()]
+  if persona.scratch.chatting_with or target_persona.scratch.chatting_with: 
+    return
+  _chat_react(maze, persona, None, reaction_mode, personas)
+
+
+register_barrier_action("chat", _deferred_chat_react)
 
 
 def _wait_react(persona, reaction_mode): 
@@ -982,13 +1106,36 @@ def plan(persona, maze, personas, new_day, retrieved):
     if reaction_mode: 
       # If we do want to chat, then we generate conversation 
       if reaction_mode[:9] == "chat with":
-        _chat_react(maze, persona, focused_event, reaction_mode, personas)
+        step_barrier = get_step_barrier()
+        if step_barrier: 
+          # In a parallel step, the other personas are snapshots, and the 
+          # conversation changes the target persona as well. So we hold it
+          # until the barrier, where it runs with the real personas. 
+          step_barrier.defer(persona.name, "chat", reaction_mode)
+        else: 
+          _chat_react(maze, persona, focused_event, reaction_mode, personas)
       elif reaction_mode[:4] == "wait": 
         _wait_react(persona, reaction_mode)
       # elif reaction_mode == "do other things": 
       #   _chat_react(persona, focused_event, reaction_mode, personas)
 
   # Step 3: Chat-related state clean up. 
+  update_chat_state(persona)
+
+  return persona.scratch.act_address
+
+
+def update_chat_state(persona, n_steps=1): 
+  """
+  The chat-related bookkeeping that every step of a persona ends with, 
+  whether or not it thinks in the step (see fast_forward.py). 
+
+  INPUT: 
+    persona: Current <Persona> instance whose chat state we are updating. 
+    n_steps: The number of steps to account for. 
+  OUTPUT: 
+    None
+  """
   # If the persona is not chatting with anyone, we clean up any of the 
   # chat-related states here. 
   if persona.scratch.act_event[1] != "chat with":
@@ -1002,9 +1149,7 @@ def plan(persona, maze, personas, new_day, retrieved):
   curr_persona_chat_buffer = persona.scratch.chatting_with_buffer
   for persona_name, buffer_count in curr_persona_chat_buffer.items():
     if persona_name != persona.scratch.chatting_with: 
-      persona.scratch.chatting_with_buffer[persona_name] -= 1
-
-  return persona.scratch.act_address
+      persona.scratch.chatting_with_buffer[persona_name] -= n_steps
 
 
 
@@ -215,6 +215,11 @@ def new_retrieve(persona, focal_points, n_count=30):
     persona = <persona> object 
     focal_points = ["How are you?", "Jane is swimming in the pond"]
   """
+  # We embed all focal points in one batched request up front; the 
+  # get_embedding call in extract_relevance is then served from the 
+  # embedding store. 
+  get_embeddings(focal_points)
+
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict() 
   for focal_pt in focal_points: 
@@ -543,21 +543,33 @@ class Scratch:
     """
     if not self.act_address: 
       return True
-      
-    if self.chatting_with: 
-      end_time = self.chatting_end_time
-    else: 
-      x = self.act_start_time
-      if x.second != 0: 
-        x = x.replace(second=0)
-        x = (x + datetime.timedelta(minutes=1))
-      end_time = (x + datetime.timedelta(minutes=self.act_duration))
 
+    end_time = self.get_act_end_time()
     if end_time.strftime("%H:%M:%S") == self.curr_time.strftime("%H:%M:%S"): 
       return True
     return False
 
 
+  def get_act_end_time(self): 
+    """
+    Returns the time the current action ends at: the end of the conversation
+    if the persona is chatting, and otherwise its duration after the first
+    full minute of its start. 
+
+    INPUT
+      None
+    OUTPUT 
+      datetime instance of the end of the current action. 
+    """
+    if self.chatting_with: 
+      return self.chatting_end_time
+    x = self.act_start_time
+    if x.second != 0: 
+      x = x.replace(second=0)
+      x = (x + datetime.timedelta(minutes=1))
+    return (x + datetime.timedelta(minutes=self.act_duration))
+
+
   def act_summarize(self):
     """
     Summarize the current action as a dictionary. 
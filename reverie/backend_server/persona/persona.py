@@ -179,7 +179,9 @@ class Persona:
     OUTPUT: 
       None
     """
-    reflect(self)
+    # Reflections can wait behind the conversations and plans of others.
+    with llm_priority("reflection"): 
+      reflect(self)
 
 
   def move(self, maze, personas, curr_tile, curr_time):
@@ -232,7 +234,8 @@ class Persona:
 
 
   def open_convo_session(self, convo_mode): 
-    open_convo_session(self, convo_mode)
+    with llm_priority("analysis"): 
+      open_convo_session(self, convo_mode)
     
 
 
@@ -0,0 +1,247 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: embedding_store.py
+Description: A process-wide store for text embeddings. Each persona keeps its
+own embeddings dictionary in its associative memory, so the same text (e.g.,
+a persona's name used as a focal point) used to be embedded over and over
+again. This store sits behind get_embedding and is shared by all personas:
+it keeps the most recently used vectors in memory and persists every vector
+to disk so that other runs and forks of the simulation can reuse them.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def normalize_embedding_text(text):
+  """
+  Normalizes the text that we send to the embedding endpoint. Two texts that
+  normalize to the same str share one embedding.
+
+  INPUT:
+    text: a str text
+  OUTPUT:
+    the normalized str text
+  """
+  text = text.replace("\n", " ").strip()
+  if not text:
+    text = "this is blank"
+  return text
+
+
+class EmbeddingStore:
+  def __init__(self, db_path=None, max_memory_items=20000):
+    # <db_path> is the SQLite file that the vectors are persisted to. If it
+    # is None, the store only lives in memory for the current process.
+    self.db_path = db_path
+    # <memory> is the in-memory LRU that maps a key to its embedding. The
+    # most recently used key is at the end.
+    self.memory = OrderedDict()
+    self.max_memory_items = max_memory_items
+
+    self.conn = None
+    self.lock = threading.Lock()
+
+    # Counters for the current process.
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+
+  def _connect(self):
+    if self.conn:
+      return self.conn
+
+    db_folder = os.path.dirname(self.db_path)
+    if db_folder and not os.path.exists(db_folder):
+      os.makedirs(db_folder)
+
+    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    self.conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                           key TEXT PRIMARY KEY,
+                           model TEXT,
+                           text TEXT,
+                           embedding TEXT,
+                           created REAL)""")
+    self.conn.commit()
+    return self.conn
+
+
+  def make_key(self, model, text):
+    raw = json.dumps([model, normalize_embedding_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+  def _remember(self, key, embedding):
+    self.memory[key] = embedding
+    self.memory.move_to_end(key)
+    while len(self.memory) > self.max_memory_items:
+      self.memory.popitem(last=False)
+
+
+  def get(self, model, text):
+    """
+    Returns the stored embedding of <text> under <model>, or None if we have
+    never embedded it.
+    """
+    key = self.make_key(model, text)
+    with self.lock:
+      if key in self.memory:
+        self.memory.move_to_end(key)
+        self.memory_hits += 1
+        return self.memory[key]
+
+      if self.db_path:
+        row = self._connect().execute(
+                "SELECT embedding FROM embeddings WHERE key = ?",
+                (key,)).fetchone()
+        if row:
+          embedding = json.loads(row[0])
+          self._remember(key, embedding)
+          self.disk_hits += 1
+          return embedding
+
+      self.misses += 1
+    return None
+
+
+  def put(self, model, text, embedding):
+    """
+    Stores <embedding> as the embedding of <text> under <model>.
+    """
+    key = self.make_key(model, text)
+    with self.lock:
+      self._remember(key, embedding)
+      if self.db_path:
+        conn = self._connect()
+        conn.execute("""INSERT OR REPLACE INTO embeddings
+                        (key, model, text, embedding, created)
+                        VALUES (?, ?, ?, ?, ?)""",
+                     (key, model, normalize_embedding_text(text),
+                      json.dumps(embedding), time.time()))
+        conn.commit()
+
+
+  def get_str_stats(self):
+    return (f"Embedding store {self.db_path}\n"
+            f"memory hits: {self.memory_hits}, disk hits: {self.disk_hits}, "
+            f"misses: {self.misses}, "
+            f"in memory: {len(self.memory)}/{self.max_memory_items}")
+
+
+class EmbeddingBatcher:
+  def __init__(self, request_func, max_batch_size=256, max_wait=0.02):
+    # <request_func> takes a list of str texts and a model name, and returns
+    # the list of their embeddings in the same order (i.e., one request to
+    # the embedding endpoint).
+    self.request_func = request_func
+    # We flush the pending texts once there are <max_batch_size> of them, or
+    # once the oldest one has been waiting for <max_wait> seconds. The texts
+    # of a lone caller do not wait at all: we send one batch at a time, so
+    # no other request is in flight then, and waiting for company would 
+    # only add to the latency of every miss outside a busy moment. 
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+
+    # <pending> is a list of [model, text, future, caller] that are yet to 
+    # be sent, where <caller> tells apart the callers that queued them.
+    self.pending = []
+    self.first_pending_time = None
+    self.cond = threading.Condition()
+    self.worker = None
+
+    # Counters for the current process.
+    self.batches_sent = 0
+    self.texts_sent = 0
+
+
+  def submit(self, model, texts):
+    """
+    Queues <texts> to be embedded and returns a list of Futures that resolve
+    to their embeddings.
+    """
+    futures = [Future() for text in texts]
+    caller = object()
+    with self.cond:
+      if not self.worker:
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+      if not self.pending:
+        self.first_pending_time = time.time()
+      self.pending += [[model, text, future, caller]
+                       for text, future in zip(texts, futures)]
+      self.cond.notify()
+    return futures
+
+
+  def embed(self, model, texts):
+    """
+    Embeds all of <texts> (along with whatever the other callers have queued
+    up in the meantime) and returns their embeddings in the same order.
+    """
+    futures = self.submit(model, texts)
+    return [future.result() for future in futures]
+
+
+  def _run(self):
+    while True:
+      with self.cond:
+        while not self.pending:
+          self.cond.wait()
+        while (len(self.pending) < self.max_batch_size
+               and len(set([i[3] for i in self.pending])) > 1):
+          wait_left = self.first_pending_time + self.max_wait - time.time()
+          if wait_left <= 0:
+            break
+          self.cond.wait(wait_left)
+        batch = self.pending[:self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size:]
+        if self.pending:
+          self.first_pending_time = time.time()
+      try:
+        self._send(batch)
+      except Exception as e:
+        # Whatever goes wrong, no caller may be left waiting on a future
+        # that nobody resolves.
+        for model, text, future, caller in batch:
+          if not future.done():
+            future.set_exception(e)
+
+
+  def _send(self, batch):
+    # A batch may mix models, and the same text may have been queued by more
+    # than one caller. We send each unique text once per model.
+    model_to_texts = dict()
+    for model, text, future, caller in batch:
+      if model not in model_to_texts:
+        model_to_texts[model] = []
+      if text not in model_to_texts[model]:
+        model_to_texts[model] += [text]
+
+    for model, texts in model_to_texts.items():
+      futures = [i for i in batch if i[0] == model]
+      try:
+        self.batches_sent += 1
+        self.texts_sent += len(texts)
+        embeddings = self.request_func(texts, model)
+        if len(embeddings) != len(texts):
+          raise ValueError(f"Got {len(embeddings)} embeddings for "
+                           f"{len(texts)} texts")
+        text_to_embedding = dict(zip(texts, embeddings))
+        for curr_model, text, future, caller in futures:
+          future.set_result(text_to_embedding[text])
+      except Exception as e:
+        for curr_model, text, future, caller in futures:
+          if not future.done():
+            future.set_exception(e)
+
+
+  def get_str_stats(self):
+    return (f"embedding batches sent: {self.batches_sent}, "
+            f"texts sent: {self.texts_sent}")
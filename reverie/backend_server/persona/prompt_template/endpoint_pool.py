@@ -0,0 +1,308 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: endpoint_pool.py
+Description: A pool of OpenAI compatible endpoints (e.g., several API keys,
+regions, or a local inference server) that the LLM client spreads its
+requests over. Every request goes to the healthy endpoint that serves its
+model and has the fewest requests outstanding. An endpoint that fails
+(connection errors, server errors, timeouts) is taken out of the rotation
+and the request fails over to the next one; once its cooldown is over, the
+endpoint has to pass a health check before it gets requests again. All
+endpoints share one keep-alive HTTP session, so we do not open a new
+connection for every request.
+"""
+import asyncio
+import time
+
+import aiohttp
+import openai
+
+from persona.prompt_template.llm_backend import *
+
+# The errors after which a request fails over to another endpoint and the
+# endpoint is taken out of the rotation.
+FAILOVER_ERRORS = (openai.error.APIConnectionError,
+                   openai.error.ServiceUnavailableError,
+                   openai.error.Timeout,
+                   openai.error.APIError)
+
+
+class LLMEndpoint:
+  def __init__(self, api_base, api_key, name=None, organization=None,
+               models=None):
+    self.api_base = api_base.rstrip("/")
+    self.api_key = api_key
+    self.name = name if name else self.api_base
+    self.organization = organization
+    # <models> is the list of models this endpoint serves, or None if it
+    # serves all of them.
+    self.models = models
+
+    # The number of requests that are currently in flight to the endpoint.
+    self.outstanding = 0
+    # An unhealthy endpoint gets no requests until <retry_at>, and then only
+    # after it passes a health check. Every consecutive failure doubles the
+    # cooldown.
+    self.healthy = True
+    self.consecutive_failures = 0
+    self.retry_at = 0
+    # Whether a health check of the endpoint is in flight.
+    self.checking = False
+
+    # Counters for the current process.
+    self.requests = 0
+    self.failures = 0
+
+
+  def serves(self, model):
+    return self.models is None or model in self.models
+
+
+  def get_request_args(self):
+    args = {"api_key": self.api_key, "api_base": self.api_base}
+    if self.organization:
+      args["organization"] = self.organization
+    return args
+
+
+  def on_success(self):
+    self.healthy = True
+    self.consecutive_failures = 0
+
+
+  def on_failure(self, base_cooldown, max_cooldown):
+    self.failures += 1
+    if not self.healthy and time.time() < self.retry_at:
+      # This request was sent before the endpoint went down, so it does not
+      # tell us anything new.
+      return
+    self.consecutive_failures += 1
+    self.healthy = False
+    cooldown = base_cooldown * 2 ** (self.consecutive_failures - 1)
+    self.retry_at = time.time() + min(cooldown, max_cooldown)
+
+
+class EndpointPoolBackend(OpenAIBackend):
+  # The pool talks to OpenAI's API, so its responses are cached and stored
+  # together with the ones of the plain OpenAI backend.
+  name = "openai"
+  rate_limited = True
+
+  def __init__(self, endpoints, connection_limit=64, base_cooldown=5,
+               max_cooldown=300):
+    """
+    INPUT:
+      endpoints: a list of dictionaries with the "api_base" and "api_key"
+                 of every endpoint, and optionally its "name",
+                 "organization" and the list of "models" it serves.
+      connection_limit: the max number of open connections of the shared
+                        keep-alive session.
+      base_cooldown: the seconds a failed endpoint is out of the rotation
+                     after its first failure (doubled for every
+                     consecutive failure, up to <max_cooldown>).
+    """
+    if not endpoints:
+      raise ValueError("The endpoint pool needs at least one endpoint")
+    self.endpoints = [LLMEndpoint(**endpoint) for endpoint in endpoints]
+    self.connection_limit = connection_limit
+    self.base_cooldown = base_cooldown
+    self.max_cooldown = max_cooldown
+    # The shared session is created lazily on the LLM client's event loop.
+    self.session = None
+    # Breaks the ties between equally loaded endpoints in turn.
+    self.turn = 0
+
+
+  async def _get_session(self):
+    if not self.session or self.session.closed:
+      self.session = aiohttp.ClientSession(
+                       connector=aiohttp.TCPConnector(
+                                   limit=self.connection_limit,
+                                   keepalive_timeout=60))
+    return self.session
+
+
+  async def _check_health(self, endpoint):
+    """
+    Returns whether <endpoint> answers its model list. This is the check an
+    endpoint has to pass to get back into the rotation after a failure.
+    """
+    session = await self._get_session()
+    headers = {"Authorization": f"Bearer {endpoint.api_key}"}
+    try:
+      async with session.get(f"{endpoint.api_base}/models", headers=headers,
+                             timeout=aiohttp.ClientTimeout(total=10)) as r:
+        return r.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+      return False
+
+
+  async def _recheck(self, endpoint):
+    """
+    Health checks an endpoint that is out of the rotation, and puts it back
+    in if it passes. Returns whether it passed.
+    """
+    endpoint.checking = True
+    try:
+      passed = await self._check_health(endpoint)
+    finally:
+      endpoint.checking = False
+    if passed:
+      endpoint.on_success()
+    else:
+      endpoint.on_failure(self.base_cooldown, self.max_cooldown)
+    return passed
+
+
+  async def _pick(self, model, tried):
+    """
+    Returns the endpoint for the next attempt of a request to <model>, or
+    None if every endpoint that serves <model> has been tried.
+    """
+    candidates = [i for i in self.endpoints
+                  if i.serves(model) and i not in tried]
+    if not candidates:
+      return None
+
+    # The endpoints whose cooldown is over get back in once they pass the
+    # health check. While other endpoints are healthy, we check them in the
+    # background rather than holding up the request.
+    now = time.time()
+    due = [i for i in candidates
+           if not i.healthy and not i.checking and i.retry_at <= now]
+    healthy = [i for i in candidates if i.healthy]
+    if healthy:
+      for endpoint in due:
+        asyncio.ensure_future(self._recheck(endpoint))
+      self.turn += 1
+      healthy = (healthy[self.turn % len(healthy):]
+                 + healthy[:self.turn % len(healthy)])
+      return min(healthy, key=lambda x: x.outstanding)
+    for endpoint in due:
+      if await self._recheck(endpoint):
+        return endpoint
+
+    # As a last resort (every endpoint is cooling down), we try the one that
+    # is going to be back the soonest rather than failing the request.
+    return min(candidates, key=lambda x: x.retry_at)
+
+
+  async def _call(self, model, request_func):
+    """
+    Sends a request to <model> to the least loaded healthy endpoint, and
+    fails over to the next endpoint if it fails.
+    INPUT:
+      model: the model name
+      request_func: a function that takes the request arguments of an
+                    endpoint (its api_key, api_base, ...) and returns the
+                    request coroutine.
+    OUTPUT:
+      the response of the first endpoint that succeeds.
+    """
+    tried = []
+    last_error = None
+    while True:
+      endpoint = await self._pick(model, tried)
+      if not endpoint:
+        if last_error:
+          raise last_error
+        raise openai.error.APIConnectionError(
+                f"No LLM endpoint serves the model {model}")
+      tried += [endpoint]
+
+      endpoint.outstanding += 1
+      endpoint.requests += 1
+      token = openai.aiosession.set(await self._get_session())
+      try:
+        response = await request_func(endpoint.get_request_args())
+      except openai.error.RateLimitError as e:
+        # The endpoint is fine, just busy; if no other endpoint can take the
+        # request, the client backs off and retries it.
+        last_error = e
+        continue
+      except FAILOVER_ERRORS as e:
+        endpoint.on_failure(self.base_cooldown, self.max_cooldown)
+        print (f"LLM endpoint {endpoint.name} failed "
+               f"({type(e).__name__}); failing over")
+        last_error = e
+        continue
+      finally:
+        openai.aiosession.reset(token)
+        endpoint.outstanding -= 1
+
+      endpoint.on_success()
+      return response
+
+
+  async def chat_completion(self, model, prompt):
+    return await self._call(
+             model,
+             lambda args: OpenAIBackend.chat_completion(self, model, prompt,
+                                                        **args))
+
+
+  async def completion(self, prompt, gpt_parameter):
+    return await self._call(
+             gpt_parameter["engine"],
+             lambda args: OpenAIBackend.completion(self, prompt,
+                                                   gpt_parameter, **args))
+
+
+  async def embedding(self, texts, model):
+    return await self._call(
+             model,
+             lambda args: OpenAIBackend.embedding(self, texts, model, **args))
+
+
+  async def _open_stream(self, chunks):
+    """
+    Waits for the first chunk of the stream <chunks>, so that a stream that
+    fails to start fails over like any other request. Returns [<first
+    chunk>, <chunks>].
+    """
+    try:
+      return [await chunks.__anext__(), chunks]
+    except StopAsyncIteration:
+      return ["", chunks]
+
+
+  async def _stream(self, model, open_func):
+    # We can only fail over until the first chunk has arrived.
+    first_chunk, chunks = await self._call(
+                            model, lambda args: self._open_stream(open_func(args)))
+    yield first_chunk
+    async for chunk in chunks:
+      yield chunk
+
+
+  async def chat_completion_stream(self, model, prompt):
+    async for chunk in self._stream(
+                         model,
+                         lambda args: OpenAIBackend.chat_completion_stream(
+                                        self, model, prompt, **args)):
+      yield chunk
+
+
+  async def completion_stream(self, prompt, gpt_parameter):
+    async for chunk in self._stream(
+                         gpt_parameter["engine"],
+                         lambda args: OpenAIBackend.completion_stream(
+                                        self, prompt, gpt_parameter, **args)):
+      yield chunk
+
+
+  def get_str_stats(self):
+    ret_str = ""
+    for endpoint in self.endpoints:
+      if endpoint.healthy:
+        status = "healthy"
+      elif endpoint.retry_at > time.time():
+        status = f"down for {endpoint.retry_at - time.time():.0f}s"
+      else:
+        status = "down, due for a health check"
+      ret_str += (f"{endpoint.name} ({endpoint.api_base}): {status}, "
+                  f"outstanding: {endpoint.outstanding}, "
+                  f"requests: {endpoint.requests}, "
+                  f"failures: {endpoint.failures}\n")
+    return ret_str.strip()
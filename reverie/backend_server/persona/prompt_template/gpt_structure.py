@@ -2,82 +2,641 @@
 Author: Joon Sung Park (joonspk@stanford.edu)
 
 File: gpt_structure.py
-Description: Wrapper functions for calling OpenAI APIs.
+Description: Wrapper functions for calling OpenAI APIs. All requests go
+through <llm_client>, which hands them to the configured LLM backend (see
+llm_backend.py). 
 """
+import asyncio
+import contextlib
 import json
+import os
 import random
+import re
 import openai
 import time 
 
+import utils
 from utils import *
+from tape import *
+from persona.prompt_template.llm_cache import *
+from persona.prompt_template.embedding_store import *
+from persona.prompt_template.llm_client import *
+from persona.prompt_template.llm_scheduler import *
+from persona.prompt_template.prompt_stats import *
+from persona.prompt_template.prompt_memo import *
+from persona.prompt_template.model_router import *
+from persona.prompt_template.endpoint_pool import *
 
 openai.api_key = openai_api_key
+# <openai_api_base> in utils.py points the OpenAI backend at a different 
+# server that speaks OpenAI's API (e.g., stub_llm_server.py). 
+if hasattr(utils, "openai_api_base"): 
+  openai.api_base = utils.openai_api_base
+
+# <llm_client> sends all requests to the LLM backend from a background event
+# loop. Optional settings in utils.py: 
+#   llm_backend: "openai" (default) or "stub" for the offline, deterministic
+#                backend in llm_backend.py
+#   llm_max_concurrency: the max number of requests in flight at once
+#   llm_request_timeout: seconds after which a request is cancelled
+#   llm_rate_limits: {<model>: {"rpm": <int>, "tpm": <int>}} budgets that 
+#                    override the defaults in rate_limiter.py
+#   llm_rate_limit_retries: the number of times we retry a rate limited 
+#                           request (with backoff) before giving up
+#   llm_endpoints: [{"api_base": <url>, "api_key": <key>, "name": <str>, 
+#                   "models": [<model>, ...]}, ...] OpenAI compatible 
+#                  endpoints that the "openai" backend balances its requests
+#                  over, with failover (see endpoint_pool.py); "name" and 
+#                  "models" are optional. None (the default) uses 
+#                  openai_api_key and openai.api_base. 
+#   llm_connection_limit: the max number of open keep-alive connections
+#   llm_priorities: {<prompt function name>: <priority class>} overrides of
+#                   the priority classes in llm_scheduler.py
+#   llm_priority_aging: the seconds of waiting that make a request as urgent
+#                       as one of the next more urgent priority class
+def get_configured_llm_backend(): 
+  backend_name = getattr(utils, "llm_backend", "openai")
+  if backend_name != "openai": 
+    return get_llm_backend(backend_name)
+  endpoints = getattr(utils, "llm_endpoints", None)
+  if not endpoints: 
+    endpoints = [{"name": "default", 
+                  "api_base": openai.api_base, 
+                  "api_key": openai.api_key}]
+  return EndpointPoolBackend(endpoints, 
+                             getattr(utils, "llm_connection_limit", 64))
+
+
+llm_client = AsyncLLMClient(
+               getattr(utils, "llm_max_concurrency", 8),
+               getattr(utils, "llm_request_timeout", 120),
+               RateLimiter(getattr(utils, "llm_rate_limits", None),
+                           getattr(utils, "llm_rate_limit_retries", 6)),
+               get_configured_llm_backend(),
+               PriorityScheduler(getattr(utils, "llm_max_concurrency", 8),
+                                 getattr(utils, "llm_priorities", None),
+                                 getattr(utils, "llm_priority_aging", 10)))
+
+
+# <prompt_stats> accounts the requests, tokens, retries and wall time to the
+# run_gpt_prompt_* function (and persona) that made them. Optional setting in
+# utils.py: 
+#   llm_prices: {<model>: [<prompt>, <completion>]} USD per 1K tokens that 
+#               override the defaults in prompt_stats.py
+prompt_stats = PromptStats(getattr(utils, "llm_prices", None))
+llm_client.usage_callback = prompt_stats.record_usage
+
+
+# <model_router> sends the prompt functions listed in a routing table to 
+# model tiers instead of their pinned models, and moves the retries of a 
+# response that failed validation up to stronger tiers. Optional setting in 
+# utils.py: 
+#   llm_routing_path: the json routing table (e.g., 
+#                     persona/prompt_template/model_routing.json); None (the
+#                     default) keeps every prompt on its pinned model
+model_router = ModelRouter(getattr(utils, "llm_routing_path", None))
+
+
+def get_routed_model(kind, default_model, attempt=0): 
+  """
+  Returns the model for the <attempt>-th attempt (0 for the first one) of a
+  request of <kind> ("chat" or "completion") that is pinned to 
+  <default_model>, as routed for the prompt function that is running. 
+  """
+  key = current_prompt.get()
+  function = key[0] if key else None
+  return model_router.get_model(function, kind, default_model, attempt)
+
+
+def get_routed_parameter(gpt_parameter, attempt=0): 
+  """
+  The completion version of get_routed_model. Returns <gpt_parameter> with
+  its engine replaced by the routed model (or <gpt_parameter> itself if the
+  request is not routed elsewhere). 
+  """
+  engine = get_routed_model("completion", gpt_parameter["engine"], attempt)
+  if engine == gpt_parameter["engine"]: 
+    return gpt_parameter
+  routed_parameter = dict(gpt_parameter)
+  routed_parameter["engine"] = engine
+  return routed_parameter
+
+
+def get_store_model_name(model): 
+  """
+  Returns the model name that we use to key the response cache and the 
+  embedding store. Responses from backends other than OpenAI's are kept apart
+  so that, e.g., stub responses never end up in a real simulation. 
+  """
+  if llm_client.backend.name == "openai": 
+    return model
+  return f"{llm_client.backend.name}/{model}"
+
+# <llm_cache> is the on-disk response cache shared by all request functions
+# below. The following optional settings can be set in utils.py: 
+#   llm_cache_mode: "read-write", "read-only", or "bypass" (default)
+#   llm_cache_path: the SQLite file that backs the cache
+#   llm_cache_max_mb: the size budget of the cache before eviction kicks in
+llm_cache = LLMCache(getattr(utils, "llm_cache_path", 
+                             f"{fs_temp_storage}/llm_cache.db"),
+                     getattr(utils, "llm_cache_mode", "bypass"),
+                     getattr(utils, "llm_cache_max_mb", 512))
+
+# <embedding_store> is the process-wide embedding store that get_embedding
+# checks before going to the server. Optional settings in utils.py: 
+#   embedding_store_path: the SQLite file the vectors are persisted to (None
+#                         keeps the store in memory only)
+#   embedding_store_max_items: the number of vectors kept in memory
+embedding_store = EmbeddingStore(
+                    getattr(utils, "embedding_store_path", 
+                            f"{fs_temp_storage}/embedding_store.db"),
+                    getattr(utils, "embedding_store_max_items", 20000))
+
+# <prompt_memo> memoizes the outputs of the prompt functions that declare a
+# key (see the @prompt_memo.memoize functions in run_gpt_prompt.py) across 
+# all personas. Optional settings in utils.py: 
+#   prompt_memo_enabled: True to turn the memo on (off by default)
+#   prompt_memo_path: the SQLite file the outputs are persisted to (None 
+#                     keeps the memo in memory only)
+#   prompt_memo_max_items: the number of outputs kept in memory
+#   prompt_memo_max_disk_items: the number of outputs kept on disk
+prompt_memo = PromptMemo(getattr(utils, "prompt_memo_enabled", False),
+                         getattr(utils, "prompt_memo_path", 
+                                 f"{fs_temp_storage}/prompt_memo.db"),
+                         getattr(utils, "prompt_memo_max_items", 5000),
+                         llm_client.backend.name,
+                         getattr(utils, "prompt_memo_max_disk_items", 100000))
+prompt_memo.is_disk_enabled = lambda: not get_active_tape()
+
+def _embedding_request(texts, model): 
+  return llm_client.run(llm_client.embedding(texts, model))
+
+# <embedding_batcher> coalesces the embedding requests that come in around
+# the same time into one request. Optional settings in utils.py: 
+#   embedding_batch_size: the max number of texts we send in one request
+#   embedding_batch_wait: the max seconds a text waits for others to join
+embedding_batcher = EmbeddingBatcher(
+                      _embedding_request,
+                      getattr(utils, "embedding_batch_size", 256),
+                      getattr(utils, "embedding_batch_wait", 0.02))
+
+
+class SingleFlight: 
+  """
+  Makes concurrent callers of the same request share one request. The first
+  caller of a key (the leader) starts the request as a task on the LLM 
+  client's event loop, and everyone who asks for that key while it is still
+  in flight awaits the same task instead of sending a duplicate (e.g., when 
+  several personas ask for the state of the same object in the same step). 
+  All of this runs on the event loop's thread, so no lock is needed. 
+  """
+  def __init__(self): 
+    # <inflight> maps a request key to [<task>, <number of waiters>]. 
+    self.inflight = dict()
+
+    # Counters for the current process. 
+    self.leaders = 0
+    self.saved = 0
+
+
+  async def run(self, key, coro_func): 
+    """
+    Returns the result of <coro_func>() for <key>, sharing the request with
+    the concurrent callers of the same key. 
+    """
+    entry = self.inflight.get(key)
+    if entry: 
+      self.saved += 1
+    else: 
+      # The task runs in a copy of the leader's context, so the request is 
+      # accounted to the leader's prompt function. 
+      entry = [asyncio.ensure_future(coro_func()), 0]
+      self.inflight[key] = entry
+      self.leaders += 1
+      entry[0].add_done_callback(lambda task: self._forget(key, task))
+
+    task = entry[0]
+    entry[1] += 1
+    try: 
+      # One waiter being cancelled (e.g., a candidate response that is no 
+      # longer needed) must not cancel the request for the others. 
+      return await asyncio.shield(task)
+    finally: 
+      entry[1] -= 1
+      if entry[1] == 0 and not task.done(): 
+        # Nobody is waiting anymore, so the request is not needed either. 
+        task.cancel()
+
+
+  def _forget(self, key, task): 
+    entry = self.inflight.get(key)
+    if entry and entry[0] is task: 
+      del self.inflight[key]
+
+
+  def get_str_stats(self): 
+    return (f"Single flight: requests sent: {self.leaders}, "
+            f"duplicate requests saved: {self.saved}, "
+            f"in flight: {len(self.inflight)}")
+
+
+# <single_flight> deduplicates the identical LLM requests that are in flight
+# at the same time (see cached_request_async). 
+single_flight = SingleFlight()
+
+
+async def _request_and_cache(key, model, coro_func): 
+  response = await coro_func()
+  llm_cache.put(key, response, model)
+  return response
+
+
+async def cached_request_async(model, prompt, gpt_parameter, coro_func): 
+  """
+  Looks up the response for (model, prompt, gpt_parameter) in <llm_cache>, 
+  and only awaits <coro_func>() (which does the actual request to OpenAI's
+  server) on a miss. Concurrent misses on the same request share one 
+  request through <single_flight>. Note that exceptions raised by the 
+  request are passed on to the caller and nothing gets cached in that case. 
+  ARGS:
+    model: the model name (e.g., "gpt-3.5-turbo")
+    prompt: a str prompt
+    gpt_parameter: the gpt_parameter dictionary of the request, or None.
+    coro_func: a function with no arguments that returns the request 
+               coroutine (e.g., a call to one of llm_client's methods).
+  RETURNS: 
+    a str of GPT's response. 
+  """
+  # When we replay a tape, the response comes from the tape and we never 
+  # touch the cache or the network. 
+  tape = get_active_tape()
+  if tape and tape.mode == "replay": 
+    return tape.replay_llm(llm_cache.make_key(model, prompt, gpt_parameter))
+
+  key = llm_cache.make_key(get_store_model_name(model), prompt, gpt_parameter)
+  response = llm_cache.get(key)
+  if response is None: 
+    response = await single_flight.run(
+                 key, lambda: _request_and_cache(key, model, coro_func))
+
+  if tape: 
+    tape.record_llm(llm_cache.make_key(model, prompt, gpt_parameter), response)
+  return response
+
+
+def cached_request(model, prompt, gpt_parameter, coro_func): 
+  """
+  The synchronous version of cached_request_async. It blocks until the 
+  response is ready. 
+  """
+  return llm_client.run(cached_request_async(model, prompt, gpt_parameter, 
+                                             coro_func))
+
+
+def discard_cached_response(model, prompt, gpt_parameter=None): 
+  """
+  Drops the cached response for (model, prompt, gpt_parameter). The retry 
+  loops below call this when a response fails validation so that the retry
+  does not get the very same response back from the cache. 
+  """
+  llm_cache.discard(llm_cache.make_key(get_store_model_name(model), 
+                                       prompt, gpt_parameter))
+
+
+async def chat_request_async(model, prompt, candidate=0): 
+  """
+  Sends <prompt> to the chat model <model> (through the response cache) and
+  returns the str response. New code can gather many of these at once, e.g., 
+    llm_client.run_all([chat_request_async("gpt-3.5-turbo", p) 
+                        for p in prompts])
+  <candidate> tells apart the candidates of the same prompt that 
+  ChatGPT_safe_generate_response asks for at once (see 
+  get_chat_candidate_parameter). 
+  """
+  return await cached_request_async(
+                 model, prompt, get_chat_candidate_parameter(candidate), 
+                 lambda: llm_client.chat_completion(model, prompt))
+
+
+async def chat_stream_request_async(model, prompt, early_stop): 
+  """
+  The streaming version of chat_request_async (see get_early_stop). 
+  """
+  return await cached_request_async(
+                 model, prompt, get_stream_parameter(), 
+                 lambda: llm_client.chat_completion_stream(model, prompt, 
+                                                           early_stop))
+
+
+# The safe_generate functions can ask for <n_candidates> responses to a 
+# prompt at once instead of retrying one at a time. Optional settings in 
+# utils.py: 
+#   llm_n_candidates: the number of candidates that the flaky prompts (e.g., 
+#                     task decomposition) ask for at once (1 keeps the 
+#                     sequential retries)
+#   llm_candidate_temperature: the temperature of every candidate but the 
+#                              first, which keeps the prompt's own temperature
+llm_n_candidates = getattr(utils, "llm_n_candidates", 1)
+llm_candidate_temperature = getattr(utils, "llm_candidate_temperature", 0.7)
+
+
+def get_candidate_parameter(gpt_parameter, count): 
+  """
+  Returns the gpt_parameter of the <count>-th candidate response to a 
+  prompt. The first candidate is the very same request as without 
+  candidates. The others are sampled at <llm_candidate_temperature> (at 
+  temperature 0 they would all be the same), and carry their index so that 
+  each gets its own entry in the response cache and on the tape. 
+  """
+  if count == 0: 
+    return gpt_parameter
+  candidate_parameter = dict(gpt_parameter)
+  candidate_parameter["temperature"] = max(gpt_parameter["temperature"], 
+                                           llm_candidate_temperature)
+  candidate_parameter["candidate"] = count
+  return candidate_parameter
+
+
+# The short-answer prompts (e.g., poignancy ratings and yes/no decisions) 
+# can stream their responses and stop reading as soon as the answer is 
+# complete. Optional setting in utils.py: 
+#   llm_streaming: True to stream the prompts that pass an <early_stop> to 
+#                  the safe_generate functions (off by default)
+llm_streaming = getattr(utils, "llm_streaming", False)
+
+
+def get_early_stop(pattern, suffix=""): 
+  """
+  Returns an early_stop function for the streaming requests. The function 
+  takes the text of a response received so far, and returns the response 
+  to go with (the text up to the end of the first match of <pattern>, plus
+  <suffix>) once <pattern> matches, or None to keep reading. 
+  ARGS:
+    pattern: a regex str that only matches once the answer is complete 
+             (e.g., with a lookahead for the character after a number)
+    suffix: a str appended to the response (e.g., to close a json)
+  RETURNS: 
+    a function that takes a str and returns a str or None. 
+  """
+  compiled = re.compile(pattern)
+  def early_stop(text): 
+    match = compiled.search(text)
+    if not match: 
+      return None
+    return text[:match.end()] + suffix
+  return early_stop
+
+
+# Stops once the value of the {"output": ...} json that 
+# ChatGPT_safe_generate_response asks for is complete. 
+JSON_OUTPUT_EARLY_STOP = get_early_stop(
+  r'^\s*\{\s*"output"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?=[^\d.])|true|false)', 
+  "}")
+
+
+def get_stream_parameter(gpt_parameter=None): 
+  """
+  Returns the parameter that keys a streamed request in the response cache.
+  Streamed responses can be cut short, so they are kept apart from the 
+  complete responses to the same prompt. 
+  """
+  if gpt_parameter is None: 
+    return {"stream": True}
+  stream_parameter = dict(gpt_parameter)
+  stream_parameter["stream"] = True
+  return stream_parameter
+
+
+def get_chat_candidate_parameter(count): 
+  """
+  The chat version of get_candidate_parameter. Chat requests are already 
+  sampled, so the candidates only need their index. 
+  """
+  if count == 0: 
+    return None
+  return {"candidate": count}
+
+
+def iter_candidate_responses(coros, error_response): 
+  """
+  Sends all <coros> to the LLM at once and yields their responses in order, 
+  so that the caller can go with the first candidate that passes validation
+  while the others are still in flight. Failed requests yield 
+  <error_response>. The requests that are still in flight when the caller 
+  stops iterating are cancelled (use with contextlib.closing). 
+  """
+  futures = [llm_client.submit(coro) for coro in coros]
+  try: 
+    for future in futures: 
+      try: 
+        yield future.result()
+      except (openai.error.OpenAIError, asyncio.TimeoutError) as e: 
+        print (f"{error_response} ({type(e).__name__}): {e}")
+        yield error_response
+  finally: 
+    for future in futures: 
+      future.cancel()
 
-def temp_sleep(seconds=0.1):
-  time.sleep(seconds)
 
 def ChatGPT_single_request(prompt): 
-  temp_sleep()
+  return llm_client.run(chat_request_async(
+                          get_routed_model("chat", "gpt-3.5-turbo"), prompt))
+
 
-  completion = openai.ChatCompletion.create(
-    model="gpt-3.5-turbo", 
-    messages=[{"role": "user", "content": prompt}]
-  )
-  return completion["choices"][0]["message"]["content"]
+class ValidationFailure: 
+  """
+  What a func_validate returns instead of False to say why it rejected a 
+  response, e.g., ValidationFailure("not an integer"). It is falsy, so the 
+  validators that still return True/False and the code that checks their 
+  result as a bool keep working. The reason is accounted in prompt_stats, 
+  and the chat prompts tell it to the model when they ask again, together
+  with the <detail> of this very response if there is one (e.g., the error
+  that parsing it raised), which we leave out of the stats. 
+  """
+  def __init__(self, reason, detail=""): 
+    self.reason = reason
+    self.detail = detail
+
+  def get_message(self): 
+    if self.detail: 
+      return f"{self.reason}: {self.detail}"
+    return self.reason
+
+  def __bool__(self): 
+    return False
+
+  def __repr__(self): 
+    return f"ValidationFailure({self.reason!r})"
+
+
+def check_response(func_validate, response, prompt, func_clean_up=None): 
+  """
+  Runs <func_validate> on <response> and returns True, or a 
+  ValidationFailure with the reason it failed. Most validators that return 
+  a plain False do so because <func_clean_up> cannot parse the response, so 
+  we take the reason from the error it raises; the others (and validators 
+  that raise) get a generic reason. 
+  """
+  try: 
+    result = func_validate(response, prompt=prompt)
+  except Exception as e: 
+    return ValidationFailure(f"validator raised {type(e).__name__}", str(e))
+  if isinstance(result, ValidationFailure): 
+    return result
+  if result: 
+    return True
+  if func_clean_up: 
+    try: 
+      func_clean_up(response, prompt=prompt)
+    except Exception as e: 
+      return ValidationFailure(f"could not be parsed ({type(e).__name__})", 
+                               str(e)[:200])
+  return ValidationFailure("rejected by the validator")
+
+
+def get_local_repairs(response): 
+  """
+  Returns the repaired versions of a str <response> that failed validation,
+  for the usual formatting problems that do not need another request: code 
+  fences, text around a json, trailing commas, quotes and a trailing period
+  around a short answer, and a number with text around it (only if it is
+  the one number in the response, or the whole answer but for punctuation 
+  and a unit, e.g., "8:00 am"). 
+  """
+  if type(response) != str: 
+    return []
+  candidates = []
+  text = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", response.strip())
+  candidates += [text]
+  start = text.find("{")
+  end = text.rfind("}")
+  if 0 <= start < end: 
+    candidates += [re.sub(r",\s*([}\]])", r"\1", text[start:end + 1])]
+  candidates += [text.strip("\"'` ").rstrip(".").strip()]
+  # We do not guess between several numbers: the first one of "On a scale
+  # of 1 to 10, I'd rate it 7" would pass as a valid (and wrong) answer. 
+  numbers = re.findall(r"-?\d+", text)
+  whole_number = re.fullmatch(r"[^\w-]*(-?\d+)(?::00)?\s*[a-zA-Z%.]*\W*", 
+                              text)
+  if len(numbers) == 1: 
+    candidates += numbers
+  elif whole_number: 
+    candidates += [whole_number.group(1)]
+
+  ret = []
+  for candidate in candidates: 
+    if candidate and candidate != response and candidate not in ret: 
+      ret += [candidate]
+  return ret
+
+
+def try_response(response, func_validate, func_clean_up, prompt): 
+  """
+  Validates <response>, and if it fails, its local repairs (see 
+  get_local_repairs) before we spend another request on the prompt. 
+  RETURNS: 
+    [True, <the cleaned up response>] or [False, <the ValidationFailure of 
+    the original response>]. 
+  """
+  failure = check_response(func_validate, response, prompt, func_clean_up)
+  if failure is True: 
+    return [True, func_clean_up(response, prompt=prompt)]
+  for repaired in get_local_repairs(response): 
+    if check_response(func_validate, repaired, prompt) is True: 
+      prompt_stats.record_repair()
+      return [True, func_clean_up(repaired, prompt=prompt)]
+  return [False, failure]
+
+
+def parse_json_output(response): 
+  """
+  Returns [<value>, <repaired>] for the "output" value of the json that the
+  chat prompts ask for, or None if there is no such json in <response>. 
+  <repaired> is True if we had to get past formatting problems (text or 
+  code fences around the json, single quotes, trailing commas) to read it. 
+  """
+  end_index = response.rfind('}') + 1
+  try: 
+    return [json.loads(response[:end_index])["output"], False]
+  except (ValueError, KeyError, TypeError): 
+    pass
+
+  start_index = response.find('{')
+  if start_index == -1 or end_index <= start_index: 
+    return None
+  chunk = response[start_index:end_index]
+  without_trailing_commas = re.sub(r",\s*([}\]])", r"\1", chunk)
+  for candidate in [chunk, 
+                    without_trailing_commas, 
+                    without_trailing_commas.replace("'", '"')]: 
+    try: 
+      return [json.loads(candidate)["output"], True]
+    except (ValueError, KeyError, TypeError): 
+      pass
+  match = re.search(r'"output"\s*:\s*"([^"]*)"', chunk)
+  if match: 
+    return [match.group(1), True]
+  return None
+
+
+def get_repair_prompt(prompt, response, reason): 
+  """
+  Returns the prompt that asks again after <response> to <prompt> failed 
+  validation for <reason>. Instead of sending the very same prompt (which 
+  tends to fail the same way), it tells the model what was wrong. 
+  """
+  return (f"{prompt}\n\nYour previous response was:\n{str(response)[:500]}\n"
+          f"It could not be used ({reason}). Respond again, following the "
+          f"instructions above exactly.")
 
 
 # ============================================================================
 # #####################[SECTION 1: CHATGPT-3 STRUCTURE] ######################
 # ============================================================================
 
-def GPT4_request(prompt): 
+def GPT4_request(prompt, model="gpt-4"): 
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
   ARGS:
     prompt: a str prompt
-    gpt_parameter: a python dictionary with the keys indicating the names of  
-                   the parameter and the values indicating the parameter 
-                   values.   
+    model: the chat model to send the prompt to (see get_routed_model)
   RETURNS: 
     a str of GPT-3's response. 
   """
-  temp_sleep()
-
   try: 
-    completion = openai.ChatCompletion.create(
-    model="gpt-4", 
-    messages=[{"role": "user", "content": prompt}]
-    )
-    return completion["choices"][0]["message"]["content"]
+    return llm_client.run(chat_request_async(model, prompt))
   
-  except: 
-    print ("ChatGPT ERROR")
+  except (openai.error.OpenAIError, asyncio.TimeoutError) as e: 
+    # Rate limits are retried with backoff inside llm_client; we only get 
+    # here once those retries are exhausted or on a non-retryable error. 
+    print (f"ChatGPT ERROR ({type(e).__name__}): {e}")
     return "ChatGPT ERROR"
 
 
-def ChatGPT_request(prompt): 
+def ChatGPT_request(prompt, model="gpt-3.5-turbo", early_stop=None): 
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
   ARGS:
     prompt: a str prompt
-    gpt_parameter: a python dictionary with the keys indicating the names of  
-                   the parameter and the values indicating the parameter 
-                   values.   
+    model: the chat model to send the prompt to (see get_routed_model)
+    early_stop: if given (and <llm_streaming> is on), the response is 
+                streamed and cut short by this function (see 
+                get_early_stop). 
   RETURNS: 
     a str of GPT-3's response. 
   """
-  # temp_sleep()
   try: 
-    completion = openai.ChatCompletion.create(
-    model="gpt-3.5-turbo", 
-    messages=[{"role": "user", "content": prompt}]
-    )
-    return completion["choices"][0]["message"]["content"]
+    if early_stop and llm_streaming: 
+      return llm_client.run(chat_stream_request_async(model, prompt, 
+                                                      early_stop))
+    return llm_client.run(chat_request_async(model, prompt))
   
-  except: 
-    print ("ChatGPT ERROR")
+  except (openai.error.OpenAIError, asyncio.TimeoutError) as e: 
+    # Rate limits are retried with backoff inside llm_client; we only get 
+    # here once those retries are exhausted or on a non-retryable error. 
+    print (f"ChatGPT ERROR ({type(e).__name__}): {e}")
     return "ChatGPT ERROR"
 
 
@@ -98,24 +657,36 @@ def GPT4_safe_generate_response(prompt,
     print ("CHAT GPT PROMPT")
     print (prompt)
 
+  curr_prompt = prompt
   for i in range(repeat): 
+    if i > 0: 
+      prompt_stats.record_retry()
 
+    model = get_routed_model("chat", "gpt-4", i)
+    curr_gpt_response = ""
     try: 
-      curr_gpt_response = GPT4_request(prompt).strip()
-      end_index = curr_gpt_response.rfind('}') + 1
-      curr_gpt_response = curr_gpt_response[:end_index]
-      curr_gpt_response = json.loads(curr_gpt_response)["output"]
-      
-      if func_validate(curr_gpt_response, prompt=prompt): 
-        return func_clean_up(curr_gpt_response, prompt=prompt)
-      
-      if verbose: 
-        print ("---- repeat count: \n", i, curr_gpt_response)
-        print (curr_gpt_response)
-        print ("~~~~")
-
-    except: 
-      pass
+      curr_gpt_response = GPT4_request(curr_prompt, model).strip()
+      parsed = parse_json_output(curr_gpt_response)
+      if parsed is None: 
+        failure = ValidationFailure("no json with an output")
+      else: 
+        valid, ret = try_response(parsed[0], func_validate, func_clean_up, 
+                                  prompt)
+        if valid: 
+          if parsed[1]: 
+            prompt_stats.record_repair()
+          return ret
+        failure = ret
+    except Exception as e: 
+      failure = ValidationFailure(f"{type(e).__name__} raised")
+
+    prompt_stats.record_validation_failure(failure.reason)
+    discard_cached_response(model, curr_prompt)
+    if verbose: 
+      print ("---- repeat count: \n", i, curr_gpt_response, failure)
+    if curr_gpt_response not in ["", "ChatGPT ERROR"]: 
+      curr_prompt = get_repair_prompt(prompt, curr_gpt_response, 
+                                      failure.get_message())
 
   return False
 
@@ -127,7 +698,9 @@ def ChatGPT_safe_generate_response(prompt,
                                    fail_safe_response="error",
                                    func_validate=None,
                                    func_clean_up=None,
-                                   verbose=False): 
+                                   verbose=False,
+                                   n_candidates=1,
+                                   early_stop=None): 
   # prompt = 'GPT-3 Prompt:\n"""\n' + prompt + '\n"""\n'
   prompt = '"""\n' + prompt + '\n"""\n'
   prompt += f"Output the response to the prompt above in json. {special_instruction}\n"
@@ -138,28 +711,89 @@ def ChatGPT_safe_generate_response(prompt,
     print ("CHAT GPT PROMPT")
     print (prompt)
 
+  if n_candidates > 1: 
+    # Ask for up to <n_candidates> responses at once instead of one at a 
+    # time, and go with the first one that passes validation. 
+    curr_prompt = prompt
+    for i in range(0, repeat, n_candidates): 
+      if i > 0: 
+        prompt_stats.record_retry()
+      counts = list(range(i, min(repeat, i + n_candidates)))
+      # All candidates of a batch go to the same tier; the next batch is the
+      # next attempt. 
+      model = get_routed_model("chat", "gpt-3.5-turbo", i // n_candidates)
+      coros = [chat_request_async(model, curr_prompt, count) 
+               for count in counts]
+      last_failure = None
+      with contextlib.closing(iter_candidate_responses(coros, 
+                                "ChatGPT ERROR")) as responses: 
+        for count, curr_gpt_response in zip(counts, responses): 
+          curr_gpt_response = curr_gpt_response.strip()
+          try: 
+            parsed = parse_json_output(curr_gpt_response)
+            if parsed is None: 
+              failure = ValidationFailure("no json with an output")
+            else: 
+              valid, ret = try_response(parsed[0], func_validate, 
+                                        func_clean_up, prompt)
+              if valid: 
+                if parsed[1]: 
+                  prompt_stats.record_repair()
+                return ret
+              failure = ret
+          except Exception as e: 
+            failure = ValidationFailure(f"{type(e).__name__} raised")
+          prompt_stats.record_validation_failure(failure.reason)
+          discard_cached_response(model, curr_prompt, 
+                                  get_chat_candidate_parameter(count))
+          if verbose: 
+            print ("---- candidate: \n", count, curr_gpt_response, failure)
+          if curr_gpt_response not in ["", "ChatGPT ERROR"]: 
+            last_failure = [curr_gpt_response, failure]
+      if last_failure: 
+        # Like in the sequential attempts below, the next batch tells the 
+        # model what was wrong with (the last candidate of) this one. 
+        curr_prompt = get_repair_prompt(prompt, last_failure[0], 
+                                        last_failure[1].get_message())
+    return False
+
+  # Streamed responses are cached under their own key. 
+  cache_parameter = None
+  if early_stop and llm_streaming: 
+    cache_parameter = get_stream_parameter()
+
+  curr_prompt = prompt
   for i in range(repeat): 
+    if i > 0: 
+      prompt_stats.record_retry()
 
+    model = get_routed_model("chat", "gpt-3.5-turbo", i)
+    curr_gpt_response = ""
     try: 
-      curr_gpt_response = ChatGPT_request(prompt).strip()
-      end_index = curr_gpt_response.rfind('}') + 1
-      curr_gpt_response = curr_gpt_response[:end_index]
-      curr_gpt_response = json.loads(curr_gpt_response)["output"]
-
-      # print ("---ashdfaf")
-      # print (curr_gpt_response)
-      # print ("000asdfhia")
-      
-      if func_validate(curr_gpt_response, prompt=prompt): 
-        return func_clean_up(curr_gpt_response, prompt=prompt)
-      
-      if verbose: 
-        print ("---- repeat count: \n", i, curr_gpt_response)
-        print (curr_gpt_response)
-        print ("~~~~")
-
-    except: 
-      pass
+      curr_gpt_response = ChatGPT_request(curr_prompt, model, 
+                                          early_stop).strip()
+      parsed = parse_json_output(curr_gpt_response)
+      if parsed is None: 
+        failure = ValidationFailure("no json with an output")
+      else: 
+        valid, ret = try_response(parsed[0], func_validate, func_clean_up, 
+                                  prompt)
+        if valid: 
+          if parsed[1]: 
+            prompt_stats.record_repair()
+          return ret
+        failure = ret
+    except Exception as e: 
+      failure = ValidationFailure(f"{type(e).__name__} raised")
+
+    prompt_stats.record_validation_failure(failure.reason)
+    discard_cached_response(model, curr_prompt, cache_parameter)
+    if verbose: 
+      print ("---- repeat count: \n", i, curr_gpt_response, failure)
+    if curr_gpt_response not in ["", "ChatGPT ERROR"]: 
+      # The next attempt tells the model what was wrong with this one. 
+      curr_prompt = get_repair_prompt(prompt, curr_gpt_response, 
+                                      failure.get_message())
 
   return False
 
@@ -174,18 +808,31 @@ def ChatGPT_safe_generate_response_OLD(prompt,
     print ("CHAT GPT PROMPT")
     print (prompt)
 
+  curr_prompt = prompt
   for i in range(repeat): 
+    if i > 0: 
+      prompt_stats.record_retry()
+    model = get_routed_model("chat", "gpt-3.5-turbo", i)
+    curr_gpt_response = ""
     try: 
-      curr_gpt_response = ChatGPT_request(prompt).strip()
-      if func_validate(curr_gpt_response, prompt=prompt): 
-        return func_clean_up(curr_gpt_response, prompt=prompt)
-      if verbose: 
-        print (f"---- repeat count: {i}")
-        print (curr_gpt_response)
-        print ("~~~~")
-
-    except: 
-      pass
+      curr_gpt_response = ChatGPT_request(curr_prompt, model).strip()
+      valid, ret = try_response(curr_gpt_response, func_validate, 
+                                func_clean_up, prompt)
+      if valid: 
+        return ret
+      failure = ret
+    except Exception as e: 
+      failure = ValidationFailure(f"{type(e).__name__} raised")
+
+    prompt_stats.record_validation_failure(failure.reason)
+    discard_cached_response(model, curr_prompt)
+    if verbose: 
+      print (f"---- repeat count: {i}")
+      print (curr_gpt_response, failure)
+      print ("~~~~")
+    if curr_gpt_response not in ["", "ChatGPT ERROR"]: 
+      curr_prompt = get_repair_prompt(prompt, curr_gpt_response, 
+                                      failure.get_message())
   print ("FAIL SAFE TRIGGERED") 
   return fail_safe_response
 
@@ -194,7 +841,7 @@ def ChatGPT_safe_generate_response_OLD(prompt,
 # ###################[SECTION 2: ORIGINAL GPT-3 STRUCTURE] ###################
 # ============================================================================
 
-def GPT_request(prompt, gpt_parameter): 
+def GPT_request(prompt, gpt_parameter, early_stop=None): 
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -203,27 +850,89 @@ def GPT_request(prompt, gpt_parameter):
     gpt_parameter: a python dictionary with the keys indicating the names of  
                    the parameter and the values indicating the parameter 
                    values.   
+    early_stop: if given (and <llm_streaming> is on), the response is 
+                streamed and cut short by this function (see 
+                get_early_stop). 
   RETURNS: 
     a str of GPT-3's response. 
   """
-  temp_sleep()
   try: 
-    response = openai.Completion.create(
-                model=gpt_parameter["engine"],
-                prompt=prompt,
-                temperature=gpt_parameter["temperature"],
-                max_tokens=gpt_parameter["max_tokens"],
-                top_p=gpt_parameter["top_p"],
-                frequency_penalty=gpt_parameter["frequency_penalty"],
-                presence_penalty=gpt_parameter["presence_penalty"],
-                stream=gpt_parameter["stream"],
-                stop=gpt_parameter["stop"],)
-    return response.choices[0].text
-  except: 
-    print ("TOKEN LIMIT EXCEEDED")
+    if early_stop and llm_streaming: 
+      return llm_client.run(completion_stream_request_async(
+                              prompt, gpt_parameter, early_stop))
+    return llm_client.run(completion_request_async(prompt, gpt_parameter))
+  except (openai.error.OpenAIError, asyncio.TimeoutError) as e: 
+    print (f"TOKEN LIMIT EXCEEDED ({type(e).__name__}): {e}")
     return "TOKEN LIMIT EXCEEDED"
 
 
+async def completion_request_async(prompt, gpt_parameter): 
+  """
+  The async version of GPT_request (without its error handling). 
+  """
+  return await cached_request_async(
+                 gpt_parameter["engine"], prompt, gpt_parameter, 
+                 lambda: llm_client.completion(prompt, gpt_parameter))
+
+
+async def completion_stream_request_async(prompt, gpt_parameter, early_stop): 
+  """
+  The streaming version of completion_request_async (see get_early_stop). 
+  """
+  return await cached_request_async(
+                 gpt_parameter["engine"], prompt, 
+                 get_stream_parameter(gpt_parameter), 
+                 lambda: llm_client.completion_stream(prompt, gpt_parameter, 
+                                                      early_stop))
+
+
+# The marker that separates the comment header of a prompt template from the
+# prompt itself, and the pattern of the input slots in a prompt template. 
+PROMPT_COMMENT_MARKER = "<commentblockmarker>###</commentblockmarker>"
+PROMPT_SLOT_PATTERN = re.compile(r"!<INPUT (\d+)>!")
+
+# <prompt_template_cache> maps the path of a prompt template to 
+# [<mtime>, <segments>] of its compiled form. <segments> alternates between 
+# literal strs and int slot indices, so a prompt is rendered with a single 
+# join instead of reading the file and running a replace for every input. 
+# The mtime lets us pick up templates that are edited while the server runs. 
+prompt_template_cache = dict()
+
+
+def compile_prompt_template(prompt_lib_file): 
+  """
+  Returns the compiled form of the prompt template at <prompt_lib_file>, 
+  parsing it only if we have not seen it yet or if it changed on disk. 
+  ARGS:
+    prompt_lib_file: the path to the promopt file. 
+  RETURNS: 
+    a list of literal strs and int slot indices. 
+  """
+  mtime = os.path.getmtime(prompt_lib_file)
+  cached = prompt_template_cache.get(prompt_lib_file)
+  if cached and cached[0] == mtime: 
+    return cached[1]
+
+  f = open(prompt_lib_file, "r")
+  prompt = f.read()
+  f.close()
+  # The comment header is dropped at compile time. (Its slots are never 
+  # rendered anyway.)
+  if PROMPT_COMMENT_MARKER in prompt: 
+    prompt = prompt.split(PROMPT_COMMENT_MARKER)[1]
+
+  segments = []
+  for count, chunk in enumerate(PROMPT_SLOT_PATTERN.split(prompt)): 
+    # re.split puts the captured slot index at every odd position. 
+    if count % 2: 
+      segments += [int(chunk)]
+    elif chunk: 
+      segments += [chunk]
+
+  prompt_template_cache[prompt_lib_file] = [mtime, segments]
+  return segments
+
+
 def generate_prompt(curr_input, prompt_lib_file): 
   """
   Takes in the current input (e.g. comment that you want to classifiy) and 
@@ -242,14 +951,16 @@ def generate_prompt(curr_input, prompt_lib_file):
     curr_input = [curr_input]
   curr_input = [str(i) for i in curr_input]
 
-  f = open(prompt_lib_file, "r")
-  prompt = f.read()
-  f.close()
-  for count, i in enumerate(curr_input):   
-    prompt = prompt.replace(f"!<INPUT {count}>!", i)
-  if "<commentblockmarker>###</commentblockmarker>" in prompt: 
-    prompt = prompt.split("<commentblockmarker>###</commentblockmarker>")[1]
-  return prompt.strip()
+  prompt = []
+  for segment in compile_prompt_template(prompt_lib_file): 
+    if type(segment) == str: 
+      prompt += [segment]
+    elif segment < len(curr_input): 
+      prompt += [curr_input[segment]]
+    else: 
+      # Slots that we have no input for stay in the prompt as they are. 
+      prompt += [f"!<INPUT {segment}>!"]
+  return "".join(prompt).strip()
 
 
 def safe_generate_response(prompt, 
@@ -258,14 +969,59 @@ def safe_generate_response(prompt,
                            fail_safe_response="error",
                            func_validate=None,
                            func_clean_up=None,
-                           verbose=False): 
+                           verbose=False,
+                           n_candidates=1,
+                           early_stop=None): 
   if verbose: 
     print (prompt)
 
+  if n_candidates > 1: 
+    # Ask for up to <n_candidates> responses at once instead of one at a 
+    # time, and go with the first one that passes validation. 
+    for i in range(0, repeat, n_candidates): 
+      if i > 0: 
+        prompt_stats.record_retry()
+      counts = list(range(i, min(repeat, i + n_candidates)))
+      routed_parameter = get_routed_parameter(gpt_parameter, 
+                                              i // n_candidates)
+      candidate_parameters = [get_candidate_parameter(routed_parameter, count) 
+                              for count in counts]
+      coros = [completion_request_async(prompt, candidate_parameter) 
+               for candidate_parameter in candidate_parameters]
+      with contextlib.closing(iter_candidate_responses(coros, 
+                                "TOKEN LIMIT EXCEEDED")) as responses: 
+        for candidate_parameter, curr_gpt_response in zip(
+                                   candidate_parameters, responses): 
+          valid, ret = try_response(curr_gpt_response, func_validate, 
+                                    func_clean_up, prompt)
+          if valid: 
+            return ret
+          prompt_stats.record_validation_failure(ret.reason)
+          discard_cached_response(candidate_parameter["engine"], prompt, 
+                                  candidate_parameter)
+          if verbose: 
+            print ("---- candidate: ", candidate_parameter, curr_gpt_response)
+    return fail_safe_response
+
   for i in range(repeat): 
-    curr_gpt_response = GPT_request(prompt, gpt_parameter)
-    if func_validate(curr_gpt_response, prompt=prompt): 
-      return func_clean_up(curr_gpt_response, prompt=prompt)
+    if i > 0: 
+      prompt_stats.record_retry()
+    routed_parameter = get_routed_parameter(gpt_parameter, i)
+    curr_gpt_response = GPT_request(prompt, routed_parameter, early_stop)
+    valid, ret = try_response(curr_gpt_response, func_validate, 
+                              func_clean_up, prompt)
+    if valid: 
+      return ret
+    # Completion prompts end in the middle of the text that the model is to
+    # complete, so we cannot append a correction to them; we only repair 
+    # locally (in try_response) and retry. 
+    prompt_stats.record_validation_failure(ret.reason)
+    cache_parameter = routed_parameter
+    if early_stop and llm_streaming: 
+      # Streamed responses are cached under their own key. 
+      cache_parameter = get_stream_parameter(routed_parameter)
+    discard_cached_response(routed_parameter["engine"], prompt, 
+                            cache_parameter)
     if verbose: 
       print ("---- repeat count: ", i, curr_gpt_response)
       print (curr_gpt_response)
@@ -273,12 +1029,46 @@ def safe_generate_response(prompt,
   return fail_safe_response
 
 
+def get_embeddings(texts, model="text-embedding-ada-002"): 
+  """
+  Returns the embeddings of all <texts>. The texts that are already in the 
+  embedding store are served from there, and the rest are sent together
+  through the embedding batcher. 
+  ARGS:
+    texts: a list of str texts
+    model: the embedding model name
+  RETURNS: 
+    a list of embeddings (lists of floats) in the same order as <texts>. 
+  """
+  texts = [normalize_embedding_text(text) for text in texts]
+  tape = get_active_tape()
+  if tape and tape.mode == "replay": 
+    return [tape.replay_embedding(embedding_store.make_key(model, text))
+            for text in texts]
+
+  store_model = get_store_model_name(model)
+  embeddings = [embedding_store.get(store_model, text) for text in texts]
+
+  missing = []
+  for text, embedding in zip(texts, embeddings): 
+    if embedding is None and text not in missing: 
+      missing += [text]
+  if missing: 
+    new_embeddings = dict(zip(missing, 
+                              embedding_batcher.embed(model, missing)))
+    for text, embedding in new_embeddings.items(): 
+      embedding_store.put(store_model, text, embedding)
+    embeddings = [embedding if embedding is not None else new_embeddings[text]
+                  for text, embedding in zip(texts, embeddings)]
+
+  if tape: 
+    for text, embedding in zip(texts, embeddings): 
+      tape.record_embedding(embedding_store.make_key(model, text), embedding)
+  return embeddings
+
+
 def get_embedding(text, model="text-embedding-ada-002"):
-  text = text.replace("\n", " ")
-  if not text: 
-    text = "this is blank"
-  return openai.Embedding.create(
-          input=[text], model=model)['data'][0]['embedding']
+  return get_embeddings([text], model)[0]
 
 
 if __name__ == '__main__':
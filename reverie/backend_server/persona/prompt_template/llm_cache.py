@@ -0,0 +1,242 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: llm_cache.py
+Description: A persistent, content-addressed cache for LLM responses. Every
+request we send to OpenAI is keyed by a hash of (model, prompt, gpt_parameter)
+so that re-running a fork of a simulation can reuse the responses that were
+already generated instead of going back to the network.
+"""
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# The cache can be used in one of three modes:
+# "read-write" -- Serve hits from the cache and store all new responses.
+# "read-only"  -- Serve hits from the cache, but never write to it.
+# "bypass"     -- Do not touch the cache at all (the original behavior).
+CACHE_MODES = ["read-write", "read-only", "bypass"]
+
+
+class LLMCache:
+  def __init__(self, db_path, mode="bypass", max_size_mb=512,
+               flush_every=100, flush_secs=5):
+    if mode not in CACHE_MODES:
+      raise ValueError(f"Unknown LLM cache mode: {mode}")
+
+    # <db_path> is the SQLite file that backs the cache. It is shared across
+    # all simulations (and all forks) that point to the same file.
+    self.db_path = db_path
+    # <mode> is one of CACHE_MODES.
+    self.mode = mode
+    # <max_bytes> is the size budget for the stored responses. Once we go
+    # over it, the least recently used entries are evicted.
+    self.max_bytes = int(max_size_mb * 1024 * 1024)
+
+    # The connection is opened lazily (so that "bypass" never creates the
+    # file) and shared across threads behind a lock.
+    self.conn = None
+    self.total_bytes = 0
+    self.lock = threading.Lock()
+
+    # A commit is a disk write, so in "read-write" mode we do not write every
+    # new response and every hit's <last_access> right away. <pending_puts>
+    # maps a key to the (model, response, size, created) of a new response,
+    # and <pending_touches> maps a key to the time of its last hit. They go
+    # to the file in one transaction once there are <flush_every> of them or
+    # <flush_secs> have passed since the last flush (and at exit, see flush).
+    # We keep them in memory rather than in an open transaction so that the
+    # worker processes that share the file do not lock each other out.
+    self.pending_puts = dict()
+    self.pending_touches = dict()
+    self.flush_every = flush_every
+    self.flush_secs = flush_secs
+    self.last_flush = time.time()
+    atexit.register(self.flush)
+
+    # Counters for the current process.
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  def _connect(self):
+    if self.conn:
+      return self.conn
+
+    db_folder = os.path.dirname(self.db_path)
+    if db_folder and not os.path.exists(db_folder):
+      os.makedirs(db_folder)
+
+    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                           key TEXT PRIMARY KEY,
+                           model TEXT,
+                           response TEXT,
+                           size INTEGER,
+                           created REAL,
+                           last_access REAL)""")
+    self.conn.execute("""CREATE INDEX IF NOT EXISTS responses_last_access
+                           ON responses (last_access)""")
+    self.conn.commit()
+    row = self.conn.execute("SELECT SUM(size) FROM responses").fetchone()
+    self.total_bytes = row[0] or 0
+    return self.conn
+
+
+  def make_key(self, model, prompt, gpt_parameter=None):
+    """
+    Returns the content address of a request.
+
+    INPUT:
+      model: the model name (e.g., "gpt-3.5-turbo")
+      prompt: a str prompt
+      gpt_parameter: the gpt_parameter dictionary of the request (None for
+                     the chat requests that do not take one).
+    OUTPUT:
+      a hex str sha256 digest.
+    """
+    raw = json.dumps([model, prompt, gpt_parameter], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+  def get(self, key):
+    """
+    Returns the cached value for <key>, or None if we do not have it.
+    """
+    if self.mode == "bypass":
+      return None
+
+    with self.lock:
+      if key in self.pending_puts:
+        self.hits += 1
+        return json.loads(self.pending_puts[key][1])
+
+      conn = self._connect()
+      row = conn.execute("SELECT response FROM responses WHERE key = ?",
+                         (key,)).fetchone()
+      if not row:
+        self.misses += 1
+        return None
+
+      self.hits += 1
+      if self.mode == "read-write":
+        self.pending_touches[key] = time.time()
+        self._maybe_flush()
+    return json.loads(row[0])
+
+
+  def put(self, key, value, model=""):
+    """
+    Stores <value> (anything that is json serializable) under <key>.
+    """
+    if self.mode != "read-write":
+      return
+
+    response = json.dumps(value)
+    size = len(response.encode("utf-8"))
+    with self.lock:
+      conn = self._connect()
+      if key in self.pending_puts:
+        self.total_bytes -= self.pending_puts[key][2]
+      else:
+        row = conn.execute("SELECT size FROM responses WHERE key = ?",
+                           (key,)).fetchone()
+        if row:
+          self.total_bytes -= row[0]
+      self.pending_puts[key] = (model, response, size, time.time())
+      self.pending_touches.pop(key, None)
+      self.total_bytes += size
+      self._maybe_flush()
+
+
+  def discard(self, key):
+    """
+    Removes <key> from the cache. We use this when a cached response turned
+    out to be unusable (e.g., it failed validation), so that the next attempt
+    goes back to the server instead of getting the same response again.
+    """
+    if self.mode != "read-write":
+      return
+
+    with self.lock:
+      self.pending_touches.pop(key, None)
+      if key in self.pending_puts:
+        self.total_bytes -= self.pending_puts.pop(key)[2]
+        return
+
+      conn = self._connect()
+      row = conn.execute("SELECT size FROM responses WHERE key = ?",
+                         (key,)).fetchone()
+      if row:
+        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        conn.commit()
+        self.total_bytes -= row[0]
+
+
+  def flush(self):
+    """
+    Writes the pending responses and hits to the file. This runs at exit,
+    but the worker processes do not run the exit hooks, so they call it
+    themselves after every step.
+    """
+    with self.lock:
+      self._flush()
+
+
+  def _maybe_flush(self):
+    if (len(self.pending_puts) + len(self.pending_touches) >= self.flush_every
+        or time.time() - self.last_flush >= self.flush_secs):
+      self._flush()
+
+
+  def _flush(self):
+    self.last_flush = time.time()
+    if not self.pending_puts and not self.pending_touches:
+      return
+
+    conn = self._connect()
+    conn.executemany("""INSERT OR REPLACE INTO responses
+                          (key, model, response, size, created, last_access)
+                          VALUES (?, ?, ?, ?, ?, ?)""",
+                     [(key, model, response, size, created, created)
+                      for key, (model, response, size, created)
+                      in self.pending_puts.items()])
+    conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                     [(last_access, key)
+                      for key, last_access in self.pending_touches.items()])
+    self.pending_puts = dict()
+    self.pending_touches = dict()
+    if self.total_bytes > self.max_bytes:
+      self._evict(conn)
+    conn.commit()
+
+
+  def _evict(self, conn):
+    # We evict the least recently used entries in chunks until we are back
+    # under 90% of the budget (so we do not evict on every single put).
+    target_bytes = int(self.max_bytes * 0.9)
+    while self.total_bytes > target_bytes:
+      rows = conn.execute("""SELECT key, size FROM responses
+                             ORDER BY last_access ASC LIMIT 100""").fetchall()
+      if not rows:
+        self.total_bytes = 0
+        break
+      for key, size in rows:
+        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.total_bytes -= size
+        self.evictions += 1
+        if self.total_bytes <= target_bytes:
+          break
+
+
+  def get_str_stats(self):
+    return (f"LLM cache [{self.mode}] {self.db_path}\n"
+            f"hits: {self.hits}, misses: {self.misses}, "
+            f"evictions: {self.evictions}, "
+            f"size: {self.total_bytes/(1024*1024):.2f}MB / "
+            f"{self.max_bytes/(1024*1024):.0f}MB")
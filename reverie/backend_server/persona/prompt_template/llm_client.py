@@ -0,0 +1,255 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: llm_client.py
+Description: An asyncio client for the LLM API. The client owns an event
+loop that runs on a background thread, so the synchronous functions in
+gpt_structure.py can hand their requests to it and block on the result, while
+new code can submit many requests at once and wait for all of them. The
+number of requests in flight is bounded by the slots of a priority scheduler
+(see llm_scheduler.py), and every request is subject to a timeout after which
+it is cancelled. Requests are also paced by a shared rate limiter, and rate
+limited requests are retried here with backoff so that they never reach the
+validation retries of the callers.
+"""
+import asyncio
+import contextvars
+import threading
+
+import openai
+
+from persona.prompt_template.llm_backend import *
+from persona.prompt_template.llm_scheduler import *
+from persona.prompt_template.rate_limiter import *
+
+
+class AsyncLLMClient:
+  def __init__(self, max_concurrency=8, timeout=120, rate_limiter=None, 
+               backend=None, scheduler=None):
+    # <max_concurrency> is the max number of requests we have in flight at
+    # any given moment. Requests beyond that wait for a free slot.
+    self.max_concurrency = max_concurrency
+    # <scheduler> hands out the slots, most urgent requests first (see 
+    # llm_scheduler.py).
+    self.scheduler = (scheduler if scheduler 
+                      else PriorityScheduler(max_concurrency))
+    # <timeout> is the number of seconds after which a request is cancelled
+    # and asyncio.TimeoutError is raised to the caller.
+    self.timeout = timeout
+    # <rate_limiter> paces the requests per model (see rate_limiter.py).
+    self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+    # <backend> is the LLMBackend that actually serves the requests (see 
+    # llm_backend.py).
+    self.backend = backend if backend else OpenAIBackend()
+    # <usage_callback> is called with (model, usage) for every response that
+    # reports its token usage (see prompt_stats.py). 
+    self.usage_callback = None
+
+    # The event loop and its thread are started lazily on the first request.
+    self.loop = None
+    self.thread = None
+    self.lock = threading.Lock()
+
+
+  def _start(self):
+    with self.lock:
+      if self.loop:
+        return
+      self.loop = asyncio.new_event_loop()
+      self.thread = threading.Thread(target=self.loop.run_forever,
+                                     daemon=True)
+      self.thread.start()
+
+
+  def submit(self, coro):
+    """
+    Schedules <coro> on the client's event loop and returns a
+    concurrent.futures.Future for its result. This is the entry point for
+    code that wants to have many requests in flight at once.
+    """
+    if not self.loop:
+      self._start()
+    # <coro> runs in a copy of the caller's context, so that the context
+    # variables set by the caller (e.g., the prompt function that the
+    # request is accounted to) are visible to it on the loop's thread.
+    return asyncio.run_coroutine_threadsafe(
+             self._run_in_context(contextvars.copy_context(), coro), 
+             self.loop)
+
+
+  async def _run_in_context(self, context, coro):
+    # A task runs in a copy of the context that is current when it is
+    # created. 
+    return await context.run(asyncio.ensure_future, coro)
+
+
+  def run(self, coro):
+    """
+    Runs <coro> on the client's event loop and blocks until it is done. If
+    the calling thread is interrupted (e.g., with ctrl-c), the request is
+    cancelled.
+    """
+    future = self.submit(coro)
+    try:
+      return future.result()
+    except BaseException:
+      future.cancel()
+      raise
+
+
+  def run_all(self, coros):
+    """
+    Runs all of <coros> concurrently and returns their results in order.
+    Exceptions are returned in place of the results of the failed coros.
+    """
+    futures = [self.submit(coro) for coro in coros]
+    ret = []
+    for future in futures:
+      try:
+        ret += [future.result()]
+      except Exception as e:
+        ret += [e]
+    return ret
+
+
+  async def _request(self, model, n_tokens, coro_func):
+    """
+    Sends one request to <model> within its rate limits and returns the
+    response. Rate limited requests are retried with jittered exponential
+    backoff; once we run out of retries, the error is raised to the caller.
+    ARGS:
+      model: the model name (used to pick the rate limits)
+      n_tokens: the estimated number of tokens of the request
+      coro_func: a function that returns the request coroutine. We only
+                 create it once we hold a slot so that a request cancelled
+                 while waiting is never started.
+    """
+    priority_class = self.scheduler.get_priority()
+    if not self.backend.rate_limited: 
+      async with self.scheduler.slot(priority_class):
+        response = await asyncio.wait_for(coro_func(), self.timeout)
+      self._record_usage(model, response)
+      return response
+
+    for attempt in range(self.rate_limiter.max_retries + 1):
+      try:
+        async with self.scheduler.slot(priority_class):
+          # We only draw from the rate budget once we hold a slot, so that
+          # under a tight rate limit the budget goes to the requests that
+          # the scheduler let through first.
+          await self.rate_limiter.acquire(model, n_tokens)
+          response = await asyncio.wait_for(coro_func(), self.timeout)
+      except (openai.error.RateLimitError,
+              openai.error.ServiceUnavailableError) as e:
+        if attempt == self.rate_limiter.max_retries:
+          raise
+        backoff = self.rate_limiter.on_rate_limited(model, attempt)
+        print (f"Rate limited by {model} ({type(e).__name__}); "
+               f"retrying in {backoff:.1f}s")
+        await asyncio.sleep(backoff)
+        continue
+
+      self.rate_limiter.on_success(model)
+      if "usage" in response:
+        self.rate_limiter.record_usage(model, n_tokens,
+                                       response["usage"]["total_tokens"])
+      self._record_usage(model, response)
+      return response
+
+
+  def _record_usage(self, model, response):
+    if self.usage_callback and "usage" in response:
+      self.usage_callback(model, response["usage"])
+
+
+  async def chat_completion(self, model, prompt):
+    """
+    Sends <prompt> to the chat completion endpoint of <model> and returns
+    the str content of the response.
+    """
+    n_tokens = estimate_tokens(prompt) + 256
+    completion = await self._request(
+                   model, n_tokens, 
+                   lambda: self.backend.chat_completion(model, prompt))
+    return completion["choices"][0]["message"]["content"]
+
+
+  async def completion(self, prompt, gpt_parameter):
+    """
+    Sends <prompt> to the (legacy) completion endpoint with <gpt_parameter>
+    and returns the str text of the response.
+    """
+    n_tokens = estimate_tokens(prompt) + gpt_parameter["max_tokens"]
+    response = await self._request(
+                 gpt_parameter["engine"], n_tokens, 
+                 lambda: self.backend.completion(prompt, gpt_parameter))
+    return response["choices"][0]["text"]
+
+
+  async def chat_completion_stream(self, model, prompt, early_stop):
+    """
+    The streaming version of chat_completion. It reads the response as it
+    arrives, and stops reading (which closes the stream and thereby stops 
+    the generation) as soon as early_stop(<the text so far>) returns a 
+    response. Returns that response, or the whole text if the stream ends 
+    before. 
+    """
+    n_tokens = estimate_tokens(prompt) + 256
+    response = await self._request(
+                 model, n_tokens, 
+                 lambda: self._read_stream(
+                           prompt, 
+                           self.backend.chat_completion_stream(model, prompt),
+                           early_stop))
+    return response["choices"][0]["text"]
+
+
+  async def completion_stream(self, prompt, gpt_parameter, early_stop):
+    """
+    The streaming version of completion (see chat_completion_stream). 
+    """
+    n_tokens = estimate_tokens(prompt) + gpt_parameter["max_tokens"]
+    response = await self._request(
+                 gpt_parameter["engine"], n_tokens, 
+                 lambda: self._read_stream(
+                           prompt, 
+                           self.backend.completion_stream(prompt, 
+                                                          gpt_parameter),
+                           early_stop))
+    return response["choices"][0]["text"]
+
+
+  async def _read_stream(self, prompt, chunks, early_stop):
+    text = ""
+    n_chunks = 0
+    try:
+      async for chunk in chunks:
+        text += chunk
+        n_chunks += 1
+        response = early_stop(text)
+        if response is not None:
+          text = response
+          break
+    finally:
+      await chunks.aclose()
+
+    # Streamed responses do not report their token usage, so we estimate it
+    # (a chunk is about one token) for the rate limiter and prompt_stats.
+    prompt_tokens = estimate_tokens(prompt)
+    return {"choices": [{"index": 0, "text": text}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": n_chunks,
+                      "total_tokens": prompt_tokens + n_chunks}}
+
+
+  async def embedding(self, texts, model):
+    """
+    Embeds all of <texts> in one request and returns the list of their
+    embeddings in the same order.
+    """
+    n_tokens = sum([estimate_tokens(text) for text in texts])
+    response = await self._request(
+                 model, n_tokens, 
+                 lambda: self.backend.embedding(texts, model))
+    data = sorted(response["data"], key=lambda x: x["index"])
+    return [i["embedding"] for i in data]
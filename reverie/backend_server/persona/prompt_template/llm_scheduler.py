@@ -0,0 +1,201 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: llm_scheduler.py
+Description: A priority scheduler for the request slots of the LLM client.
+Not all requests are equally urgent: an utterance of a conversation holds up
+both personas in it, while a reflection or a revised identity can wait a
+little. Every request belongs to a priority class, and when a slot frees up,
+it goes to the waiting request of the most urgent class. So that the
+requests of the other classes are not starved under a tight rate limit,
+their priority goes up the longer they wait (aging).
+
+The class of a request is the one that is set with llm_priority(...) around
+it, or else the one of the prompt function that made it (see
+DEFAULT_PRIORITIES), or else "planning".
+"""
+import asyncio
+import contextlib
+import contextvars
+import time
+
+from persona.prompt_template.prompt_stats import *
+
+# The priority classes from the most to the least urgent.
+#   blocking: holds up the current step of several personas (conversations)
+#   planning: the plans and actions of the current step
+#   reflection: the background bookkeeping of a persona (poignancy,
+#               reflections, thoughts on a conversation, revised identity)
+#   analysis: the interviews and whispers of the "call -- analysis" and
+#             "call -- load history" commands
+PRIORITY_CLASSES = ["blocking", "planning", "reflection", "analysis"]
+DEFAULT_PRIORITY_CLASS = "planning"
+
+# The priority class of the prompt functions that are not "planning".
+DEFAULT_PRIORITIES = {
+  "run_gpt_prompt_decide_to_talk": "blocking",
+  "run_gpt_prompt_decide_to_react": "blocking",
+  "run_gpt_prompt_create_conversation": "blocking",
+  "run_gpt_prompt_summarize_conversation": "blocking",
+  "run_gpt_prompt_agent_chat_summarize_ideas": "blocking",
+  "run_gpt_prompt_agent_chat_summarize_relationship": "blocking",
+  "run_gpt_prompt_agent_chat": "blocking",
+  "run_gpt_generate_iterative_chat_utt": "blocking",
+  "run_gpt_prompt_event_poignancy": "reflection",
+  "run_gpt_prompt_thought_poignancy": "reflection",
+  "run_gpt_prompt_chat_poignancy": "reflection",
+  "run_gpt_prompt_poignancy_batch": "reflection",
+  "run_gpt_prompt_focal_pt": "reflection",
+  "run_gpt_prompt_insight_and_guidance": "reflection",
+  "run_gpt_prompt_planning_thought_on_convo": "reflection",
+  "run_gpt_prompt_memo_on_convo": "reflection",
+  "run_gpt_prompt_summarize_ideas": "analysis",
+  "run_gpt_prompt_generate_next_convo_line": "analysis",
+  "run_gpt_prompt_generate_whisper_inner_thought": "analysis",
+  "run_gpt_generate_safety_score": "analysis",
+}
+
+# <current_priority> is the priority class set by llm_priority(...) in the
+# current context, or None.
+current_priority = contextvars.ContextVar("current_priority", default=None)
+
+
+@contextlib.contextmanager
+def llm_priority(priority_class):
+  """
+  Sends all LLM requests made in the with block with <priority_class>,
+  regardless of the prompt functions that make them.
+  Ex: with llm_priority("reflection"):
+        run_reflect(persona)
+  """
+  if priority_class not in PRIORITY_CLASSES:
+    raise ValueError(f"Unknown LLM priority class: {priority_class}")
+  token = current_priority.set(priority_class)
+  try:
+    yield
+  finally:
+    current_priority.reset(token)
+
+
+class PriorityScheduler:
+  def __init__(self, max_concurrency=8, priorities=None, aging=10):
+    # <max_concurrency> is the number of slots, i.e., the max number of
+    # requests we have in flight at any given moment.
+    self.max_concurrency = max_concurrency
+    # <priorities> maps a prompt function name to its priority class.
+    self.priorities = dict(DEFAULT_PRIORITIES)
+    if priorities:
+      for function, priority_class in priorities.items():
+        if priority_class not in PRIORITY_CLASSES:
+          raise ValueError(f"Unknown LLM priority class for {function}: "
+                           f"{priority_class}")
+      self.priorities.update(priorities)
+    # <aging> is the number of seconds of waiting that make a request as
+    # urgent as a request of the next more urgent class.
+    self.aging = aging
+
+    self.in_flight = 0
+    # <waiters> is the list of [rank, enqueue time, sequence number, future,
+    # priority class] of the requests that wait for a slot. Everything here
+    # runs on the LLM client's event loop, so we need no lock.
+    self.waiters = []
+    self.sequence = 0
+
+    # Counters for the current process: priority class -> [requests,
+    # requests that waited, total wait time, max wait time]. <promotions>
+    # counts the slots that went to a request ahead of a more urgent one
+    # because it had waited long enough.
+    self.counters = {i: [0, 0, 0, 0] for i in PRIORITY_CLASSES}
+    self.promotions = 0
+
+
+  def get_priority(self):
+    """
+    Returns the priority class of a request made in the current context.
+    """
+    priority_class = current_priority.get()
+    if priority_class:
+      return priority_class
+    key = current_prompt.get()
+    if key:
+      return self.priorities.get(key[0], DEFAULT_PRIORITY_CLASS)
+    return DEFAULT_PRIORITY_CLASS
+
+
+  def _get_urgency(self, waiter, now):
+    # The lower, the more urgent.
+    rank, enqueued, sequence = waiter[:3]
+    return [rank - (now - enqueued) / self.aging, sequence]
+
+
+  async def acquire(self, priority_class):
+    start = time.perf_counter()
+    if self.in_flight < self.max_concurrency and not self.waiters:
+      self.in_flight += 1
+      self._count(priority_class, 0)
+      return
+
+    future = asyncio.get_running_loop().create_future()
+    self.sequence += 1
+    waiter = [PRIORITY_CLASSES.index(priority_class), time.perf_counter(),
+              self.sequence, future, priority_class]
+    self.waiters += [waiter]
+    try:
+      await future
+    except asyncio.CancelledError:
+      if future.done() and not future.cancelled():
+        # We were handed a slot just as we were cancelled, so we pass it on.
+        self.release()
+      else:
+        self.waiters.remove(waiter)
+      raise
+    self._count(priority_class, time.perf_counter() - start)
+
+
+  def release(self):
+    """
+    Hands the slot that is released to the most urgent waiting request, or
+    frees it if no request is waiting.
+    """
+    if not self.waiters:
+      self.in_flight -= 1
+      return
+
+    now = time.perf_counter()
+    waiter = min(self.waiters, key=lambda x: self._get_urgency(x, now))
+    if waiter[0] > min([i[0] for i in self.waiters]):
+      self.promotions += 1
+    self.waiters.remove(waiter)
+    # The slot passes to the waiter, so <in_flight> stays the same.
+    waiter[3].set_result(True)
+
+
+  @contextlib.asynccontextmanager
+  async def slot(self, priority_class):
+    await self.acquire(priority_class)
+    try:
+      yield
+    finally:
+      self.release()
+
+
+  def _count(self, priority_class, wait_time):
+    counter = self.counters[priority_class]
+    counter[0] += 1
+    if wait_time:
+      counter[1] += 1
+      counter[2] += wait_time
+      counter[3] = max(counter[3], wait_time)
+
+
+  def get_str_stats(self):
+    ret_str = (f"LLM scheduler: {self.in_flight}/{self.max_concurrency} "
+               f"slots in use, {len(self.waiters)} waiting, "
+               f"{self.promotions} promoted by aging\n")
+    for priority_class, counter in self.counters.items():
+      requests, waited, total_wait, max_wait = counter
+      mean_wait = total_wait / waited if waited else 0
+      ret_str += (f"{priority_class}: requests: {requests}, "
+                  f"waited: {waited}, mean wait: {mean_wait:.2f}s, "
+                  f"max wait: {max_wait:.2f}s\n")
+    return ret_str.strip()
@@ -0,0 +1,104 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: model_router.py
+Description: Routing of the run_gpt_prompt_* functions to model tiers. Every
+prompt function is pinned to a model in its gpt_param or request helper
+(e.g., text-davinci-003 or gpt-3.5-turbo). The routing table in a json config
+file can instead send a prompt function to a tier (e.g., cheap yes/no and
+rating prompts to a small, fast model), and lets the retries of a response
+that failed validation escalate to a stronger tier.
+
+The config file looks like this (see model_routing.json):
+  {"tiers": {"small": {"chat": "gpt-3.5-turbo",
+                       "completion": "text-davinci-002"},
+             "large": {"chat": "gpt-4", "completion": "text-davinci-003"}},
+   "escalation": ["small", "large"],
+   "escalate_after": 1,
+   "routes": {"run_gpt_prompt_event_poignancy": "small",
+              "run_gpt_prompt_agent_chat": "large"}}
+A tier maps the kind of request ("chat" or "completion") to the model that
+serves it; a tier without a model for a kind leaves those requests on the
+pinned model. Prompt functions without a route keep their pinned model.
+"""
+import json
+import os
+
+
+class ModelRouter:
+  def __init__(self, config_path=None):
+    # <config_path> is the json routing table. If it is None, nothing is
+    # routed and every prompt function keeps its pinned model.
+    self.config_path = config_path
+
+    # <tiers> maps a tier name to {"chat": <model>, "completion": <model>}.
+    self.tiers = dict()
+    # <escalation> is the list of tier names from the weakest to the
+    # strongest. A failed attempt moves up this list.
+    self.escalation = []
+    # The number of failed attempts on a tier before we move up a tier.
+    self.escalate_after = 1
+    # <routes> maps a prompt function name to its tier name.
+    self.routes = dict()
+
+    if config_path:
+      self.load(config_path)
+
+
+  def load(self, config_path):
+    if not os.path.exists(config_path):
+      raise ValueError(f"Model routing config not found: {config_path}")
+    with open(config_path) as json_file:
+      config = json.load(json_file)
+
+    self.tiers = config.get("tiers", dict())
+    self.escalation = config.get("escalation", list(self.tiers.keys()))
+    self.escalate_after = max(1, config.get("escalate_after", 1))
+    self.routes = config.get("routes", dict())
+    for function, tier in self.routes.items():
+      if tier not in self.tiers:
+        raise ValueError(f"Unknown model tier for {function}: {tier}")
+    for tier in self.escalation:
+      if tier not in self.tiers:
+        raise ValueError(f"Unknown model tier in escalation: {tier}")
+
+
+  def get_tier(self, function, attempt=0):
+    """
+    Returns the name of the tier that serves the <attempt>-th attempt (0 for
+    the first one) of the prompt function <function>, or None if the
+    function is not routed.
+    """
+    tier = self.routes.get(function)
+    if not tier or tier not in self.escalation:
+      return tier
+    index = self.escalation.index(tier) + attempt // self.escalate_after
+    return self.escalation[min(index, len(self.escalation) - 1)]
+
+
+  def get_model(self, function, kind, default_model, attempt=0):
+    """
+    Returns the model that the <attempt>-th attempt of <function> should use
+    for a request of <kind> ("chat" or "completion").
+
+    INPUT:
+      function: the run_gpt_prompt_* function name (or None outside of one)
+      kind: "chat" or "completion"
+      default_model: the model that the request is pinned to
+      attempt: the number of failed attempts before this one
+    OUTPUT:
+      a str model name
+    """
+    tier = self.get_tier(function, attempt)
+    if not tier:
+      return default_model
+    return self.tiers[tier].get(kind, default_model)
+
+
+  def get_str_routes(self):
+    ret_str = f"Model routing {self.config_path}\n"
+    ret_str += f"escalation: {' -> '.join(self.escalation)} "
+    ret_str += f"(after {self.escalate_after} failed attempt(s))\n"
+    for function, tier in self.routes.items():
+      ret_str += f"{function}: {tier} {self.tiers[tier]}\n"
+    return ret_str.strip()
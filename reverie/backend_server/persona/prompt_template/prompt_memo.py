@@ -0,0 +1,225 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: prompt_memo.py
+Description: A memo for the outputs of the prompt functions that depend on
+the action or object text rather than on who the persona is (e.g., the emoji
+for "sleeping", or the state of a bed that someone sleeps in). Each memoized
+prompt function declares which of its arguments make up the key, so that one
+output is shared by all personas of a simulation. The memo keeps the most
+recently used outputs in memory and persists them to disk so that other runs
+and forks of the simulation can reuse them as well. Both are bounded: once 
+the disk holds more than its max number of outputs, the least recently used
+ones are evicted.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PromptMemo:
+  def __init__(self, enabled=False, db_path=None, max_memory_items=5000,
+               namespace="", max_disk_items=100000):
+    # If <enabled> is False, memoized prompt functions are always called.
+    self.enabled = enabled
+    # <db_path> is the SQLite file that the outputs are persisted to. If it
+    # is None, the memo only lives in memory for the current process.
+    self.db_path = db_path
+    # <memory> is the in-memory LRU that maps a key to its output. The most
+    # recently used key is at the end.
+    self.memory = OrderedDict()
+    self.max_memory_items = max_memory_items
+    # <max_disk_items> is the max number of outputs in the SQLite file, 
+    # which all runs and forks share. <disk_items> is the current number. 
+    self.max_disk_items = max_disk_items
+    self.disk_items = 0
+    # <namespace> keeps the outputs of different LLM backends apart (e.g.,
+    # so that stub outputs never end up in a real simulation).
+    self.namespace = namespace
+    # <is_disk_enabled> is checked before every disk lookup. We turn the disk
+    # off while a tape is active (see gpt_structure.py), as the disk holds
+    # outputs that the recorded run may not have had.
+    self.is_disk_enabled = lambda: True
+
+    self.conn = None
+    self.lock = threading.Lock()
+
+    # Counters for the current process: function name -> [memory hits, disk
+    # hits, misses], and the number of outputs evicted from the disk.
+    self.counters = dict()
+    self.evictions = 0
+
+
+  def _connect(self):
+    if self.conn:
+      return self.conn
+
+    db_folder = os.path.dirname(self.db_path)
+    if db_folder and not os.path.exists(db_folder):
+      os.makedirs(db_folder)
+
+    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    self.conn.execute("""CREATE TABLE IF NOT EXISTS outputs (
+                           key TEXT PRIMARY KEY,
+                           function TEXT,
+                           memo_key TEXT,
+                           output TEXT,
+                           created REAL)""")
+    # Memo files from before the disk was bounded have no <last_access>.
+    columns = [i[1] for i in self.conn.execute("PRAGMA table_info(outputs)")]
+    if "last_access" not in columns:
+      self.conn.execute("ALTER TABLE outputs ADD COLUMN last_access REAL")
+      self.conn.execute("UPDATE outputs SET last_access = created")
+    self.conn.execute("""CREATE INDEX IF NOT EXISTS outputs_last_access
+                           ON outputs (last_access)""")
+    self.conn.commit()
+    self.disk_items = self.conn.execute(
+                        "SELECT COUNT(*) FROM outputs").fetchone()[0]
+    return self.conn
+
+
+  def make_key(self, function, key_values):
+    raw = json.dumps([self.namespace, function, key_values])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+  def _count(self, function, index):
+    if function not in self.counters:
+      self.counters[function] = [0, 0, 0]
+    self.counters[function][index] += 1
+
+
+  def _remember(self, key, output):
+    self.memory[key] = output
+    self.memory.move_to_end(key)
+    while len(self.memory) > self.max_memory_items:
+      self.memory.popitem(last=False)
+
+
+  def get(self, function, key_values):
+    """
+    Returns [True, output] if we have the output of <function> for
+    <key_values>, and [False, None] otherwise.
+    """
+    key = self.make_key(function, key_values)
+    with self.lock:
+      if key in self.memory:
+        self.memory.move_to_end(key)
+        self._count(function, 0)
+        return [True, self.memory[key]]
+
+      if self.db_path and self.is_disk_enabled():
+        conn = self._connect()
+        row = conn.execute("SELECT output FROM outputs WHERE key = ?",
+                           (key,)).fetchone()
+        if row:
+          conn.execute("UPDATE outputs SET last_access = ? WHERE key = ?",
+                       (time.time(), key))
+          conn.commit()
+          # json turns tuples (e.g., event triples) into lists, so we keep
+          # track of which outputs were tuples.
+          output, is_tuple = json.loads(row[0])
+          if is_tuple:
+            output = tuple(output)
+          self._remember(key, output)
+          self._count(function, 1)
+          return [True, output]
+
+      self._count(function, 2)
+    return [False, None]
+
+
+  def put(self, function, key_values, output):
+    """
+    Stores <output> as the output of <function> for <key_values>.
+    """
+    key = self.make_key(function, key_values)
+    with self.lock:
+      self._remember(key, output)
+      if self.db_path and self.is_disk_enabled():
+        conn = self._connect()
+        row = conn.execute("SELECT 1 FROM outputs WHERE key = ?",
+                           (key,)).fetchone()
+        now = time.time()
+        conn.execute("""INSERT OR REPLACE INTO outputs
+                        (key, function, memo_key, output, created, 
+                         last_access)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                     (key, function, json.dumps(key_values),
+                      json.dumps([output, type(output) == tuple]),
+                      now, now))
+        if not row:
+          self.disk_items += 1
+        if self.disk_items > self.max_disk_items:
+          self._evict(conn)
+        conn.commit()
+
+
+  def _evict(self, conn):
+    # We evict the least recently used outputs in chunks until we are back
+    # under 90% of the max (so we do not evict on every single put).
+    target_items = int(self.max_disk_items * 0.9)
+    while self.disk_items > target_items:
+      rows = conn.execute("""SELECT key FROM outputs
+                             ORDER BY last_access ASC LIMIT ?""",
+                          (min(100, self.disk_items - target_items),)
+                          ).fetchall()
+      if not rows:
+        self.disk_items = 0
+        break
+      for (key,) in rows:
+        conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+        self.disk_items -= 1
+        self.evictions += 1
+
+
+  def memoize(self, *key_args):
+    """
+    A decorator for the run_gpt_prompt_* functions whose output only depends
+    on some of their arguments. <key_args> are the names of those arguments,
+    e.g., @prompt_memo.memoize("act_game_object", "act_obj_desc").
+
+    On a hit, the decorated function returns (output, [output, None, None,
+    None, None]) without making any request. Fail safe outputs are never
+    memoized, so those are asked for again the next time around.
+    """
+    def decorator(func):
+      signature = inspect.signature(func)
+
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+        if not self.enabled:
+          return func(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        key_values = [bound.arguments.get(i) for i in key_args]
+        found, output = self.get(func.__name__, key_values)
+        if found:
+          return output, [output, None, None, None, None]
+
+        ret = func(*args, **kwargs)
+        if ret and ret[0] is not None and ret[0] != ret[1][4]:
+          self.put(func.__name__, key_values, ret[0])
+        return ret
+      return wrapper
+    return decorator
+
+
+  def get_str_stats(self):
+    ret_str = f"Prompt memo {self.db_path}\n"
+    with self.lock:
+      for function, (memory_hits, disk_hits, misses) in self.counters.items():
+        ret_str += (f"{function}: memory hits: {memory_hits}, "
+                    f"disk hits: {disk_hits}, misses: {misses}\n")
+      ret_str += f"in memory: {len(self.memory)}/{self.max_memory_items}"
+      if self.db_path:
+        self._connect()
+        ret_str += (f", on disk: {self.disk_items}/{self.max_disk_items}, "
+                    f"evictions: {self.evictions}")
+    return ret_str
@@ -0,0 +1,253 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: prompt_stats.py
+Description: Accounting of the LLM spend per prompt function. For every
+run_gpt_prompt_* function and every persona that calls it, we keep the number
+of calls, the number of requests actually sent, retries, validation failures
+(and their reasons), local repairs, prompt/completion tokens, wall time and 
+the estimated cost, so that we can see which prompts dominate the latency 
+and the bill of a simulation.
+
+The prompt function that is currently running is kept in a context variable.
+The LLM client carries it over to its event loop with each request, which is
+how the token usage reported by the backend ends up on the right row.
+"""
+import contextvars
+import csv
+import functools
+import json
+import os
+import threading
+import time
+
+# The estimated prices in USD per 1K tokens, as [prompt, completion]. These
+# can be overridden with <llm_prices> in utils.py.
+DEFAULT_MODEL_PRICES = {"gpt-3.5-turbo": [0.0015, 0.002],
+                        "gpt-4": [0.03, 0.06],
+                        "text-davinci-002": [0.02, 0.02],
+                        "text-davinci-003": [0.02, 0.02],
+                        "text-embedding-ada-002": [0.0001, 0]}
+
+# The row that requests made outside of any prompt function are accounted to
+# (e.g., the embeddings sent by the embedding batcher).
+OTHER_FUNCTION = "<other>"
+
+PROMPT_STATS_FIELDS = ["function", "persona", "calls", "requests", "retries",
+                       "validation_failures", "repairs", "prompt_tokens",
+                       "completion_tokens", "wall_time", "cost"]
+
+# <current_prompt> is the (function name, persona name) of the prompt
+# function that is running in the current context, or None.
+current_prompt = contextvars.ContextVar("current_prompt", default=None)
+
+
+def _get_persona_name(args):
+  # The persona is not always the first argument of a prompt function (e.g.,
+  # run_gpt_prompt_action_sector(action_description, persona, maze)), so we
+  # take the first argument that looks like one.
+  for arg in args:
+    if hasattr(arg, "scratch") and hasattr(arg.scratch, "name"):
+      return arg.scratch.name
+  return ""
+
+
+class PromptStats:
+  def __init__(self, model_prices=None):
+    self.model_prices = dict(DEFAULT_MODEL_PRICES)
+    if model_prices:
+      self.model_prices.update(model_prices)
+
+    # <rows> maps (function name, persona name) to a dictionary with the
+    # counters of PROMPT_STATS_FIELDS.
+    self.rows = dict()
+    # <failure_reasons> maps (function name, persona name) to a dictionary
+    # that counts the reasons of its validation failures.
+    self.failure_reasons = dict()
+    # Usage is recorded from the LLM client's thread as well as the main
+    # thread, so all updates go through a lock.
+    self.lock = threading.Lock()
+
+
+  def _get_row(self, function, persona):
+    if (function, persona) not in self.rows:
+      row = {field: 0 for field in PROMPT_STATS_FIELDS}
+      row["function"] = function
+      row["persona"] = persona
+      self.rows[(function, persona)] = row
+    return self.rows[(function, persona)]
+
+
+  def _add(self, field, amount=1):
+    key = current_prompt.get()
+    if not key:
+      key = (OTHER_FUNCTION, "")
+    with self.lock:
+      self._get_row(*key)[field] += amount
+
+
+  def track(self, func):
+    """
+    A decorator for the run_gpt_prompt_* functions. It sets the current
+    prompt for the duration of the call, and accounts the call and its wall
+    time to (function, persona).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      key = (func.__name__, _get_persona_name(args))
+      token = current_prompt.set(key)
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        wall_time = time.perf_counter() - start
+        current_prompt.reset(token)
+        with self.lock:
+          row = self._get_row(*key)
+          row["calls"] += 1
+          row["wall_time"] += wall_time
+    return wrapper
+
+
+  def record_usage(self, model, usage):
+    """
+    Accounts one request to <model> with the OpenAI style <usage> dictionary
+    of its response to the current prompt.
+    """
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    prices = self.model_prices.get(model, [0, 0])
+    cost = (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+    key = current_prompt.get()
+    if not key:
+      key = (OTHER_FUNCTION, "")
+    with self.lock:
+      row = self._get_row(*key)
+      row["requests"] += 1
+      row["prompt_tokens"] += prompt_tokens
+      row["completion_tokens"] += completion_tokens
+      row["cost"] += cost
+
+
+  def record_retry(self):
+    self._add("retries")
+
+
+  def record_validation_failure(self, reason=""):
+    self._add("validation_failures")
+    key = current_prompt.get()
+    if not key:
+      key = (OTHER_FUNCTION, "")
+    reason = reason if reason else "unknown"
+    with self.lock:
+      reasons = self.failure_reasons.setdefault(key, dict())
+      reasons[reason] = reasons.get(reason, 0) + 1
+
+
+  def record_repair(self):
+    self._add("repairs")
+
+
+  def pop_counters(self):
+    """
+    Returns [rows, failure reasons] and starts counting from zero again. A
+    worker process hands its counters to the main process this way (see 
+    persona_workers.py). 
+    """
+    with self.lock:
+      ret = [self.rows, self.failure_reasons]
+      self.rows = dict()
+      self.failure_reasons = dict()
+    return ret
+
+
+  def merge(self, rows, failure_reasons):
+    """
+    Adds the counters returned by pop_counters() of another process to ours.
+    """
+    with self.lock:
+      for key, other_row in rows.items():
+        row = self._get_row(*key)
+        for field in PROMPT_STATS_FIELDS[2:]:
+          row[field] += other_row[field]
+      for key, other_reasons in failure_reasons.items():
+        reasons = self.failure_reasons.setdefault(key, dict())
+        for reason, count in other_reasons.items():
+          reasons[reason] = reasons.get(reason, 0) + count
+
+
+  def get_rows(self):
+    """
+    Returns a copy of all rows, the most expensive (in wall time) first.
+    """
+    with self.lock:
+      rows = [dict(row) for row in self.rows.values()]
+    return sorted(rows, key=lambda x: x["wall_time"], reverse=True)
+
+
+  def get_failure_reasons(self):
+    """
+    Returns the validation failure reasons per function (over all personas),
+    as {function name: {reason: count}}.
+    """
+    ret = dict()
+    with self.lock:
+      for (function, persona), reasons in self.failure_reasons.items():
+        for reason, count in reasons.items():
+          ret.setdefault(function, dict())
+          ret[function][reason] = ret[function].get(reason, 0) + count
+    return ret
+
+
+  def get_str_failure_reasons(self):
+    ret_str = ""
+    for function, reasons in sorted(self.get_failure_reasons().items()):
+      ret_str += f"{function}\n"
+      for reason, count in sorted(reasons.items(), key=lambda x: -x[1]):
+        ret_str += f"  {count:>6}  {reason}\n"
+    return ret_str.strip()
+
+
+  def get_str_stats(self):
+    rows = self.get_rows()
+    ret_str = (f"{'function':<48} {'persona':<20} {'calls':>6} "
+               f"{'reqs':>6} {'retry':>6} {'fail':>6} {'fix':>6} "
+               f"{'p_tok':>9} {'c_tok':>8} {'time':>8} {'cost':>8}\n")
+    total = {field: 0 for field in PROMPT_STATS_FIELDS[2:]}
+    for row in rows:
+      ret_str += (f"{row['function']:<48} {row['persona']:<20} "
+                  f"{row['calls']:>6} {row['requests']:>6} "
+                  f"{row['retries']:>6} {row['validation_failures']:>6} "
+                  f"{row['repairs']:>6} "
+                  f"{row['prompt_tokens']:>9} {row['completion_tokens']:>8} "
+                  f"{row['wall_time']:>7.1f}s {row['cost']:>8.4f}\n")
+      for field in total:
+        total[field] += row[field]
+    ret_str += (f"{'total':<48} {'':<20} {total['calls']:>6} "
+                f"{total['requests']:>6} {total['retries']:>6} "
+                f"{total['validation_failures']:>6} {total['repairs']:>6} "
+                f"{total['prompt_tokens']:>9} {total['completion_tokens']:>8} "
+                f"{total['wall_time']:>7.1f}s {total['cost']:>8.4f}")
+    return ret_str
+
+
+  def save(self, folder):
+    """
+    Dumps all rows to prompt_stats.json and prompt_stats.csv, and the 
+    validation failure reasons to prompt_failures.json in <folder>.
+    """
+    rows = self.get_rows()
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+
+    with open(f"{folder}/prompt_stats.json", "w") as outfile:
+      outfile.write(json.dumps(rows, indent=2))
+
+    with open(f"{folder}/prompt_stats.csv", "w", newline="") as outfile:
+      writer = csv.DictWriter(outfile, fieldnames=PROMPT_STATS_FIELDS)
+      writer.writeheader()
+      writer.writerows(rows)
+
+    with open(f"{folder}/prompt_failures.json", "w") as outfile:
+      outfile.write(json.dumps(self.get_failure_reasons(), indent=2))
@@ -0,0 +1,192 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: rate_limiter.py
+Description: A shared, adaptive rate limiter for the OpenAI API. Every model
+gets a token bucket for requests per minute and another one for tokens per
+minute. When the server tells us that we are going too fast (429), we cut
+the rates of that model and back off with jittered exponential delays; as
+requests go through again, the rates slowly recover to their configured
+budgets.
+"""
+import asyncio
+import random
+import time
+
+# The default per-model budgets (requests per minute and tokens per minute).
+# These can be overridden with <llm_rate_limits> in utils.py.
+DEFAULT_RATE_LIMITS = {"gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+                       "gpt-4": {"rpm": 200, "tpm": 40000},
+                       "text-davinci-002": {"rpm": 3000, "tpm": 250000},
+                       "text-davinci-003": {"rpm": 3000, "tpm": 250000},
+                       "text-embedding-ada-002": {"rpm": 3000,
+                                                  "tpm": 1000000}}
+FALLBACK_RATE_LIMIT = {"rpm": 3000, "tpm": 250000}
+
+
+def estimate_tokens(text):
+  """
+  A rough estimate of the number of tokens in <text> (about four characters
+  per token for English text). This is only used to draw from the token
+  bucket before we know the actual usage of a request.
+  """
+  return len(text) // 4 + 1
+
+
+class TokenBucket:
+  def __init__(self, per_minute):
+    self.max_rate = per_minute / 60.0
+    self.rate = self.max_rate
+    self.capacity = per_minute
+    self.level = per_minute
+    self.last_refill = time.monotonic()
+
+
+  def _refill(self):
+    now = time.monotonic()
+    self.level = min(self.capacity,
+                     self.level + (now - self.last_refill) * self.rate)
+    self.last_refill = now
+
+
+  def wait_time(self, amount):
+    """
+    Returns the number of seconds until <amount> can be drawn (0 if it can
+    be drawn right now).
+    """
+    self._refill()
+    amount = min(amount, self.capacity)
+    if self.level >= amount:
+      return 0
+    return (amount - self.level) / self.rate
+
+
+  def draw(self, amount):
+    self._refill()
+    self.level = min(self.capacity, self.level - amount)
+
+
+class ModelRateLimiter:
+  def __init__(self, rpm, tpm):
+    self.requests = TokenBucket(rpm)
+    self.tokens = TokenBucket(tpm)
+    # We do not send anything for this model before <paused_until>.
+    self.paused_until = 0
+
+
+  async def acquire(self, n_tokens):
+    while True:
+      wait = max(self.paused_until - time.monotonic(),
+                 self.requests.wait_time(1),
+                 self.tokens.wait_time(n_tokens))
+      if wait <= 0:
+        break
+      await asyncio.sleep(wait)
+    self.requests.draw(1)
+    self.tokens.draw(n_tokens)
+
+
+  def on_rate_limited(self, backoff):
+    # Multiplicative decrease: the server told us that we are over budget.
+    for bucket in [self.requests, self.tokens]:
+      bucket.rate = max(bucket.max_rate * 0.05, bucket.rate * 0.7)
+    self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+
+
+  def on_success(self):
+    # Additive increase back towards the configured budgets.
+    for bucket in [self.requests, self.tokens]:
+      bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * 0.01)
+
+
+class RateLimiter:
+  def __init__(self, rate_limits=None, max_retries=6, base_delay=1,
+               max_delay=60):
+    # <rate_limits> maps a model name to {"rpm": <int>, "tpm": <int>}.
+    self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+    if rate_limits:
+      self.rate_limits.update(rate_limits)
+    # <max_retries> is the number of times we retry a rate limited request
+    # before giving up and raising the error to the caller.
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    # <shares> is the number of processes that share the budgets (see 
+    # split()). 
+    self.shares = 1
+
+    self.models = dict()
+    # The jitter comes from its own random generator so that it does not
+    # disturb the random state of the simulation.
+    self.rng = random.Random()
+
+    # Counters for the current process.
+    self.rate_limited_count = 0
+    self.total_backoff = 0
+
+
+  def split(self, n_shares):
+    """
+    Gives this process a 1/<n_shares> share of every budget, for when 
+    <n_shares> processes send requests with the same keys (e.g., the persona
+    workers in persona_workers.py). 
+    """
+    self.shares = n_shares
+    self.models = dict()
+
+
+  def get_model(self, model):
+    if model not in self.models:
+      limit = self.rate_limits.get(model, FALLBACK_RATE_LIMIT)
+      self.models[model] = ModelRateLimiter(limit["rpm"] / self.shares, 
+                                            limit["tpm"] / self.shares)
+    return self.models[model]
+
+
+  async def acquire(self, model, n_tokens):
+    """
+    Waits until a request with <n_tokens> estimated tokens can be sent to
+    <model> within its budgets, and draws from them.
+    """
+    await self.get_model(model).acquire(n_tokens)
+
+
+  def record_usage(self, model, estimated_tokens, used_tokens):
+    """
+    Corrects the token bucket of <model> once we know the actual number of
+    tokens a request used.
+    """
+    self.get_model(model).tokens.draw(used_tokens - estimated_tokens)
+
+
+  def backoff_delay(self, attempt):
+    """
+    Exponential backoff with full jitter for the <attempt>-th retry.
+    """
+    return self.rng.uniform(0, min(self.max_delay,
+                                   self.base_delay * 2 ** attempt))
+
+
+  def on_rate_limited(self, model, attempt):
+    """
+    Records a 429 for <model>, and returns the number of seconds we should
+    back off before the <attempt>-th retry.
+    """
+    backoff = self.backoff_delay(attempt)
+    self.get_model(model).on_rate_limited(backoff)
+    self.rate_limited_count += 1
+    self.total_backoff += backoff
+    return backoff
+
+
+  def on_success(self, model):
+    self.get_model(model).on_success()
+
+
+  def get_str_stats(self):
+    ret_str = (f"rate limited: {self.rate_limited_count} times, "
+               f"total backoff: {self.total_backoff:.1f}s\n")
+    for model, limiter in self.models.items():
+      ret_str += (f"{model}: {limiter.requests.rate * 60:.0f} rpm, "
+                  f"{limiter.tokens.rate * 60:.0f} tpm\n")
+    return ret_str.strip()
@@ -36,6 +36,7 @@ def get_random_alphanumeric(i=6, j=6):
 # CHAPTER 1: Run GPT Prompt
 ##############################################################################
 
+@prompt_stats.track
 def run_gpt_prompt_wake_up_hour(persona, test_input=None, verbose=False): 
   """
   Given the persona, returns an integer that indicates the hour when the 
@@ -59,7 +60,7 @@ def run_gpt_prompt_wake_up_hour(persona, test_input=None, verbose=False):
   
   def __func_validate(gpt_response, prompt=""): 
     try: __func_clean_up(gpt_response, prompt="")
-    except: return False
+    except: return ValidationFailure("not an hour followed by am")
     return True
 
   def get_fail_safe(): 
@@ -73,9 +74,12 @@ def run_gpt_prompt_wake_up_hour(persona, test_input=None, verbose=False):
   prompt_input = create_prompt_input(persona, test_input)
   prompt = generate_prompt(prompt_input, prompt_template)
   fail_safe = get_fail_safe()
+  # With streaming on, we stop reading once we have the hour (e.g., "6am").
+  early_stop = get_early_stop(r"(?i)^\s*\d{1,2}\s*am")
 
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   early_stop=early_stop)
   
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -84,6 +88,7 @@ def run_gpt_prompt_wake_up_hour(persona, test_input=None, verbose=False):
   return output, [output, prompt, gpt_param, prompt_input, fail_safe]
 
 
+@prompt_stats.track
 def run_gpt_prompt_daily_plan(persona, 
                               wake_up_hour, 
                               test_input=None, 
@@ -158,6 +163,7 @@ def run_gpt_prompt_daily_plan(persona,
   return output, [output, prompt, gpt_param, prompt_input, fail_safe]
 
 
+@prompt_stats.track
 def run_gpt_prompt_generate_hourly_schedule(persona, 
                                             curr_hour_str,
                                             p_f_ds_hourly_org, 
@@ -294,6 +300,107 @@ def run_gpt_prompt_generate_hourly_schedule(persona,
 
 
 
+@prompt_stats.track
+def run_gpt_prompt_generate_hourly_schedule_day(persona, 
+                                                wake_up_hour, 
+                                                hour_str, 
+                                                test_input=None, 
+                                                verbose=False): 
+  """
+  Generates the hourly schedule of the whole day in one structured call, 
+  instead of one run_gpt_prompt_generate_hourly_schedule call per waking 
+  hour. 
+  INPUT: 
+    persona: The Persona class instance 
+    wake_up_hour: Integer form of the wake up hour for the persona. 
+    hour_str: the list of the 24 hour strs of the day (e.g., "00:00 AM"). 
+  OUTPUT: 
+    the list of 24 activities, one for each hour in <hour_str> (e.g., 
+    "sleeping", "eating breakfast", ...), or False if the response did not 
+    cover every hour or was not diverse enough. 
+  """
+  def create_prompt_input(persona, wake_up_hour, hour_str, test_input=None): 
+    if test_input: return test_input
+    daily_req_str = ""
+    for count, i in enumerate(persona.scratch.daily_req): 
+      daily_req_str += f"{str(count+1)}) {i}, "
+    daily_req_str = daily_req_str[:-2]
+
+    schedule_format = "{\n"
+    for i in hour_str: 
+      schedule_format += f'"{i}": "<activity>",\n'
+    schedule_format = schedule_format[:-2] + "\n}"
+
+    prompt_input = []
+    prompt_input += [persona.scratch.get_str_iss()]
+    prompt_input += [persona.scratch.get_str_firstname()]
+    prompt_input += [persona.scratch.get_str_curr_date_str()]
+    prompt_input += [daily_req_str]
+    prompt_input += [hour_str[wake_up_hour % 24]]
+    prompt_input += [schedule_format]
+    return prompt_input
+
+  def __chat_func_clean_up(gpt_response, prompt=""): 
+    gpt_response = gpt_response[gpt_response.find("{"):
+                                gpt_response.rfind("}") + 1]
+    schedule = json.loads(gpt_response)
+    first_name = persona.scratch.get_str_firstname()
+
+    activities = []
+    for count, curr_hour_str in enumerate(hour_str): 
+      if count < wake_up_hour: 
+        activities += ["sleeping"]
+        continue
+      activity = schedule[curr_hour_str].strip()
+      if activity[-1] == ".": 
+        activity = activity[:-1]
+      if activity.startswith(f"{first_name} is "): 
+        activity = activity[len(f"{first_name} is "):]
+      activities += [activity.strip()]
+    return activities
+
+  def __chat_func_validate(gpt_response, prompt=""): 
+    # The local checks that replace the per-hour prompts: every hour of the 
+    # day is covered with an activity, and the day has at least five 
+    # different activities (the same bar as the diversity loop in 
+    # generate_hourly_schedule). 
+    try: 
+      activities = __chat_func_clean_up(gpt_response, prompt)
+      if len(activities) != len(hour_str): 
+        return ValidationFailure(f"not one activity for each of the "
+                                 f"{len(hour_str)} hours")
+      for i in activities: 
+        if type(i) != str or not i: 
+          return ValidationFailure("an hour without an activity")
+      if len(set(activities)) < 5: 
+        return ValidationFailure("fewer than 5 different activities")
+    except: 
+      return ValidationFailure("not a json dict with an activity for "
+                               "every hour")
+    return True
+
+  def get_fail_safe(): 
+    return False
+
+  gpt_param = {"engine": "text-davinci-003", "max_tokens": 600, 
+               "temperature": 0.5, "top_p": 1, "stream": False,
+               "frequency_penalty": 0, "presence_penalty": 0, "stop": None}
+  prompt_template = "persona/prompt_template/v3_ChatGPT/generate_hourly_schedule_day_v1.txt"
+  prompt_input = create_prompt_input(persona, wake_up_hour, hour_str, 
+                                     test_input)
+  prompt = generate_prompt(prompt_input, prompt_template)
+  fail_safe = get_fail_safe()
+  output = ChatGPT_safe_generate_response_OLD(prompt, 3, fail_safe,
+                        __chat_func_validate, __chat_func_clean_up, verbose)
+
+  if debug or verbose: 
+    print_run_prompts(prompt_template, persona, gpt_param, 
+                      prompt_input, prompt, output)
+
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+
+
+@prompt_stats.track
 def run_gpt_prompt_task_decomp(persona, 
                                task, 
                                duration, 
@@ -437,7 +544,8 @@ def run_gpt_prompt_task_decomp(persona,
   print ("?????")
   print (prompt)
   output = safe_generate_response(prompt, gpt_param, 5, get_fail_safe(),
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up, 
+                                   n_candidates=llm_n_candidates)
 
   # TODO THERE WAS A BUG HERE... 
   # This is for preventing overflows...
@@ -490,6 +598,7 @@ def run_gpt_prompt_task_decomp(persona,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_action_sector(action_description, 
                                 persona, 
                                 maze, 
@@ -558,11 +667,11 @@ def run_gpt_prompt_action_sector(action_description,
 
   def __func_validate(gpt_response, prompt=""): 
     if len(gpt_response.strip()) < 1: 
-      return False
+      return ValidationFailure("empty answer")
     if "}" not in gpt_response:
-      return False
+      return ValidationFailure("the answer does not end with }")
     if "," in gpt_response: 
-      return False
+      return ValidationFailure("more than one of the options")
     return True
   
   def get_fail_safe(): 
@@ -628,6 +737,7 @@ def run_gpt_prompt_action_sector(action_description,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_action_arena(action_description, 
                                 persona, 
                                 maze, act_world, act_sector,
@@ -688,11 +798,11 @@ def run_gpt_prompt_action_arena(action_description,
 
   def __func_validate(gpt_response, prompt=""): 
     if len(gpt_response.strip()) < 1: 
-      return False
+      return ValidationFailure("empty answer")
     if "}" not in gpt_response:
-      return False
+      return ValidationFailure("the answer does not end with }")
     if "," in gpt_response: 
-      return False
+      return ValidationFailure("more than one of the options")
     return True
   
   def get_fail_safe(): 
@@ -723,6 +833,7 @@ def run_gpt_prompt_action_arena(action_description,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_action_game_object(action_description, 
                                       persona, 
                                       maze,
@@ -744,7 +855,7 @@ def run_gpt_prompt_action_game_object(action_description,
   
   def __func_validate(gpt_response, prompt=""): 
     if len(gpt_response.strip()) < 1: 
-      return False
+      return ValidationFailure("empty answer")
     return True
 
   def __func_clean_up(gpt_response, prompt=""):
@@ -782,6 +893,8 @@ def run_gpt_prompt_action_game_object(action_description,
 
 
 
+@prompt_stats.track
+@prompt_memo.memoize("action_description")
 def run_gpt_prompt_pronunciatio(action_description, persona, verbose=False): 
   def create_prompt_input(action_description): 
     if "(" in action_description: 
@@ -799,7 +912,7 @@ def run_gpt_prompt_pronunciatio(action_description, persona, verbose=False):
     try: 
       __func_clean_up(gpt_response, prompt="")
       if len(gpt_response) == 0: 
-        return False
+        return ValidationFailure("empty answer")
     except: return False
     return True 
 
@@ -819,7 +932,7 @@ def run_gpt_prompt_pronunciatio(action_description, persona, verbose=False):
     try: 
       __func_clean_up(gpt_response, prompt="")
       if len(gpt_response) == 0: 
-        return False
+        return ValidationFailure("empty answer")
     except: return False
     return True 
     return True
@@ -873,6 +986,7 @@ def run_gpt_prompt_pronunciatio(action_description, persona, verbose=False):
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_event_triple(action_description, persona, verbose=False): 
   def create_prompt_input(action_description, persona): 
     if "(" in action_description: 
@@ -891,7 +1005,8 @@ def run_gpt_prompt_event_triple(action_description, persona, verbose=False):
     try: 
       gpt_response = __func_clean_up(gpt_response, prompt="")
       if len(gpt_response) != 2: 
-        return False
+        return ValidationFailure("not a predicate and an object separated "
+                                 "by a comma")
     except: return False
     return True 
 
@@ -962,6 +1077,8 @@ def run_gpt_prompt_event_triple(action_description, persona, verbose=False):
 
 
 
+@prompt_stats.track
+@prompt_memo.memoize("act_game_object", "act_desp")
 def run_gpt_prompt_act_obj_desc(act_game_object, act_desp, persona, verbose=False): 
   def create_prompt_input(act_game_object, act_desp, persona): 
     prompt_input = [act_game_object, 
@@ -1042,6 +1159,8 @@ def run_gpt_prompt_act_obj_desc(act_game_object, act_desp, persona, verbose=Fals
 
 
 
+@prompt_stats.track
+@prompt_memo.memoize("act_game_object", "act_obj_desc")
 def run_gpt_prompt_act_obj_event_triple(act_game_object, act_obj_desc, persona, verbose=False): 
   def create_prompt_input(act_game_object, act_obj_desc): 
     prompt_input = [act_game_object, 
@@ -1058,7 +1177,8 @@ def run_gpt_prompt_act_obj_event_triple(act_game_object, act_obj_desc, persona,
     try: 
       gpt_response = __func_clean_up(gpt_response, prompt="")
       if len(gpt_response) != 2: 
-        return False
+        return ValidationFailure("not a predicate and an object separated "
+                                 "by a comma")
     except: return False
     return True 
 
@@ -1087,6 +1207,171 @@ def run_gpt_prompt_act_obj_event_triple(act_game_object, act_obj_desc, persona,
 
 
 
+@prompt_stats.track
+def run_gpt_prompt_action_resolution(action_description, 
+                                     persona, 
+                                     maze, 
+                                     test_input=None, 
+                                     verbose=False): 
+  """
+  Resolves the whole target address (sector, arena and game object) of an
+  action together with its emoji and event triple, and the state, emoji and
+  event triple of the game object, in one structured call. This replaces the
+  eight calls that _determine_action otherwise makes one after the other. 
+
+  The address is checked against the persona's spatial memory, and every 
+  field that does not check out is returned as None so that the caller can 
+  fall back to the dedicated prompt for just that field. 
+  """
+  def get_accessible_places(persona, act_world): 
+    # The same filters as in run_gpt_prompt_action_sector and 
+    # run_gpt_prompt_action_arena: we do not send the persona into other 
+    # people's houses or rooms. 
+    places = dict()
+    for sector in persona.s_mem.get_str_accessible_sectors(act_world).split(", "): 
+      if not sector or ("'s house" in sector 
+                        and persona.scratch.last_name not in sector): 
+        continue
+      places[sector] = dict()
+      x = f"{act_world}:{sector}"
+      for arena in persona.s_mem.get_str_accessible_sector_arenas(x).split(", "): 
+        if not arena or ("'s room" in arena 
+                         and persona.scratch.last_name not in arena): 
+          continue
+        x = f"{act_world}:{sector}:{arena}"
+        game_objects = persona.s_mem.get_str_accessible_arena_game_objects(x)
+        places[sector][arena] = [i.strip() for i in game_objects.split(",") 
+                                 if i.strip()]
+    return places
+
+  def create_prompt_input(action_description, persona, maze, places, 
+                          test_input=None): 
+    act_world = f"{maze.access_tile(persona.scratch.curr_tile)['world']}"
+    living_sector = persona.scratch.living_area.split(":")[1]
+    curr_sector = f"{maze.access_tile(persona.scratch.curr_tile)['sector']}"
+
+    prompt_input = []
+    prompt_input += [persona.scratch.get_str_name()]
+    prompt_input += [living_sector]
+    x = f"{act_world}:{living_sector}"
+    prompt_input += [persona.s_mem.get_str_accessible_sector_arenas(x)]
+    prompt_input += [curr_sector]
+    x = f"{act_world}:{curr_sector}"
+    prompt_input += [persona.s_mem.get_str_accessible_sector_arenas(x)]
+
+    if persona.scratch.get_str_daily_plan_req() != "": 
+      prompt_input += [f"\n{persona.scratch.get_str_daily_plan_req()}"]
+    else: 
+      prompt_input += [""]
+
+    places_str = ""
+    for sector, arenas in places.items(): 
+      for arena, game_objects in arenas.items(): 
+        places_str += f"{sector} > {arena}: {', '.join(game_objects)}\n"
+    prompt_input += [places_str.strip()]
+
+    action_description_1 = action_description
+    action_description_2 = action_description
+    if "(" in action_description: 
+      action_description_1 = action_description.split("(")[0].strip()
+      action_description_2 = action_description.split("(")[-1][:-1]
+    prompt_input += [action_description_1]
+    prompt_input += [action_description_2]
+    return prompt_input
+
+  def __chat_func_clean_up(gpt_response, prompt=""): 
+    gpt_response = gpt_response[gpt_response.find("{"):
+                                gpt_response.rfind("}") + 1]
+    return json.loads(gpt_response)
+
+  def __chat_func_validate(gpt_response, prompt=""): 
+    try: 
+      if type(__chat_func_clean_up(gpt_response, prompt="")) != dict: 
+        return ValidationFailure("not a json dict")
+    except: 
+      return ValidationFailure("not a json dict")
+    return True
+
+  def get_fail_safe(): 
+    return dict()
+
+  def get_str_field(resolved, key): 
+    val = resolved.get(key)
+    if type(val) != str or not val.strip(): 
+      return None
+    return val.strip()
+
+  def get_pair_field(resolved, key): 
+    val = resolved.get(key)
+    if type(val) != list or len(val) != 2: 
+      return None
+    val = [str(i).strip() for i in val]
+    if not val[0] or not val[1]: 
+      return None
+    return val
+
+  act_world = f"{maze.access_tile(persona.scratch.curr_tile)['world']}"
+  places = get_accessible_places(persona, act_world)
+
+  prompt_template = "persona/prompt_template/v3_ChatGPT/action_resolution_v1.txt"
+  prompt_input = create_prompt_input(action_description, persona, maze, 
+                                     places, test_input)
+  prompt = generate_prompt(prompt_input, prompt_template)
+  fail_safe = get_fail_safe()
+  resolved = ChatGPT_safe_generate_response_OLD(prompt, 3, fail_safe,
+                        __chat_func_validate, __chat_func_clean_up, verbose)
+
+  # Every field is checked on its own. The address fields depend on each 
+  # other (an arena is only valid within its sector), and so do the object 
+  # fields on the game object. 
+  output = {"act_sector": None, "act_arena": None, "act_game_object": None, 
+            "act_pron": None, "act_event": None, "act_obj_desp": None, 
+            "act_obj_pron": None, "act_obj_event": None}
+
+  act_sector = get_str_field(resolved, "area")
+  if act_sector in places: 
+    output["act_sector"] = act_sector
+    act_arena = get_str_field(resolved, "room")
+    if act_arena in places[act_sector]: 
+      output["act_arena"] = act_arena
+      act_game_object = get_str_field(resolved, "object")
+      if not places[act_sector][act_arena]: 
+        output["act_game_object"] = "<random>"
+      elif act_game_object in places[act_sector][act_arena]: 
+        output["act_game_object"] = act_game_object
+
+  act_pron = get_str_field(resolved, "emoji")
+  if act_pron: 
+    output["act_pron"] = act_pron[:3]
+  act_event = get_pair_field(resolved, "event")
+  if act_event: 
+    output["act_event"] = (persona.name, act_event[0], act_event[1])
+
+  if output["act_game_object"]: 
+    act_obj_desp = get_str_field(resolved, "object state")
+    if act_obj_desp: 
+      if act_obj_desp[-1] == ".": act_obj_desp = act_obj_desp[:-1]
+      output["act_obj_desp"] = act_obj_desp
+      act_obj_pron = get_str_field(resolved, "object emoji")
+      if act_obj_pron: 
+        output["act_obj_pron"] = act_obj_pron[:3]
+      act_obj_event = get_pair_field(resolved, "object event")
+      if act_obj_event: 
+        output["act_obj_event"] = (output["act_game_object"], 
+                                   act_obj_event[0], act_obj_event[1])
+
+  gpt_param = {"engine": "gpt-3.5-turbo", "max_tokens": 200, 
+               "temperature": 0, "top_p": 1, "stream": False,
+               "frequency_penalty": 0, "presence_penalty": 0, "stop": None}
+
+  if debug or verbose: 
+    print_run_prompts(prompt_template, persona, gpt_param, 
+                      prompt_input, prompt, output)
+
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+
+
+@prompt_stats.track
 def run_gpt_prompt_new_decomp_schedule(persona, 
                                        main_act_dur, 
                                        truncated_act_dur, 
@@ -1166,15 +1451,16 @@ def run_gpt_prompt_new_decomp_schedule(persona,
       for act, dur in gpt_response: 
         dur_sum += dur
         if str(type(act)) != "<class 'str'>":
-          return False 
+          return ValidationFailure("an activity that is not text") 
         if str(type(dur)) != "<class 'int'>":
-          return False
+          return ValidationFailure("a duration that is not whole minutes")
       x = prompt.split("\n")[0].split("originally planned schedule from")[-1].strip()[:-1]
       x = [datetime.datetime.strptime(i.strip(), "%H:%M %p") for i in x.split(" to ")]
       delta_min = int((x[1] - x[0]).total_seconds()/60)
 
       if int(dur_sum) != int(delta_min): 
-        return False
+        return ValidationFailure(f"the durations do not add up to "
+                                 f"{delta_min} minutes")
 
     except: 
       return False
@@ -1221,7 +1507,8 @@ def run_gpt_prompt_new_decomp_schedule(persona,
   prompt = generate_prompt(prompt_input, prompt_template)
   fail_safe = get_fail_safe(main_act_dur, truncated_act_dur)
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up, 
+                                   n_candidates=llm_n_candidates)
   
   # print ("* * * * output")
   # print (output)
@@ -1241,6 +1528,7 @@ def run_gpt_prompt_new_decomp_schedule(persona,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_decide_to_talk(persona, target_persona, retrieved,test_input=None, 
                                        verbose=False): 
   def create_prompt_input(init_persona, target_persona, retrieved, 
@@ -1307,7 +1595,7 @@ def run_gpt_prompt_decide_to_talk(persona, target_persona, retrieved,test_input=
     try: 
       if gpt_response.split("Answer in yes or no:")[-1].strip().lower() in ["yes", "no"]: 
         return True
-      return False     
+      return ValidationFailure("not yes or no")
     except:
       return False 
 
@@ -1329,8 +1617,11 @@ def run_gpt_prompt_decide_to_talk(persona, target_persona, retrieved,test_input=
   prompt = generate_prompt(prompt_input, prompt_template)
 
   fail_safe = get_fail_safe()
+  # With streaming on, we stop reading once the yes or no is complete. 
+  early_stop = get_early_stop(r"(?i)^\s*(yes|no)(?=\W)")
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   early_stop=early_stop)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -1341,6 +1632,7 @@ def run_gpt_prompt_decide_to_talk(persona, target_persona, retrieved,test_input=
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_decide_to_react(persona, target_persona, retrieved,test_input=None, 
                                        verbose=False): 
   def create_prompt_input(init_persona, target_persona, retrieved, 
@@ -1406,7 +1698,7 @@ def run_gpt_prompt_decide_to_react(persona, target_persona, retrieved,test_input
     try: 
       if gpt_response.split("Answer: Option")[-1].strip().lower() in ["3", "2", "1"]: 
         return True
-      return False     
+      return ValidationFailure("not option 1, 2 or 3")
     except:
       return False 
 
@@ -1452,6 +1744,7 @@ def run_gpt_prompt_decide_to_react(persona, target_persona, retrieved,test_input
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_create_conversation(persona, target_persona, curr_loc,
                                        test_input=None, verbose=False): 
   def create_prompt_input(init_persona, target_persona, curr_loc, 
@@ -1588,6 +1881,7 @@ def run_gpt_prompt_create_conversation(persona, target_persona, curr_loc,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_summarize_conversation(persona, conversation, test_input=None, verbose=False): 
   def create_prompt_input(conversation, test_input=None): 
     convo_str = ""
@@ -1662,6 +1956,7 @@ def run_gpt_prompt_summarize_conversation(persona, conversation, test_input=None
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_extract_keywords(persona, description, test_input=None, verbose=False): 
   def create_prompt_input(description, test_input=None): 
     if "\n" in description: 
@@ -1722,6 +2017,7 @@ def run_gpt_prompt_extract_keywords(persona, description, test_input=None, verbo
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_keyword_to_thoughts(persona, keyword, concept_summary, test_input=None, verbose=False): 
   def create_prompt_input(persona, keyword, concept_summary, test_input=None): 
     prompt_input = [keyword, concept_summary, persona.name]
@@ -1766,6 +2062,7 @@ def run_gpt_prompt_keyword_to_thoughts(persona, keyword, concept_summary, test_i
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_convo_to_thoughts(persona, 
                                     init_persona_name,  
                                     target_persona_name,
@@ -1842,6 +2139,7 @@ def run_gpt_prompt_convo_to_thoughts(persona,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_event_poignancy(persona, event_description, test_input=None, verbose=False): 
   def create_prompt_input(persona, event_description, test_input=None): 
     prompt_input = [persona.scratch.name,
@@ -1876,7 +2174,7 @@ def run_gpt_prompt_event_poignancy(persona, event_description, test_input=None,
       __func_clean_up(gpt_response, prompt)
       return True
     except:
-      return False 
+      return ValidationFailure("not an integer")
 
   print ("asdhfapsh8p9hfaiafdsi;ldfj as DEBUG 7") ########
   gpt_param = {"engine": "text-davinci-002", "max_tokens": 15, 
@@ -1889,7 +2187,8 @@ def run_gpt_prompt_event_poignancy(persona, event_description, test_input=None,
   special_instruction = "The output should ONLY contain ONE integer value on the scale of 1 to 10." ########
   fail_safe = get_fail_safe() ########
   output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 3, fail_safe,
-                                          __chat_func_validate, __chat_func_clean_up, True)
+                                          __chat_func_validate, __chat_func_clean_up, True,
+                                          early_stop=JSON_OUTPUT_EARLY_STOP)
   if output != False: 
     return output, [output, prompt, gpt_param, prompt_input, fail_safe]
   # ChatGPT Plugin ===========================================================
@@ -1915,6 +2214,7 @@ def run_gpt_prompt_event_poignancy(persona, event_description, test_input=None,
   # return output, [output, prompt, gpt_param, prompt_input, fail_safe]
 
 
+@prompt_stats.track
 def run_gpt_prompt_thought_poignancy(persona, event_description, test_input=None, verbose=False): 
   def create_prompt_input(persona, event_description, test_input=None): 
     prompt_input = [persona.scratch.name,
@@ -1947,7 +2247,7 @@ def run_gpt_prompt_thought_poignancy(persona, event_description, test_input=None
       __func_clean_up(gpt_response, prompt)
       return True
     except:
-      return False 
+      return ValidationFailure("not an integer")
 
   print ("asdhfapsh8p9hfaiafdsi;ldfj as DEBUG 8") ########
   gpt_param = {"engine": "text-davinci-002", "max_tokens": 15, 
@@ -1960,7 +2260,8 @@ def run_gpt_prompt_thought_poignancy(persona, event_description, test_input=None
   special_instruction = "The output should ONLY contain ONE integer value on the scale of 1 to 10." ########
   fail_safe = get_fail_safe() ########
   output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 3, fail_safe,
-                                          __chat_func_validate, __chat_func_clean_up, True)
+                                          __chat_func_validate, __chat_func_clean_up, True,
+                                          early_stop=JSON_OUTPUT_EARLY_STOP)
   if output != False: 
     return output, [output, prompt, gpt_param, prompt_input, fail_safe]
   # ChatGPT Plugin ===========================================================
@@ -1986,6 +2287,7 @@ def run_gpt_prompt_thought_poignancy(persona, event_description, test_input=None
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_chat_poignancy(persona, event_description, test_input=None, verbose=False): 
   def create_prompt_input(persona, event_description, test_input=None): 
     prompt_input = [persona.scratch.name,
@@ -2019,7 +2321,7 @@ def run_gpt_prompt_chat_poignancy(persona, event_description, test_input=None, v
       __func_clean_up(gpt_response, prompt)
       return True
     except:
-      return False 
+      return ValidationFailure("not an integer")
 
   print ("asdhfapsh8p9hfaiafdsi;ldfj as DEBUG 9") ########
   gpt_param = {"engine": "text-davinci-002", "max_tokens": 15, 
@@ -2032,7 +2334,8 @@ def run_gpt_prompt_chat_poignancy(persona, event_description, test_input=None, v
   special_instruction = "The output should ONLY contain ONE integer value on the scale of 1 to 10." ########
   fail_safe = get_fail_safe() ########
   output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 3, fail_safe,
-                                          __chat_func_validate, __chat_func_clean_up, True)
+                                          __chat_func_validate, __chat_func_clean_up, True,
+                                          early_stop=JSON_OUTPUT_EARLY_STOP)
   if output != False: 
     return output, [output, prompt, gpt_param, prompt_input, fail_safe]
   # ChatGPT Plugin ===========================================================
@@ -2061,6 +2364,73 @@ def run_gpt_prompt_chat_poignancy(persona, event_description, test_input=None, v
 
 
 
+@prompt_stats.track
+def run_gpt_prompt_poignancy_batch(persona_events, test_input=None, verbose=False): 
+  """
+  Rates the poignancy of many events and conversations, possibly perceived 
+  by different personas, in one prompt. 
+  INPUT: 
+    persona_events: a list of [persona, [[event_type, description], ...]] 
+                    where event_type is "event" or "chat". 
+  OUTPUT: 
+    the list of int scores, in the order of <persona_events> and their 
+    events, or False if the response could not be parsed. 
+  """
+  def create_prompt_input(persona_events, test_input=None): 
+    persona_events_str = ""
+    count = 0
+    for persona, events in persona_events: 
+      persona_events_str += f"Here is a brief description of {persona.scratch.name}.\n"
+      persona_events_str += f"{persona.scratch.get_str_iss()}\n"
+      persona_events_str += f"What {persona.scratch.name} perceived:\n"
+      for event_type, description in events: 
+        count += 1
+        if event_type == "chat": 
+          persona_events_str += f"{count}. Conversation: {description}\n"
+        else: 
+          persona_events_str += f"{count}. Event: {description}\n"
+      persona_events_str += "---\n"
+    return [persona_events_str.strip(), str(count)]
+
+  def __chat_func_clean_up(gpt_response, prompt=""): 
+    if type(gpt_response) == str: 
+      gpt_response = json.loads(gpt_response)
+    return [int(i) for i in gpt_response]
+
+  def __chat_func_validate(gpt_response, prompt=""): 
+    try: 
+      scores = __chat_func_clean_up(gpt_response, prompt)
+      if len(scores) != n_events: 
+        return ValidationFailure(f"not {n_events} scores")
+    except: 
+      return ValidationFailure("not a json list of integers")
+    return True
+
+  def get_fail_safe(): 
+    return False
+
+  n_events = sum([len(events) for persona, events in persona_events])
+
+  gpt_param = {"engine": "text-davinci-002", "max_tokens": 15, 
+               "temperature": 0, "top_p": 1, "stream": False,
+               "frequency_penalty": 0, "presence_penalty": 0, "stop": None}
+  prompt_template = "persona/prompt_template/v3_ChatGPT/poignancy_batch_v1.txt"
+  prompt_input = create_prompt_input(persona_events)
+  prompt = generate_prompt(prompt_input, prompt_template)
+  example_output = "[5, 2, 8]"
+  special_instruction = f"The output should ONLY contain a list of {n_events} integer values on the scale of 1 to 10, one for each numbered item in order."
+  fail_safe = get_fail_safe()
+  output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 3, fail_safe,
+                                          __chat_func_validate, __chat_func_clean_up, verbose)
+
+  if debug or verbose: 
+    print_run_prompts(prompt_template, persona_events[0][0], gpt_param, 
+                      prompt_input, prompt, output)
+
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+
+
+@prompt_stats.track
 def run_gpt_prompt_focal_pt(persona, statements, n, test_input=None, verbose=False): 
   def create_prompt_input(persona, statements, n, test_input=None): 
     prompt_input = [statements, str(n)]
@@ -2139,6 +2509,7 @@ def run_gpt_prompt_focal_pt(persona, statements, n, test_input=None, verbose=Fal
 
 
   
+@prompt_stats.track
 def run_gpt_prompt_insight_and_guidance(persona, statements, n, test_input=None, verbose=False): 
   def create_prompt_input(persona, statements, n, test_input=None): 
     prompt_input = [statements, str(n)]
@@ -2193,6 +2564,7 @@ def run_gpt_prompt_insight_and_guidance(persona, statements, n, test_input=None,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_agent_chat_summarize_ideas(persona, target_persona, statements, curr_context, test_input=None, verbose=False): 
   def create_prompt_input(persona, target_persona, statements, curr_context, test_input=None): 
     prompt_input = [persona.scratch.get_str_curr_date_str(), curr_context, persona.scratch.currently, 
@@ -2262,6 +2634,7 @@ def run_gpt_prompt_agent_chat_summarize_ideas(persona, target_persona, statement
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_agent_chat_summarize_relationship(persona, target_persona, statements, test_input=None, verbose=False): 
   def create_prompt_input(persona, target_persona, statements, test_input=None): 
     prompt_input = [statements, persona.scratch.name, target_persona.scratch.name]
@@ -2330,6 +2703,7 @@ def run_gpt_prompt_agent_chat_summarize_relationship(persona, target_persona, st
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_agent_chat(maze, persona, target_persona,
                                curr_context, 
                                init_summ_idea, 
@@ -2471,6 +2845,7 @@ def run_gpt_prompt_agent_chat(maze, persona, target_persona,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_summarize_ideas(persona, statements, question, test_input=None, verbose=False): 
   def create_prompt_input(persona, statements, question, test_input=None): 
     prompt_input = [statements, persona.scratch.name, question]
@@ -2537,6 +2912,7 @@ def run_gpt_prompt_summarize_ideas(persona, statements, question, test_input=Non
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_generate_next_convo_line(persona, interlocutor_desc, prev_convo, retrieved_summary, test_input=None, verbose=False): 
   def create_prompt_input(persona, interlocutor_desc, prev_convo, retrieved_summary, test_input=None): 
     prompt_input = [persona.scratch.name, 
@@ -2615,6 +2991,7 @@ def run_gpt_prompt_generate_next_convo_line(persona, interlocutor_desc, prev_con
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_generate_whisper_inner_thought(persona, whisper, test_input=None, verbose=False): 
   def create_prompt_input(persona, whisper, test_input=None): 
     prompt_input = [persona.scratch.name, whisper]
@@ -2652,6 +3029,7 @@ def run_gpt_prompt_generate_whisper_inner_thought(persona, whisper, test_input=N
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_planning_thought_on_convo(persona, all_utt, test_input=None, verbose=False): 
   def create_prompt_input(persona, all_utt, test_input=None): 
     prompt_input = [all_utt, persona.scratch.name, persona.scratch.name, persona.scratch.name]
@@ -2689,6 +3067,7 @@ def run_gpt_prompt_planning_thought_on_convo(persona, all_utt, test_input=None,
 
 
 
+@prompt_stats.track
 def run_gpt_prompt_memo_on_convo(persona, all_utt, test_input=None, verbose=False): 
   def create_prompt_input(persona, all_utt, test_input=None): 
     prompt_input = [all_utt, persona.scratch.name, persona.scratch.name, persona.scratch.name]
@@ -2756,6 +3135,7 @@ def run_gpt_prompt_memo_on_convo(persona, all_utt, test_input=None, verbose=Fals
 
 
 
+@prompt_stats.track
 def run_gpt_generate_safety_score(persona, comment, test_input=None, verbose=False): 
   def create_prompt_input(comment, test_input=None):
     prompt_input = [comment]
@@ -2771,10 +3151,10 @@ def run_gpt_generate_safety_score(persona, comment, test_input=None, verbose=Fal
       response = json.loads(gpt_response)
       for field in fields: 
         if field not in response: 
-          return False
+          return ValidationFailure(f"no \"{field}\" field")
       return True
     except:
-      return False 
+      return ValidationFailure("not json")
 
   def get_fail_safe():
     return None
@@ -2818,6 +3198,7 @@ def extract_first_json_dict(data_str):
         return None
 
 
+@prompt_stats.track
 def run_gpt_generate_iterative_chat_utt(maze, init_persona, target_persona, retrieved, curr_context, curr_chat, test_input=None, verbose=False): 
   def create_prompt_input(maze, init_persona, target_persona, retrieved, curr_context, curr_chat, test_input=None):
     persona = init_persona
@@ -0,0 +1,329 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: persona_workers.py
+Description: Runs the personas in a pool of worker processes. Besides the LLM
+round trips, a move spends its time in Python (retrieval scoring, perceiving,
+path finding, ...), which holds the GIL, so with enough personas a step is
+capped at one core no matter how many threads move them (see
+parallel_step.py). Here every persona lives in one worker process for a whole
+run: its memory (Scratch, AssociativeMemory, MemoryTree) is sent to its
+worker once when the run starts, and comes back once when it ends.
+
+In between, every step only sends each worker a compact delta of the world:
+  - the time and the tiles of all personas,
+  - the journal of the tile event writes since the last step (see
+    Maze.start_journal), and
+  - the scratches of the personas of the other workers, which stand in for
+    them during the step (RemotePersona).
+Each worker moves its personas behind a barrier of its own, like in a
+parallel step, and sends back their moves and scratches, and the actions
+they deferred to the barrier. The main process applies the deferred actions
+of all workers in the order of the personas (e.g., a conversation, which is
+generated turn by turn by the worker of whoever speaks; see
+PersonaWorkerPool._chat).
+"""
+import multiprocessing
+import traceback
+
+from maze import *
+from parallel_step import *
+from persona.persona import *
+
+
+class RemotePersona:
+  """
+  Stands in for a persona that lives in another worker: other personas see
+  its name and its scratch as of the start of the step.
+  """
+  def __init__(self, name, scratch):
+    self.name = name
+    self.scratch = scratch
+
+
+def _worker_step(state, curr_time, personas_tile, journal, scratches):
+  maze = state["maze"]
+  own = state["own"]
+  for method_name, args in journal:
+    getattr(maze, method_name)(*args)
+  for persona_name, scratch in scratches.items():
+    state["personas"][persona_name].scratch = scratch
+  if not own:
+    # More workers than personas: this one has nobody to move.
+    return [dict(), dict(), []]
+
+  if poignancy_batch == "step":
+    prefetch_step_poig_scores(own, maze, personas_tile)
+
+  barrier = StepBarrier(state["persona_names"])
+  moves = move_personas_behind_barrier(maze, state["personas"],
+                                       personas_tile, curr_time, barrier,
+                                       list(own.keys()), state["max_threads"])
+  own_scratches = {name: persona.scratch for name, persona in own.items()}
+  return [moves, own_scratches, barrier.take_deferred()]
+
+
+def worker_main(conn):
+  """
+  The main loop of a worker process. It answers the commands that the main
+  process sends over <conn> (see PersonaWorkerPool) with ["ok", <result>],
+  or ["error", <traceback>] if the command fails.
+  """
+  state = dict()
+  while True:
+    command, args = conn.recv()
+    try:
+      if command == "stop":
+        conn.send(["ok", None])
+        break
+
+      elif command == "load":
+        # args: the worker's own personas, the names of all personas in
+        # order, the scratches of the others, the maze name and its tile
+        # events, the number of workers, and the max number of threads.
+        (own, persona_names, scratches, maze_name, tile_events, n_workers,
+         max_threads) = args
+        if "maze" not in state or state["maze"].maze_name != maze_name:
+          state["maze"] = Maze(maze_name)
+        state["maze"].set_tile_events(tile_events)
+        state["own"] = own
+        state["persona_names"] = persona_names
+        state["personas"] = dict()
+        for persona_name in persona_names:
+          if persona_name in own:
+            state["personas"][persona_name] = own[persona_name]
+          else:
+            state["personas"][persona_name] = RemotePersona(
+                                                persona_name,
+                                                scratches[persona_name])
+        state["max_threads"] = max_threads
+        # The workers share the rate limits of the same keys.
+        llm_client.rate_limiter.split(n_workers)
+        ret = None
+
+      elif command == "step":
+        ret = _worker_step(state, *args)
+        # A worker process does not run the exit hooks (see LLMCache.flush),
+        # and it may be stopped at any point, so it writes its new responses
+        # to the cache after every step.
+        llm_cache.flush()
+
+      elif command == "update":
+        # args: {persona name: scratch} of personas of other workers.
+        for persona_name, scratch in args[0].items():
+          state["personas"][persona_name].scratch = scratch
+        ret = None
+
+      elif command == "chat_turn":
+        init_name, target_name, curr_chat = args
+        ret = agent_chat_turn(state["maze"], state["own"][init_name],
+                              state["personas"][target_name], curr_chat)
+
+      elif command == "chat_summary":
+        persona_name, convo = args
+        ret = generate_convo_summary(state["own"][persona_name], convo)
+
+      elif command == "chat_react":
+        persona_name, other_name = args[:2]
+        persona = state["own"][persona_name]
+        create_chat_react(persona, other_name, *args[2:])
+        ret = persona.scratch
+
+      elif command == "sync":
+        ret = [state["own"], prompt_stats.pop_counters()]
+
+      else:
+        raise ValueError(f"Unknown persona worker command: {command}")
+
+      conn.send(["ok", ret])
+    except Exception:
+      conn.send(["error", traceback.format_exc()])
+
+
+class PersonaWorkerPool:
+  def __init__(self, n_workers, max_threads=None):
+    """
+    Starts <n_workers> worker processes. <max_threads> is the max number of
+    personas that move at once within a worker (None for all of them).
+    """
+    self.n_workers = n_workers
+    self.max_threads = max_threads
+    # We spawn rather than fork, so that the workers do not inherit the
+    # threads (and locks) of the LLM client.
+    context = multiprocessing.get_context("spawn")
+    self.conns = []
+    self.processes = []
+    for i in range(n_workers):
+      conn, worker_conn = context.Pipe()
+      process = context.Process(target=worker_main, args=(worker_conn,),
+                                daemon=True)
+      process.start()
+      self.conns += [conn]
+      self.processes += [process]
+    # <assignment> maps a persona name to the index of its worker.
+    self.assignment = dict()
+
+
+  def _send(self, worker, command, *args):
+    self.conns[worker].send([command, args])
+
+
+  def _recv(self, worker):
+    status, ret = self.conns[worker].recv()
+    if status == "error":
+      raise RuntimeError(f"Persona worker {worker} failed:\n{ret}")
+    return ret
+
+
+  def _call(self, worker, command, *args):
+    self._send(worker, command, *args)
+    return self._recv(worker)
+
+
+  def _call_all(self, commands):
+    """
+    Sends every worker its command at once, and then waits for all of them.
+    <commands> maps a worker index to [command, args].
+    """
+    for worker, (command, args) in commands.items():
+      self._send(worker, command, *args)
+    # We hear back from every worker before we raise, so that no answer is
+    # left behind in a pipe.
+    answers = {worker: self.conns[worker].recv() for worker in commands}
+    for worker, (status, ret) in answers.items():
+      if status == "error":
+        raise RuntimeError(f"Persona worker {worker} failed:\n{ret}")
+    return {worker: ret for worker, (status, ret) in answers.items()}
+
+
+  def load(self, personas, maze):
+    """
+    Sends the <personas> to the workers for a run, and starts the journal of
+    <maze> that the workers follow it with from now on. Every persona goes
+    to the same worker as in the runs before.
+    """
+    for persona_name in personas:
+      if persona_name not in self.assignment:
+        self.assignment[persona_name] = (len(self.assignment)
+                                         % self.n_workers)
+    persona_names = list(personas.keys())
+    scratches = {name: persona.scratch for name, persona in personas.items()}
+    tile_events = maze.get_tile_events()
+    maze.start_journal()
+
+    commands = dict()
+    for worker in range(self.n_workers):
+      own = {name: persona for name, persona in personas.items()
+             if self.assignment[name] == worker}
+      commands[worker] = ["load", [own, persona_names, scratches,
+                                   maze.maze_name, tile_events,
+                                   self.n_workers, self.max_threads]]
+    self._call_all(commands)
+
+
+  def step(self, maze, personas, personas_tile, curr_time):
+    """
+    Moves all <personas> for the step at <curr_time> in their workers, and
+    applies what they deferred to <personas> (whose scratches mirror the
+    ones in the workers) at the barrier.
+    OUTPUT:
+      a dictionary of persona name -> the (next_tile, pronunciatio,
+      description) returned by its move.
+    """
+    journal = maze.take_journal()
+    commands = dict()
+    for worker in range(self.n_workers):
+      scratches = {name: persona.scratch
+                   for name, persona in personas.items()
+                   if self.assignment[name] != worker}
+      commands[worker] = ["step", [curr_time, personas_tile, journal,
+                                   scratches]]
+    results = self._call_all(commands)
+
+    moves = dict()
+    deferred = []
+    for worker, (worker_moves, scratches,
+                 worker_deferred) in results.items():
+      moves.update(worker_moves)
+      for persona_name, scratch in scratches.items():
+        personas[persona_name].scratch = scratch
+      deferred += worker_deferred
+
+    for order, sequence, persona_name, kind, args in sorted(
+                                                       deferred,
+                                                       key=lambda x: x[:2]):
+      if kind != "chat":
+        raise ValueError(f"Persona workers cannot apply a deferred {kind}")
+      self._chat(personas, persona_name, *args)
+    return moves
+
+
+  def _chat(self, personas, persona_name, reaction_mode):
+    """
+    Has the persona <persona_name> start the conversation it decided on (see
+    _deferred_chat_react in plan.py). Every utterance is generated by the
+    worker of the persona who says it, with that persona's memory.
+    """
+    init_name = persona_name
+    target_name = reaction_mode[9:].strip()
+    if (personas[init_name].scratch.chatting_with
+        or personas[target_name].scratch.chatting_with):
+      return
+    init_worker = self.assignment[init_name]
+    target_worker = self.assignment[target_name]
+    # Both workers see the other persona as it is after its move.
+    if init_worker != target_worker:
+      self._call_all({
+        init_worker: ["update", [{target_name:
+                                  personas[target_name].scratch}]],
+        target_worker: ["update", [{init_name:
+                                    personas[init_name].scratch}]]})
+
+    convo = []
+    for i in range(8):
+      utt, end = self._call(init_worker, "chat_turn", init_name, target_name,
+                            convo)
+      convo += [[init_name, utt]]
+      if end:
+        break
+
+      utt, end = self._call(target_worker, "chat_turn", target_name,
+                            init_name, convo)
+      convo += [[target_name, utt]]
+      if end:
+        break
+
+    inserted_act = self._call(init_worker, "chat_summary", init_name, convo)
+    inserted_act_dur = get_convo_length(convo)
+    act_start_time = personas[target_name].scratch.act_start_time
+    chatting_end_time = get_chatting_end_time(personas[target_name]
+                                              .scratch.curr_time,
+                                              inserted_act_dur)
+    for name, other_name in [[init_name, target_name],
+                             [target_name, init_name]]:
+      personas[name].scratch = self._call(self.assignment[name],
+                                          "chat_react", name, other_name,
+                                          convo, inserted_act,
+                                          inserted_act_dur, act_start_time,
+                                          chatting_end_time)
+
+
+  def sync(self, personas):
+    """
+    Brings the personas back from the workers into <personas> at the end of
+    a run, together with the prompt stats of the workers.
+    """
+    commands = {worker: ["sync", []] for worker in range(self.n_workers)}
+    for worker, (own, counters) in self._call_all(commands).items():
+      personas.update(own)
+      prompt_stats.merge(*counters)
+
+
+  def close(self):
+    for worker in range(self.n_workers):
+      try:
+        self._call(worker, "stop")
+      except (EOFError, OSError, RuntimeError):
+        pass
+    for process in self.processes:
+      process.join(timeout=10)
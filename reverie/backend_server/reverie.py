@@ -26,14 +26,22 @@ import time
 import math
 import os
 import shutil
+import sys
 import traceback
 
 from selenium import webdriver
 
+import utils
 from global_methods import *
 from utils import *
 from maze import *
 from persona.persona import *
+from persona.prompt_template.gpt_structure import *
+from tape import *
+from parallel_step import *
+from persona_workers import *
+from frontend_channel import *
+from fast_forward import *
 
 ##############################################################################
 #                                  REVERIE                                   #
@@ -42,7 +50,10 @@ from persona.persona import *
 class ReverieServer: 
   def __init__(self, 
                fork_sim_code,
-               sim_code):
+               sim_code, 
+               tape_mode=None, 
+               tape_path=None, 
+               headless=None):
     # FORKING FROM A PRIOR SIMULATION:
     # <fork_sim_code> indicates the simulation we are forking from. 
     # Interestingly, all simulations must be forked from some initial 
@@ -136,6 +147,84 @@ class ReverieServer:
     # <server_sleep> denotes the amount of time that our while loop rests each
     # cycle; this is to not kill our machine. 
     self.server_sleep = 0.1
+    # <parallel_moves> is whether the personas of a step move in parallel 
+    # (see parallel_step.py), and <parallel_workers> is the max number of 
+    # personas that move at once (None for all of them). These are set with 
+    # <parallel_persona_moves> and <parallel_persona_workers> in utils.py. 
+    self.parallel_moves = getattr(utils, "parallel_persona_moves", False)
+    self.parallel_workers = getattr(utils, "parallel_persona_workers", None)
+    # <worker_processes> is the number of processes the personas live in 
+    # during a run (see persona_workers.py), or None to keep them in this 
+    # process. This is set with <persona_worker_processes> in utils.py. The
+    # pool is started by the first run. 
+    self.worker_processes = getattr(utils, "persona_worker_processes", None)
+    self.persona_workers = None
+    # <headless> is whether we run without the frontend: instead of waiting
+    # for the frontend to write the environment file of every step, we move
+    # the personas to the tiles of their last movement ourselves. This is 
+    # set with <headless_mode> in utils.py, or with <headless> (e.g., by the
+    # batch runs). 
+    self.headless = headless
+    if headless is None: 
+      self.headless = getattr(utils, "headless_mode", False)
+    # <movement_tiles> is the tile that the last movement of every persona 
+    # took it to. 
+    # e.g., ["Isabella Rodriguez"] = (58, 39)
+    self.movement_tiles = dict()
+    # <frontend_channel> is the socket that the frontend pushes the 
+    # environment of every step to, and gets the movements from (see 
+    # frontend_channel.py), in place of the files. It is opened on the port
+    # <frontend_channel_port> in utils.py (any free port by default), and 
+    # None if that is set to None, in which case we only use the files. In 
+    # the headless mode there is no frontend to talk to, so it stays None. 
+    self.frontend_channel = None
+    channel_port = getattr(utils, "frontend_channel_port", 0)
+    if channel_port is not None and not self.headless: 
+      self.frontend_channel = FrontendChannel(self.sim_code, channel_port)
+
+    # RECORD/REPLAY TAPE: 
+    # <tape> records every LLM response, embedding, and random draw of this
+    # simulation to a tape file ("record"), or feeds them back from a tape 
+    # that was recorded earlier ("replay"), so that runs can be repeated 
+    # deterministically without network access. See tape.py. The mode and 
+    # path can also be set with <tape_mode> and <tape_path> in utils.py. 
+    # e.g., Tape("record", ".../storage/<sim_code>/reverie/tape.jsonl")
+    self.tape = None
+    if not tape_mode: 
+      tape_mode = getattr(utils, "tape_mode", None)
+      tape_path = getattr(utils, "tape_path", None)
+    if tape_mode: 
+      if not tape_path and tape_mode == "record": 
+        tape_path = f"{sim_folder}/reverie/tape.jsonl"
+      if not tape_path: 
+        raise ValueError("Replaying requires the path of a recorded tape.")
+      self.tape = Tape(tape_mode, tape_path, 
+                       {"fork_sim_code": fork_sim_code, "step": self.step})
+      if (tape_mode == "replay" 
+          and self.tape.meta.get("fork_sim_code") != fork_sim_code): 
+        print (f"Warning: the tape was recorded on a fork of "
+               f"{self.tape.meta.get('fork_sim_code')}, not {fork_sim_code}.")
+      self.tape.install()
+      set_active_tape(self.tape)
+      # Random draws are replayed strictly in order, which parallel moves
+      # would not keep. 
+      if self.parallel_moves or self.worker_processes: 
+        print ("Note: the personas move one at a time while a tape is used.")
+        self.parallel_moves = False
+        self.worker_processes = None
+
+    # <fast_forward> skips the cognition of the personas in the steps where 
+    # it would not change what they do, and jumps the clock when none of 
+    # them needs to think (see fast_forward.py), or is None to have every 
+    # persona think in every step. This is set with <fast_forward> in 
+    # utils.py. 
+    self.fast_forward = None
+    if getattr(utils, "fast_forward", False): 
+      if self.worker_processes: 
+        print ("Note: fast forward is off while the personas live in worker "
+               "processes.")
+      else: 
+        self.fast_forward = FastForward(self.sec_per_step)
 
     # SIGNALING THE FRONTEND SERVER: 
     # curr_sim_code.json contains the current simulation code, and
@@ -145,6 +234,8 @@ class ReverieServer:
     # simulation. 
     curr_sim_code = dict()
     curr_sim_code["sim_code"] = self.sim_code
+    if self.frontend_channel: 
+      curr_sim_code["channel_port"] = self.frontend_channel.port
     with open(f"{fs_temp_storage}/curr_sim_code.json", "w") as outfile: 
       outfile.write(json.dumps(curr_sim_code, indent=2))
     
@@ -181,12 +272,45 @@ class ReverieServer:
     with open(reverie_meta_f, "w") as outfile: 
       outfile.write(json.dumps(reverie_meta, indent=2))
 
+    # Make sure the tape has everything up to this point. 
+    if self.tape: 
+      self.tape.flush()
+
     # Save the personas.
     for persona_name, persona in self.personas.items(): 
       save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
       persona.save(save_folder)
 
 
+  def close(self): 
+    """
+    Shuts down what the server holds on to outside of its own memory: the 
+    persona worker processes, the frontend channel, and the tape (which is
+    flushed first). It also dumps the per-prompt accounting so far to 
+    prompt_stats.json and prompt_stats.csv in the reverie folder of the 
+    simulation, unless the simulation was erased (see "exit"). 
+
+    INPUT
+      None
+    OUTPUT 
+      None
+    """
+    if self.persona_workers: 
+      self.persona_workers.close()
+      self.persona_workers = None
+    if self.frontend_channel: 
+      self.frontend_channel.close()
+      self.frontend_channel = None
+    if self.tape: 
+      self.tape.close()
+      set_active_tape(None)
+      self.tape = None
+
+    sim_folder = f"{fs_storage}/{self.sim_code}"
+    if os.path.exists(f"{sim_folder}/reverie"): 
+      prompt_stats.save(f"{sim_folder}/reverie")
+
+
   def start_path_tester_server(self): 
     """
     Starts the path tester server. This is for generating the spatial memory
@@ -289,8 +413,32 @@ class ReverieServer:
     OUTPUT 
       None
     """
+    if not self.worker_processes: 
+      self._run_steps(int_counter)
+      return
+
+    # The personas live in the worker processes for the whole run, and come 
+    # back here once it is over (or has failed). 
+    if not self.persona_workers: 
+      # A worker without personas would only take a share of the rate limits.
+      self.persona_workers = PersonaWorkerPool(min(self.worker_processes, 
+                                                   len(self.personas)), 
+                                               self.parallel_workers)
+    self.persona_workers.load(self.personas, self.maze)
+    try: 
+      self._run_steps(int_counter)
+    finally: 
+      self.persona_workers.sync(self.personas)
+
+
+  def _run_steps(self, int_counter): 
+    """
+    Runs <int_counter> steps of the main loop (see start_server). 
+    """
     # <sim_folder> points to the current simulation folder.
     sim_folder = f"{fs_storage}/{self.sim_code}"
+    if self.headless: 
+      create_folder_if_not_there(f"{sim_folder}/movement")
 
     # When a persona arrives at a game object, we give a unique event
     # to that object. 
@@ -313,16 +461,30 @@ class ReverieServer:
       # new environment file that matches our step count. That's when we run 
       # the content of this for loop. Otherwise, we just wait. 
       curr_env_file = f"{sim_folder}/environment/{self.step}.json"
-      if check_if_file_exists(curr_env_file):
+      # In the headless mode, there is no frontend to wait for: the personas
+      # are where their last movement took them, which is what the frontend
+      # would tell us as well. Otherwise, the frontend pushes the environment
+      # to our channel, if it can, and writes the file if it cannot. 
+      channel_env = None
+      if self.headless: 
+        channel_env = self.get_env_from_movements()
+      elif self.frontend_channel: 
+        channel_env = self.frontend_channel.wait_for_environment(
+                        self.step, self.server_sleep)
+      if channel_env is not None or check_if_file_exists(curr_env_file):
         # If we have an environment file, it means we have a new perception
         # input to our personas. So we first retrieve it.
-        try: 
-          # Try and save block for robustness of the while loop.
-          with open(curr_env_file) as json_file:
-            new_env = json.load(json_file)
-            env_retrieved = True
-        except: 
-          pass
+        if channel_env is not None: 
+          new_env = channel_env
+          env_retrieved = True
+        else: 
+          try: 
+            # Try and save block for robustness of the while loop.
+            with open(curr_env_file) as json_file:
+              new_env = json.load(json_file)
+              env_retrieved = True
+          except: 
+            pass
       
         if env_retrieved: 
           # This is where we go through <game_obj_cleanup> to clean up all 
@@ -364,21 +526,58 @@ class ReverieServer:
                        None, None, None)
               self.maze.remove_event_from_tile(blank, new_tile)
 
+          # With fast forward, only some of the personas think in this 
+          # step, and the others coast. 
+          thinkers = list(self.personas.keys())
+          if self.fast_forward: 
+            thinkers = self.fast_forward.get_thinkers(self.maze, 
+                                                      self.personas, 
+                                                      self.personas_tile,
+                                                      self.curr_time)
+
+          # With poignancy_batch = "step" in utils.py, we score the new 
+          # events of all personas in one prompt before they move. 
+          # (The persona workers do this for their own personas.) 
+          if poignancy_batch == "step" and not self.worker_processes: 
+            prefetch_step_poig_scores({i: self.personas[i] for i in thinkers},
+                                      self.maze, self.personas_tile)
+
           # Then we need to actually have each of the personas perceive and
           # move. The movement for each of the personas comes in the form of
           # x y coordinates where the persona will move towards. e.g., (50, 34)
           # This is where the core brains of the personas are invoked. 
           movements = {"persona": dict(), 
                        "meta": dict()}
+          step_moves = None
+          coast_moves = dict()
+          if self.fast_forward: 
+            for persona_name in self.personas: 
+              if persona_name not in thinkers: 
+                coast_moves[persona_name] = self.fast_forward.coast(
+                  self.maze, self.personas, persona_name, 
+                  self.personas_tile[persona_name], self.curr_time)
+          if self.worker_processes: 
+            step_moves = self.persona_workers.step(self.maze, self.personas,
+                                                   self.personas_tile, 
+                                                   self.curr_time)
+          elif self.parallel_moves and thinkers: 
+            step_moves = move_personas_in_parallel(
+                           self.maze, self.personas, self.personas_tile,
+                           self.curr_time, self.parallel_workers, thinkers)
           for persona_name, persona in self.personas.items(): 
             # <next_tile> is a x,y coordinate. e.g., (58, 9)
             # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
             # <description> is a string description of the movement. e.g., 
             #   writing her next novel (editing her novel) 
             #   @ double studio:double studio:common room:sofa
-            next_tile, pronunciatio, description = persona.move(
-              self.maze, self.personas, self.personas_tile[persona_name], 
-              self.curr_time)
+            if persona_name in coast_moves: 
+              next_tile, pronunciatio, description = coast_moves[persona_name]
+            elif step_moves is not None: 
+              next_tile, pronunciatio, description = step_moves[persona_name]
+            else: 
+              next_tile, pronunciatio, description = persona.move(
+                self.maze, self.personas, self.personas_tile[persona_name], 
+                self.curr_time)
             movements["persona"][persona_name] = {}
             movements["persona"][persona_name]["movement"] = next_tile
             movements["persona"][persona_name]["pronunciatio"] = pronunciatio
@@ -400,16 +599,56 @@ class ReverieServer:
           curr_move_file = f"{sim_folder}/movement/{self.step}.json"
           with open(curr_move_file, "w") as outfile: 
             outfile.write(json.dumps(movements, indent=2))
+          if self.frontend_channel: 
+            self.frontend_channel.publish_movement(self.step, movements)
+          self.movement_tiles = {persona_name: tuple(val["movement"]) 
+                                 for persona_name, val 
+                                 in movements["persona"].items()}
 
           # After this cycle, the world takes one step forward, and the 
-          # current time moves by <sec_per_step> amount. 
+          # current time moves by <sec_per_step> amount (or, with fast 
+          # forward, up to when the next persona wakes up). 
           self.step += 1
-          self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+          if self.fast_forward: 
+            self.curr_time = self.fast_forward.get_next_time(self.personas,
+                                                             self.curr_time,
+                                                             thinkers)
+          else: 
+            self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
 
           int_counter -= 1
           
-      # Sleep so we don't burn our machines. 
-      time.sleep(self.server_sleep)
+      # Sleep so we don't burn our machines. (In the headless mode, nothing
+      # is waiting on anyone, and the channel has waited for us already.) 
+      if not self.headless and not self.frontend_channel: 
+        time.sleep(self.server_sleep)
+
+    # The environment file of the step we stopped at is where a later run, 
+    # a fork, or the frontend pick the simulation up from, and the frontend
+    # does not write it if it sends the environment to the channel. 
+    curr_env_file = f"{sim_folder}/environment/{self.step}.json"
+    if self.movement_tiles and not check_if_file_exists(curr_env_file): 
+      with open(curr_env_file, "w") as outfile: 
+        outfile.write(json.dumps(self.get_env_from_movements(), indent=2))
+
+    if self.tape: 
+      self.tape.flush()
+
+
+  def get_env_from_movements(self): 
+    """
+    Returns the environment of the current step in the form of the 
+    environment file that the frontend would have written: every persona is
+    at the tile that its movement of the last step took it to (or where it 
+    is now, if we have not moved it yet). 
+    e.g., {"Maria Lopez": {"maze": "the_ville", "x": 58, "y": 9}}
+    """
+    new_env = dict()
+    for persona_name in self.personas: 
+      x, y = self.movement_tiles.get(persona_name, 
+                                     self.personas_tile[persona_name])
+      new_env[persona_name] = {"maze": self.maze.maze_name, "x": x, "y": y}
+    return new_env
 
 
   def open_server(self): 
@@ -466,6 +705,9 @@ class ReverieServer:
           # Example: run 1000
           int_count = int(sim_command.split()[-1])
           rs.start_server(int_count)
+          # Dump the per-prompt accounting so far to prompt_stats.json and 
+          # prompt_stats.csv in the reverie folder of the simulation.
+          prompt_stats.save(f"{sim_folder}/reverie")
 
         elif ("print persona schedule" 
               in sim_command[:22].lower()): 
@@ -566,6 +808,76 @@ class ReverieServer:
           for key, val in self.maze.access_tile(cooordinate).items(): 
             ret_str += f"{key}: {val}\n"
 
+        elif ("print llm cache stats" 
+              in sim_command.lower()): 
+          # Print the hit/miss counts and the size of the LLM response cache,
+          # and the number of duplicate in-flight requests that were saved.
+          # Ex: print llm cache stats
+          ret_str += llm_cache.get_str_stats() + "\n"
+          ret_str += single_flight.get_str_stats()
+
+        elif ("print llm endpoint stats" 
+              in sim_command.lower()): 
+          # Print the health, the outstanding requests and the failures of 
+          # every endpoint in the pool of the OpenAI backend. 
+          # Ex: print llm endpoint stats
+          if isinstance(llm_client.backend, EndpointPoolBackend): 
+            ret_str += llm_client.backend.get_str_stats()
+          else: 
+            ret_str += f"The {llm_client.backend.name} backend has no endpoints"
+
+        elif ("print llm scheduler stats" 
+              in sim_command.lower()): 
+          # Print the requests and wait times of every LLM priority class.
+          # Ex: print llm scheduler stats
+          ret_str += llm_client.scheduler.get_str_stats()
+
+        elif ("print rate limiter stats" 
+              in sim_command.lower()): 
+          # Print the number of rate limited requests and the current 
+          # per-model rates. 
+          # Ex: print rate limiter stats
+          ret_str += llm_client.rate_limiter.get_str_stats()
+
+        elif ("print embedding store stats" 
+              in sim_command.lower()): 
+          # Print the hit/miss counts of the shared embedding store.
+          # Ex: print embedding store stats
+          ret_str += embedding_store.get_str_stats() + "\n"
+          ret_str += embedding_batcher.get_str_stats()
+
+        elif ("print prompt memo stats" 
+              in sim_command.lower()): 
+          # Print the hit/miss counts of the prompt memo, per prompt function.
+          # Ex: print prompt memo stats
+          ret_str += prompt_memo.get_str_stats()
+
+        elif ("print model routing" 
+              in sim_command.lower()): 
+          # Print the model tiers and the prompt functions routed to them.
+          # Ex: print model routing
+          ret_str += model_router.get_str_routes()
+
+        elif ("print fast forward stats" 
+              in sim_command.lower()): 
+          # Print how many persona-steps thought and coasted, and how much
+          # game time the jumps of the clock skipped (see fast_forward.py). 
+          # Ex: print fast forward stats
+          if self.fast_forward: 
+            ret_str += self.fast_forward.get_str_stats()
+          else: 
+            ret_str += "Fast forward is off."
+
+        elif ("print prompt stats" 
+              in sim_command.lower()): 
+          # Print the calls, requests, retries, validation failures, local 
+          # repairs, tokens, wall time and estimated cost of every prompt 
+          # function, per persona, followed by the reasons of the validation
+          # failures. 
+          # Ex: print prompt stats
+          ret_str += prompt_stats.get_str_stats() + "\n"
+          ret_str += prompt_stats.get_str_failure_reasons()
+
         elif ("call -- analysis" 
               in sim_command.lower()): 
           # Starts a stateless chat session with the agent. It does not save 
@@ -588,7 +900,8 @@ class ReverieServer:
             for whisper in whispers: 
               clean_whispers += [[agent_name, whisper]]
 
-          load_history_via_whisper(self.personas, clean_whispers)
+          with llm_priority("analysis"): 
+            load_history_via_whisper(self.personas, clean_whispers)
 
         print (ret_str)
 
@@ -597,6 +910,8 @@ class ReverieServer:
         print ("Error.")
         pass
 
+    self.close()
+
 
 if __name__ == '__main__':
   # rs = ReverieServer("base_the_ville_isabella_maria_klaus", 
@@ -605,6 +920,23 @@ if __name__ == '__main__':
   #                    "July1_the_ville_isabella_maria_klaus-step-3-21")
   # rs.open_server()
 
+  if getattr(utils, "tape_mode", None) and "PYTHONHASHSEED" not in os.environ: 
+    # Record and replay runs need the same str hashing to iterate over the 
+    # maze's event sets in the same order (see tape.py), so we restart 
+    # ourselves with a fixed hash seed. 
+    os.environ["PYTHONHASHSEED"] = "0"
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+  if len(sys.argv) == 4: 
+    # A batch run without the frontend, e.g., on a server: 
+    #   python reverie.py <forked simulation> <new simulation> <steps>
+    # runs the steps in the headless mode, and saves the new simulation. 
+    rs = ReverieServer(sys.argv[1], sys.argv[2], headless=True)
+    rs.start_server(int(sys.argv[3]))
+    rs.save()
+    rs.close()
+    sys.exit()
+
   origin = input("Enter the name of the forked simulation: ").strip()
   target = input("Enter the name of the new simulation: ").strip()
 
@@ -0,0 +1,77 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: stub_llm_server.py
+Description: A local HTTP stand-in for OpenAI's API that serves the
+deterministic stub responses of llm_backend.StubBackend. This is useful when
+you want to exercise the full OpenAI code path (including the HTTP round
+trips) without network access. To use it, run
+    python stub_llm_server.py 8001
+and add the following to utils.py:
+    openai_api_base = "http://localhost:8001/v1"
+(If you do not need the HTTP round trips, set llm_backend = "stub" in
+utils.py instead; that serves the same responses in-process.)
+"""
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from persona.prompt_template.llm_backend import *
+
+
+class StubLLMRequestHandler(BaseHTTPRequestHandler):
+  # HTTP/1.1 keeps the connections of the clients alive between requests.
+  protocol_version = "HTTP/1.1"
+
+  def send_json(self, response):
+    raw = json.dumps(response).encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(raw)))
+    self.end_headers()
+    self.wfile.write(raw)
+
+
+  def do_GET(self):
+    # The model list is what the endpoint pool's health check asks for.
+    if self.path.endswith("/models"):
+      self.send_json({"object": "list", "data": []})
+    else:
+      self.send_error(404, f"Unknown endpoint: {self.path}")
+
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = json.loads(self.rfile.read(length) or "{}")
+    model = body.get("model", "")
+
+    if self.path.endswith("/chat/completions"):
+      prompt = "\n".join([i["content"] for i in body["messages"]])
+      response = stub_chat_completion_response(model, prompt)
+    elif self.path.endswith("/completions"):
+      prompt = body["prompt"]
+      if type(prompt) == list:
+        prompt = prompt[0]
+      response = stub_completion_response(model, prompt)
+    elif self.path.endswith("/embeddings"):
+      texts = body["input"]
+      if type(texts) == str:
+        texts = [texts]
+      response = stub_embedding_response(model, texts)
+    else:
+      self.send_error(404, f"Unknown endpoint: {self.path}")
+      return
+    self.send_json(response)
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+if __name__ == '__main__':
+  port = 8001
+  if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+  server = ThreadingHTTPServer(("localhost", port), StubLLMRequestHandler)
+  print (f"Stub LLM server running at http://localhost:{port}/v1")
+  server.serve_forever()
@@ -0,0 +1,236 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: tape.py
+Description: Record/replay tapes for fully deterministic simulation runs. In
+"record" mode, every LLM response, every embedding, and every draw from the
+random module is written to a tape file as the simulation runs. In "replay"
+mode, those values are fed back from the tape instead, so a run can be
+repeated over and over without any network access and produces the very same
+movement files (e.g., for profiling start_server on a real workload, or for
+bisecting performance regressions).
+
+LLM responses and embeddings are looked up by the content address of their
+request, so they do not depend on the order in which the requests are made.
+Random draws are replayed strictly in order; a mismatch between the recorded
+and the requested draw means the run has diverged, and raises TapeMismatch.
+
+Note that Python salts the hash of str per process, which changes the
+iteration order of the sets we keep in the maze. Both record and replay runs
+should therefore be started with the same PYTHONHASHSEED (reverie.py takes
+care of this when a tape mode is set in utils.py).
+"""
+import json
+import os
+import random
+import threading
+
+# The names of the module level functions of the random module that we
+# reroute through the tape. They are all bound methods of one hidden Random
+# instance, so we swap them for the bound methods of our TapeRandom.
+RANDOM_FUNCTIONS = ["random", "getrandbits", "seed", "randrange", "randint",
+                    "choice", "choices", "sample", "shuffle", "uniform",
+                    "triangular", "gauss", "normalvariate", "lognormvariate",
+                    "expovariate", "vonmisesvariate", "gammavariate",
+                    "betavariate", "paretovariate", "weibullvariate"]
+
+TAPE_MODES = ["record", "replay"]
+
+
+class TapeMismatch(Exception):
+  pass
+
+
+class TapeRandom(random.Random):
+  """
+  A Random whose two primitives (random() and getrandbits()) go through the
+  tape. All the other methods of Random (choice, sample, randint, ...) are
+  built on top of these two, so they are covered as well.
+  """
+  def __init__(self, tape):
+    self.tape = tape
+    super().__init__()
+
+
+  def random(self):
+    if self.tape.mode == "replay":
+      return self.tape.replay_random("random", None)
+    value = super().random()
+    self.tape.record_random("random", None, value)
+    return value
+
+
+  def getrandbits(self, k):
+    if self.tape.mode == "replay":
+      return self.tape.replay_random("getrandbits", k)
+    value = super().getrandbits(k)
+    self.tape.record_random("getrandbits", k, value)
+    return value
+
+
+class Tape:
+  def __init__(self, mode, tape_path, meta=None):
+    if mode not in TAPE_MODES:
+      raise ValueError(f"Unknown tape mode: {mode}")
+    self.mode = mode
+    self.tape_path = tape_path
+    # <meta> is a dictionary that describes the recorded run (e.g., the
+    # simulation it was forked from). It is written as the first line of the
+    # tape, and is read back from the tape in replay mode.
+    self.meta = meta if meta else dict()
+
+    # <llm> and <embeddings> map a request key to the list of values that
+    # we recorded for it, in the order they were returned. The same request
+    # can be made more than once (e.g., when a response fails validation and
+    # we retry), and each time can get a different response.
+    self.llm = dict()
+    self.embeddings = dict()
+    # <randoms> is the list of [kind, k, value] random draws, in order.
+    # <random_index> is the next draw to replay in replay mode, and the next
+    # draw to write to the tape file in record mode.
+    self.randoms = []
+    self.random_index = 0
+
+    # Responses are recorded from the LLM client's thread as well as the main
+    # thread, so the writes to <outfile> go through a lock.
+    self.outfile = None
+    self.lock = threading.Lock()
+    self.recorded_embedding_keys = set()
+    self.original_random_functions = dict()
+
+    if self.mode == "record":
+      tape_folder = os.path.dirname(self.tape_path)
+      if tape_folder and not os.path.exists(tape_folder):
+        os.makedirs(tape_folder)
+      self.meta["PYTHONHASHSEED"] = os.environ.get("PYTHONHASHSEED")
+      self.outfile = open(self.tape_path, "w")
+      self._write({"type": "meta", "meta": self.meta})
+    else:
+      self._load()
+
+
+  def _write(self, entry):
+    line = json.dumps(entry) + "\n"
+    with self.lock:
+      self.outfile.write(line)
+
+
+  def _load(self):
+    with open(self.tape_path) as infile:
+      for line in infile:
+        entry = json.loads(line)
+        if entry["type"] == "meta":
+          self.meta = entry["meta"]
+        elif entry["type"] == "llm":
+          self.llm.setdefault(entry["key"], []).append(entry["value"])
+        elif entry["type"] == "embedding":
+          self.embeddings.setdefault(entry["key"], []).append(entry["value"])
+        elif entry["type"] == "random":
+          self.randoms += entry["draws"]
+
+    if self.meta.get("PYTHONHASHSEED") != os.environ.get("PYTHONHASHSEED"):
+      print (f"Warning: the tape was recorded with PYTHONHASHSEED="
+             f"{self.meta.get('PYTHONHASHSEED')}, but this run has "
+             f"PYTHONHASHSEED={os.environ.get('PYTHONHASHSEED')}. The replay "
+             f"may diverge.")
+
+
+  def install(self):
+    """
+    Reroutes the module level functions of the random module through this
+    tape.
+    """
+    rng = TapeRandom(self)
+    for name in RANDOM_FUNCTIONS:
+      if hasattr(random, name):
+        self.original_random_functions[name] = getattr(random, name)
+        setattr(random, name, getattr(rng, name))
+
+
+  def uninstall(self):
+    for name, function in self.original_random_functions.items():
+      setattr(random, name, function)
+    self.original_random_functions = dict()
+
+
+  def record_random(self, kind, k, value):
+    self.randoms += [[kind, k, value]]
+
+
+  def replay_random(self, kind, k):
+    if self.random_index >= len(self.randoms):
+      raise TapeMismatch(f"Ran out of random draws on the tape "
+                         f"(requested {kind}({k}))")
+    rec_kind, rec_k, value = self.randoms[self.random_index]
+    if rec_kind != kind or rec_k != k:
+      raise TapeMismatch(f"Random draw #{self.random_index} diverged: the "
+                         f"tape has {rec_kind}({rec_k}) but the run "
+                         f"requested {kind}({k})")
+    self.random_index += 1
+    return value
+
+
+  def record_llm(self, key, value):
+    self._write({"type": "llm", "key": key, "value": value})
+
+
+  def replay_llm(self, key):
+    if not self.llm.get(key):
+      raise TapeMismatch(f"No LLM response on the tape for request {key}")
+    values = self.llm[key]
+    # We keep the last response around in case the request is repeated more
+    # often than in the recorded run.
+    if len(values) > 1:
+      return values.pop(0)
+    return values[0]
+
+
+  def record_embedding(self, key, value):
+    # The embedding of a text never changes, so we only record it once.
+    if key in self.recorded_embedding_keys:
+      return
+    self.recorded_embedding_keys.add(key)
+    self._write({"type": "embedding", "key": key, "value": value})
+
+
+  def replay_embedding(self, key):
+    if not self.embeddings.get(key):
+      raise TapeMismatch(f"No embedding on the tape for {key}")
+    return self.embeddings[key][0]
+
+
+  def flush(self):
+    """
+    Writes the pending random draws to the tape file. We call this at the
+    end of every run and whenever the simulation is saved.
+    """
+    if self.mode != "record":
+      return
+    if self.random_index < len(self.randoms):
+      self._write({"type": "random",
+                   "draws": self.randoms[self.random_index:]})
+      self.random_index = len(self.randoms)
+    with self.lock:
+      self.outfile.flush()
+
+
+  def close(self):
+    self.flush()
+    self.uninstall()
+    if self.outfile:
+      self.outfile.close()
+      self.outfile = None
+
+
+# <active_tape> is the tape that the current process records to or replays
+# from (None if we are not using a tape).
+active_tape = None
+
+
+def get_active_tape():
+  return active_tape
+
+
+def set_active_tape(tape):
+  global active_tape
+  active_tape = tape